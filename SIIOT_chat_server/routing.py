@@ -1,7 +1,9 @@
-from channels.auth import AuthMiddlewareStack
+from channels.http import AsgiHandler
 from channels.routing import ProtocolTypeRouter, URLRouter, ChannelNameRouter
+from django.conf.urls import url
 
-from realtime.websocket.token_auth import TokenAuthMiddlewareStack
+from realtime.metrics import RealtimeMetricsConsumer
+from realtime.websocket.token_auth import TokenAuthMiddleware, TokenAuthMiddlewareStack
 from realtime.websocket.routing import websocket_urlpatterns
 
 import realtime
@@ -9,14 +11,14 @@ import realtime
 from realtime import consumers
 
 application = ProtocolTypeRouter({
-    'websocket': AuthMiddlewareStack(
-            URLRouter(
-                realtime.websocket.routing.websocket_urlpatterns
-            )
-        ),
-    # 'websocket': TokenAuthMiddlewareStack(
-    #     URLRouter(websocket_urlpatterns)
-    # ),
+    # worker 별 realtime 지표는 daphne 가 직접 응답하고, 나머지 http 요청은 Django 가 처리합니다.
+    'http': URLRouter([
+        url(r'^realtime/metrics/$', TokenAuthMiddleware(RealtimeMetricsConsumer)),
+        url(r'', AsgiHandler),
+    ]),
+    'websocket': TokenAuthMiddlewareStack(
+        URLRouter(websocket_urlpatterns)
+    ),
     # 'channel': ChannelNameRouter({
     #     'realtime-event-sender': consumers.EventSenderConsumer,
     # }),
@@ -32,17 +32,82 @@ DEBUG = True
 
 ALLOWED_HOSTS = ['127.0.0.1', 'localhost', '13.124.198.139']
 
+# Redis (channel layer 와 chat cache 가 같은 instance 를 사용합니다)
+REDIS_URL = 'redis://0.0.0.0:6379'
+# channel layer 를 나눠 저장할 Redis host 목록입니다. host 를 추가/제거한 후에는 rebalance_channel_layer 를 실행합니다.
+CHANNEL_REDIS_HOSTS = [REDIS_URL]
+
 # Channels
 ASGI_APPLICATION = 'SIIOT_chat_server.routing.application'
 CHANNEL_LAYERS = {
     'default': {
-        'BACKEND': 'channels_redis.core.RedisChannelLayer',
+        'BACKEND': 'realtime.layers.ShardedRedisChannelLayer',
         'CONFIG': {
-            "hosts": ['redis://0.0.0.0:6379'],
+            "hosts": CHANNEL_REDIS_HOSTS,
         },
     },
 }
 
+# Chat history ring buffer (chat.history.RoomHistoryBuffer)
+CHAT_HISTORY_BUFFER_SIZE = 50  # 방별로 보관하는 최근 message 수 (page_size 보다 커야 합니다)
+CHAT_HISTORY_BUFFER_TTL = 60 * 60 * 24  # 마지막 write 이후 보관 시간 (초)
+
+# 오래된 message 의 archive (chat.archive, archive_chat_history)
+CHAT_ARCHIVE_STORAGE = 'SIIOT_chat_server.storage.ArchiveStorage'  # local 에서는 'django.core.files.storage.FileSystemStorage'
+CHAT_ARCHIVE_STORAGE_OPTIONS = {}  # storage class 에 넘길 kwargs (ex. {'location': '/var/lib/siiot/archive'})
+CHAT_ARCHIVE_SEGMENT_SIZE = 1000  # segment 하나에 넣을 message 수
+CHAT_ARCHIVE_CACHE_SIZE = 64  # process 별로 decode 해 둘 segment 수 (LRU)
+CHAT_ARCHIVE_CACHE_TTL = 60 * 10  # decode 한 segment 보관 시간 (초)
+
+# Image url (core.resolvers, S3ImageKeyField / ImageField 의 url)
+IMAGE_URL_RESOLVER = 'core.resolvers.PublicURLResolver'  # private bucket 은 'core.resolvers.PresignedURLResolver'
+IMAGE_URL_RESOLVER_OPTIONS = {}  # resolver class 에 넘길 kwargs (ex. {'cdn_host': 'https://cdn.siiot.com'})
+IMAGE_URL_CACHE_SIZE = 50000  # presigned url 의 process 별 LRU 크기
+
+# Image upload (core.s3, S3ImageUploadViewSet 의 presigned POST)
+IMAGE_UPLOAD_MAX_COUNT = 10  # 한번에 발급하는 image key 수
+IMAGE_UPLOAD_MAX_SIZE = 10 * 1024 * 1024  # image 하나의 최대 크기 (bytes)
+IMAGE_UPLOAD_EXPIRE = 60 * 5  # presigned POST 유효 시간 (초)
+
+# Websocket message write-behind (chat.write_behind.WriteBehindBuffer)
+CHAT_WRITE_BEHIND = False  # True 이면 websocket message 를 먼저 broadcast 하고 worker 별로 모아서 저장합니다.
+CHAT_WRITE_BEHIND_BATCH_SIZE = 200  # 한번에 bulk_create 할 최대 message 수
+CHAT_WRITE_BEHIND_FLUSH_INTERVAL = 0.2  # 최대 flush 간격 (초)
+CHAT_WRITE_BEHIND_HEARTBEAT_TTL = 30  # 이 시간 동안 flush 가 없는 worker 의 journal 은 drain_write_behind 대상입니다. (초)
+CHAT_WRITE_BEHIND_MAX_ATTEMPTS = 3  # 이만큼 저장에 실패한 entry 는 dead-letter list 로 옮깁니다.
+
+# Sync code -> channel layer (chat.send_utils.SenderLoop)
+CHAT_SENDER_TIMEOUT = 5  # view 등 sync 코드에서 group_send 를 기다리는 최대 시간 (초)
+
+# Websocket presence (realtime.websocket.presence.PresenceService)
+PRESENCE_TTL = 60  # heartbeat 가 없는 connection 을 offline 으로 보는 시간 (초)
+PRESENCE_HEARTBEAT_INTERVAL = 20  # worker 가 자신의 connection 만료 시각을 갱신하는 간격 (초)
+
+# Token -> User cache (accounts.tokens, REST / websocket 공통)
+AUTH_TOKEN_CACHE_SIZE = 10000  # process 별 LRU 크기
+# User / Token 은 main server 가 쓰므로 signal 로 지워지지 않습니다. ban / 탈퇴 / token 삭제는 최대 L1_TTL + TTL (60초) 늦게 반영됩니다.
+AUTH_TOKEN_CACHE_L1_TTL = 30  # process LRU 보관 시간 (초)
+AUTH_TOKEN_CACHE_TTL = 30  # Redis 보관 시간 (초)
+
+# Endpoint 별 DB query 지표 (core.metrics.QueryMetrics, /metrics/)
+METRICS_SAMPLE_RATE = 0.1  # query 를 기록할 요청의 비율 (0 ~ 1). 요청 수는 항상 셉니다.
+METRICS_FLUSH_INTERVAL = 10  # process 에 모은 지표를 Redis 로 합치는 간격 (초)
+
+# Websocket worker 지표 (realtime.metrics.RealtimeMetrics, daphne worker 별 /realtime/metrics/)
+REALTIME_LOOP_LAG_INTERVAL = 0.5  # event loop lag 을 재는 간격 (초)
+
+# User card cache (accounts.cards, chat serializer 의 참여자 정보)
+USER_CARD_CACHE_SIZE = 10000  # process 별 LRU 크기
+USER_CARD_CACHE_L1_TTL = 30  # process LRU / card version 보관 시간 (초). 이 서버의 변경 (signal) 이 다른 process 에 반영되기까지의 최대 시간입니다.
+USER_CARD_CACHE_TTL = 60 * 5  # Redis 보관 시간 (초)
+# User / Profile 은 main 서버가 관리하므로 (managed = False) main 서버의 변경은 signal 로 알 수 없습니다.
+# invalidate_user_cards 를 실행하지 않으면 최대 USER_CARD_CACHE_TTL + USER_CARD_CACHE_L1_TTL (5분 30초) 동안 이전 card 가 보입니다.
+
+# Product snapshot cache (products.snapshots, 채팅방 header 의 product 정보)
+PRODUCT_SNAPSHOT_CACHE_SIZE = 10000  # process 별 LRU 크기
+PRODUCT_SNAPSHOT_CACHE_L1_TTL = 30  # process LRU / snapshot version 보관 시간 (초)
+PRODUCT_SNAPSHOT_CACHE_TTL = 60 * 10  # Redis 보관 시간 (초). main 서버의 수정이 반영되기까지의 최대 시간입니다.
+
 # Application definition
 
 INSTALLED_APPS = [
@@ -81,6 +146,7 @@ THIRD_APPS = [
 INSTALLED_APPS += SECONDS_APPS + THIRD_APPS
 
 MIDDLEWARE = [
+    'core.metrics.QueryMetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -115,6 +181,9 @@ DATABASES = {
     'default': SETTING_PRD_DIC["siiot_database"]
 }
 
+# main 서버가 관리하는 (managed = False) table 도 test DB 에 만듭니다. (python manage.py test)
+TEST_RUNNER = 'core.test_runner.UnmanagedModelTestRunner'
+
 
 WSGI_APPLICATION = 'SIIOT_chat_server.wsgi.application'
 
@@ -162,9 +231,13 @@ SITE_ID = 1
 # Rest Framework - settings for pagination
 REST_FRAMEWORK = {
     'DEFAULT_PAGINATION_CLASS': 'core.pagination.SiiotPagination',
+    'DEFAULT_RENDERER_CLASSES': (
+        'core.metrics.MetricsJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ),
     'PAGE_SIZE': 20,
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework.authentication.TokenAuthentication',
+        'accounts.authentication.CachedTokenAuthentication',
     ),
     'DEFAULT_PERMISSION_CLASSES': (
         'rest_framework.permissions.IsAuthenticated',
@@ -208,6 +281,14 @@ AWS_STORAGE_BUCKET_NAME = SETTING_PRD_DIC['S3']['AWS_STORAGE_BUCKET_NAME']
 
 AWS_QUERYSTRING_AUTH = False
 AWS_S3_HOST = 's3.%s.amazonaws.com' % AWS_S3_REGION_NAME
+AWS_S3_ENDPOINT_URL = None  # local S3 (minio 등) 를 쓸 때 'http://localhost:9000'
+AWS_S3_MAX_POOL_CONNECTIONS = 20  # core.s3 client 의 connection pool 크기 (S3_UPLOAD_MAX_WORKERS 이상)
+AWS_S3_MULTIPART_THRESHOLD = 8 * 1024 * 1024  # 이 크기 이상인 file 은 multipart upload 합니다. (storage._save)
+AWS_S3_MULTIPART_CHUNKSIZE = 8 * 1024 * 1024  # multipart upload 의 part 크기
+AWS_S3_MAX_CONCURRENCY = 4  # file 하나의 part 를 동시에 올리는 thread 수
+S3_UPLOAD_MAX_WORKERS = 10  # custom_manage.utils.S3Uploader.upload_many 가 동시에 올리는 file 수
+S3_UPLOAD_RETRIES = 3  # upload 실패시 다시 시도하는 횟수
+S3_UPLOAD_BACKOFF = 0.5  # 다시 시도하기 전 쉬는 시간 (초, 시도마다 2배)
 
 AWS_S3_CUSTOM_DOMAIN = '%s.s3.%s.amazonaws.com' % (AWS_STORAGE_BUCKET_NAME, AWS_S3_REGION_NAME)
 
@@ -1,7 +1,7 @@
+from boto3.s3.transfer import TransferConfig
 from django.conf import settings
 from storages.backends.s3boto3 import S3Boto3Storage
 import os
-from tempfile import SpooledTemporaryFile
 
 
 class MediaStorage(S3Boto3Storage):
@@ -12,6 +12,43 @@ class StaticStorage(S3Boto3Storage):
     location = settings.STATIC_LOCATION
 
 
+def build_transfer_config():
+    """
+    S3 upload 에 쓰는 TransferConfig 입니다. (CustomS3Boto3Storage, custom_manage.utils.S3Uploader)
+    part 크기 / 동시 upload 수는 settings.AWS_S3_MULTIPART_CHUNKSIZE / AWS_S3_MAX_CONCURRENCY 이고,
+    memory 는 file 크기와 상관없이 대략 part 크기 x 동시 upload 수 만큼만 씁니다.
+    """
+    config = TransferConfig(multipart_threshold=settings.AWS_S3_MULTIPART_THRESHOLD,
+                            multipart_chunksize=settings.AWS_S3_MULTIPART_CHUNKSIZE,
+                            max_concurrency=settings.AWS_S3_MAX_CONCURRENCY)
+    # 미리 읽어 두는 part 수 (기본값 10) 도 동시 upload 수로 제한합니다. (boto3 의 TransferConfig 인자에는 없음)
+    config.max_in_memory_upload_chunks = settings.AWS_S3_MAX_CONCURRENCY
+    return config
+
+
+class NonClosingFile(object):
+    """
+    file 을 감싸서 close() 만 무시하는 proxy 입니다. (나머지 method / attribute 는 원래 file 로 넘깁니다.)
+    boto3 가 upload 후 file 을 닫아도 storage backend 가 계속 쓸 수 있도록 복사하지 않고 그대로 넘깁니다.
+    """
+
+    def __init__(self, file):
+        self._file = file
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+    def __iter__(self):
+        return iter(self._file)
+
+    @property
+    def closed(self):
+        return False
+
+    def close(self):
+        pass
+
+
 class CustomS3Boto3Storage(S3Boto3Storage):
 
     location = settings.MEDIA_LOCATION
@@ -22,25 +59,38 @@ class CustomS3Boto3Storage(S3Boto3Storage):
     https://github.com/boto/boto3/issues/929
     https://github.com/matthewwithanm/django-imagekit/issues/391
     https://github.com/jschneier/django-storages/issues/382#issuecomment-377174808
+
+    content 를 복사하지 않고 NonClosingFile 로 감싸서 multipart upload 로 바로 보냅니다. (build_transfer_config)
     """
 
-    def _save_content(self, obj, content, parameters):
-        """
-        We create a clone of the content file as when this is passed to boto3 it wrongly closes
-        the file upon upload where as the storage backend expects it to still be open
-        """
-        # Seek our content back to the start
-        content.seek(0, os.SEEK_SET)
+    def get_transfer_config(self):
+        return build_transfer_config()
 
-        # Create a temporary file that will write to disk after a specified size
-        content_autoclose = SpooledTemporaryFile()
+    def _save(self, name, content):
+        # django-storages 1.9 의 _save 는 _save_content 를 거치지 않고 upload_fileobj 를 바로 호출하므로 _save 를 바꿉니다.
+        cleaned_name = self._clean_name(name)
+        name = self._normalize_name(cleaned_name)
+        params = self._get_write_parameters(name, content)
 
-        # Write our original content into our copy that will be closed by boto3
-        content_autoclose.write(content.read())
+        if (self.gzip and
+                params['ContentType'] in self.gzip_content_types and
+                'ContentEncoding' not in params):
+            content = self._compress_content(content)
+            params['ContentEncoding'] = 'gzip'
 
-        # Upload the object which will auto close the content_autoclose instance
-        super(CustomS3Boto3Storage, self)._save_content(obj, content_autoclose, parameters)
+        encoded_name = self._encode_name(name)
+        obj = self.bucket.Object(encoded_name)
+        if self.preload_metadata:
+            self._entries[encoded_name] = obj
 
-        # Cleanup if this is fixed upstream our duplicate should always close
-        if not content_autoclose.closed:
-            content_autoclose.close()
\ No newline at end of file
+        content.seek(0, os.SEEK_SET)
+        obj.upload_fileobj(NonClosingFile(content), ExtraArgs=params, Config=self.get_transfer_config())
+        return cleaned_name
+
+
+class ArchiveStorage(CustomS3Boto3Storage):
+    """
+    오래된 chat message archive (chat.archive) 를 저장합니다. 공개 url 로 읽지 않으므로 private 으로 올립니다.
+    """
+    location = 'archive'
+    default_acl = 'private'
@@ -0,0 +1,21 @@
+from django.utils.translation import gettext_lazy as _
+from rest_framework import exceptions
+from rest_framework.authentication import TokenAuthentication
+
+from accounts.tokens import resolve_token, is_allowed_user
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    """
+    TokenAuthentication 과 같지만, 매 요청마다 DB 를 조회하지 않고 accounts.tokens 의 cache 로 user 를 찾습니다.
+    """
+
+    def authenticate_credentials(self, key):
+        user = resolve_token(key)
+        if user is None:
+            raise exceptions.AuthenticationFailed(_('Invalid token.'))
+
+        if not is_allowed_user(user):
+            raise exceptions.AuthenticationFailed(_('User inactive or deleted.'))
+
+        return (user, key)
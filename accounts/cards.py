@@ -0,0 +1,61 @@
+from django.conf import settings
+
+from accounts.models import User, Profile
+from core.cache import VersionedTieredCache
+from core.resolvers import resolve_many
+
+# user id -> card ({'id', 'nickname', 'profile_image', 'version'}). profile_image 는 storage 의 file 이름입니다.
+# version 을 올리면 (bump_version) 모든 card 가 한번에 무효화됩니다. (main 서버에서 nickname / profile 을 수정한 경우 등)
+user_card_cache = VersionedTieredCache('accounts:card',
+                                       l1_maxsize=settings.USER_CARD_CACHE_SIZE,
+                                       l1_ttl=settings.USER_CARD_CACHE_L1_TTL,
+                                       l2_ttl=settings.USER_CARD_CACHE_TTL)
+
+
+def build_card(user, version):
+    """
+    serializer 가 참여자를 그릴 때 쓰는 user 정보입니다. profile 이 없으면 기본 profile image 를 사용합니다.
+    url 은 만료되는 presigned url 일 수 있으므로 저장하지 않고 꺼낼 때 만듭니다.
+    """
+    try:
+        profile_image = user.profile.profile_img.name
+    except Profile.DoesNotExist:
+        profile_image = Profile._meta.get_field('profile_img').default
+    return {
+        'id': user.id,
+        'nickname': user.nickname,
+        'profile_image': profile_image,
+        'version': version,
+    }
+
+
+def _load_cards(user_ids, version):
+    users = User.objects.filter(id__in=user_ids).select_related('profile')
+    return {user.id: build_card(user, version) for user in users}
+
+
+def get_user_cards(user_ids):
+    """
+    여러 user 의 card 를 한번에 가져옵니다. (process LRU -> Redis MGET -> 없는 user 만 DB 한번)
+    profile image url 은 resolve_many 로 한번에 만듭니다.
+    :return: {user_id: {'id', 'nickname', 'profile_image_url'}} (None / 없는 user 는 포함되지 않습니다.)
+    """
+    user_ids = {user_id for user_id in user_ids if user_id is not None}
+    if not user_ids:
+        return {}
+    cards = user_card_cache.get_or_load_many(user_ids, _load_cards)
+    urls = resolve_many(card['profile_image'] for card in cards.values())
+    return {user_id: {'id': card['id'], 'nickname': card['nickname'], 'profile_image_url': url}
+            for (user_id, card), url in zip(cards.items(), urls)}
+
+
+def get_user_card(user_id):
+    return get_user_cards([user_id]).get(user_id)
+
+
+def invalidate_user_card(user_id):
+    user_card_cache.delete(user_id)
+
+
+def invalidate_user_cards(user_ids):
+    user_card_cache.delete_many(user_ids)
@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+
+from accounts.cards import user_card_cache, invalidate_user_cards
+
+
+class Command(BaseCommand):
+    """
+    chat serializer 의 참여자 card cache 를 무효화합니다. (accounts.cards)
+    User / Profile 은 main 서버가 수정하므로 이 서버의 signal 로는 알 수 없는 변경이 있을 때 사용합니다.
+    - --user : 해당 user 의 card 만 지웁니다.
+    - 생략 : card version 을 올려 모든 card 를 무효화합니다.
+    - ex : python manage.py invalidate_user_cards --user 10 11
+    """
+    help = 'Invalidate cached user cards used by chat serializers.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', type=int, nargs='*', help='card 를 지울 user id')
+
+    def handle(self, *args, **options):
+        if options['user']:
+            invalidate_user_cards(options['user'])
+            self.stdout.write(self.style.SUCCESS('invalidated {} user cards'.format(len(options['user']))))
+        else:
+            version = user_card_cache.bump_version()
+            self.stdout.write(self.style.SUCCESS('user card version is now {}'.format(version)))
@@ -0,0 +1,34 @@
+from django.conf import settings
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from rest_framework.authtoken.models import Token
+
+from accounts.cards import invalidate_user_card
+from accounts.models import Profile
+from accounts.tokens import invalidate_token, invalidate_user_tokens
+
+
+@receiver(post_delete, sender=Token)
+def token_deleted(sender, instance, **kwargs):
+    invalidate_token(instance.key)
+
+
+@receiver(post_save, sender=settings.AUTH_USER_MODEL)
+def user_saved(sender, instance, created, **kwargs):
+    # is_banned / is_active 변경을 포함해 user 가 바뀌면 cache 된 user 와 card 를 버립니다.
+    if not created:
+        invalidate_user_tokens(instance.pk)
+        invalidate_user_card(instance.pk)
+
+
+@receiver(post_delete, sender=settings.AUTH_USER_MODEL)
+def user_deleted(sender, instance, **kwargs):
+    invalidate_user_tokens(instance.pk)
+    invalidate_user_card(instance.pk)
+
+
+@receiver(post_save, sender=Profile)
+@receiver(post_delete, sender=Profile)
+def profile_changed(sender, instance, **kwargs):
+    # profile image 가 바뀌면 card 의 profile_image_url 도 바뀝니다.
+    invalidate_user_card(instance.user_id)
@@ -0,0 +1,77 @@
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import router
+from rest_framework.authtoken.models import Token
+
+from core.cache import TieredCache
+
+User = get_user_model()
+
+# cache 에 넣지 않는 User field (password hash 는 Redis 에 두지 않습니다. 읽으면 DB 에서 가져옵니다.)
+SNAPSHOT_EXCLUDE = ('password',)
+
+# token key -> User snapshot ({attname: value})
+token_user_cache = TieredCache('auth:token:snapshot',
+                               l1_maxsize=settings.AUTH_TOKEN_CACHE_SIZE,
+                               l1_ttl=settings.AUTH_TOKEN_CACHE_L1_TTL,
+                               l2_ttl=settings.AUTH_TOKEN_CACHE_TTL)
+
+
+def snapshot_user(user):
+    """
+    cache 에 넣을 User 의 column 값입니다. User instance 는 요청끼리 공유하지 않도록 cache 에 넣지 않습니다.
+    """
+    return {field.attname: getattr(user, field.attname)
+            for field in User._meta.concrete_fields if field.attname not in SNAPSHOT_EXCLUDE}
+
+
+def build_user(snapshot):
+    """
+    snapshot 으로 요청마다 새 User instance 를 만듭니다. (DB 에서 읽은 것과 같은 상태, 빠진 field 는 deferred)
+    """
+    return User.from_db(router.db_for_read(User), list(snapshot), list(snapshot.values()))
+
+
+def resolve_token(key):
+    """
+    token key 로 User 를 찾습니다. (process LRU -> Redis -> DB 순서)
+    REST (CachedTokenAuthentication) 와 websocket (TokenAuthMiddleware) 이 함께 사용합니다.
+    User / Token 은 main server 가 쓰는 table (managed = False) 이라 이 server 의 signal 로는 대부분 지워지지 않습니다.
+    ban / 탈퇴 / token 삭제는 최대 AUTH_TOKEN_CACHE_L1_TTL + AUTH_TOKEN_CACHE_TTL 초 늦게 반영됩니다.
+    :return: 새 User object or None (없는 token)
+    """
+    snapshot = token_user_cache.get(key)
+    if snapshot is None:
+        token = Token.objects.select_related('user').filter(key=key).first()
+        if token is None:
+            return None
+        snapshot = snapshot_user(token.user)
+        token_user_cache.set(key, snapshot)
+    return build_user(snapshot)
+
+
+async def async_resolve_token(key):
+    """
+    resolve_token 의 async 버전입니다. process LRU 에 있으면 thread 전환 없이 바로 return 하고,
+    없을 때만 Redis / DB 조회를 event loop 밖에서 합니다.
+    """
+    snapshot = token_user_cache.get_local(key)
+    if snapshot is not None:
+        return build_user(snapshot)
+    return await database_sync_to_async(resolve_token)(key)
+
+
+def is_allowed_user(user):
+    return user.is_active and not user.is_banned
+
+
+def invalidate_token(key):
+    token_user_cache.delete(key)
+
+
+def invalidate_user_tokens(user_id):
+    """
+    user 의 token cache 를 지웁니다. (ban / 탈퇴 / 정보 변경 시 signal 에서 호출)
+    """
+    token_user_cache.delete_many(Token.objects.filter(user_id=user_id).values_list('key', flat=True))
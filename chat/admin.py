@@ -1,14 +1,15 @@
 from django.contrib import admin
-from chat.models import ChatRoom, ChatMessage, ChatMessageImages
+from chat.models import ChatRoom, ChatMessage, ChatMessageImages, UploadedImage
 from custom_manage.sites import staff_panel
 
 
 class ChatRoomAdmin(admin.ModelAdmin):
-    list_display = ['pk','seller', 'buyer', 'seller_active', 'buyer_active', 'deal', 'product', 'created_at']
+    list_display = ['pk','seller', 'buyer', 'seller_active', 'buyer_active', 'deal', 'product', 'created_at',
+                    'buyer_unread_count', 'seller_unread_count', 'buyer_last_read_id', 'seller_last_read_id']
 
 
 class ChatMessageAdmin(admin.ModelAdmin):
-    list_display = ['message_type', 'room', 'text', 'created_at', 'is_read',
+    list_display = ['message_type', 'room', 'text', 'created_at',
                     'owner', 'seller_visible', 'buyer_visible']
 
 
@@ -16,6 +17,11 @@ class ChatMessageImageAdmin(admin.ModelAdmin):
     list_display = ['message', 'image_key']
 
 
+class UploadedImageAdmin(admin.ModelAdmin):
+    list_display = ['image_key', 'uploader', 'size', 'content_type', 'created_at', 'confirmed_at']
+
+
 staff_panel.register(ChatRoom, ChatRoomAdmin)
 staff_panel.register(ChatMessage, ChatMessageAdmin)
 staff_panel.register(ChatMessageImages, ChatMessageImageAdmin)
+staff_panel.register(UploadedImage, UploadedImageAdmin)
@@ -0,0 +1,173 @@
+import datetime
+import gzip
+import json
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import get_storage_class
+from django.db import transaction
+from django.db.models import Q
+
+from chat.models import ChatRoom, ChatMessage, ChatMessageImages, ChatArchiveSegment
+from core.cache import LRUCache
+from core.fields import URLResolvableUUID
+
+SEGMENT_KEY_FORMAT = 'chat/{room_id}/{first_id}-{last_id}.ndjson.gz'
+
+# segment id -> decode 한 record list. segment 는 만든 후 바뀌지 않으므로 TTL 은 메모리 회수용입니다.
+segment_cache = LRUCache(settings.CHAT_ARCHIVE_CACHE_SIZE, settings.CHAT_ARCHIVE_CACHE_TTL)
+
+_storage = None
+
+
+def get_archive_storage():
+    """
+    settings.CHAT_ARCHIVE_STORAGE (storage class 경로) 와 CHAT_ARCHIVE_STORAGE_OPTIONS 로 만든 storage 입니다.
+    """
+    global _storage
+    if _storage is None:
+        _storage = get_storage_class(settings.CHAT_ARCHIVE_STORAGE)(**settings.CHAT_ARCHIVE_STORAGE_OPTIONS)
+    return _storage
+
+
+def encode_segment(messages):
+    """
+    message 들을 한줄에 하나씩 JSON (NDJSON) 으로 쓰고 gzip 으로 압축합니다. images 는 prefetch 되어 있어야 합니다.
+    """
+    lines = [json.dumps({
+        'id': message.id,
+        'message_type': message.message_type,
+        'text': message.text,
+        'created_at': message.created_at.isoformat(),
+        'owner': message.owner_id,
+        'seller_visible': message.seller_visible,
+        'buyer_visible': message.buyer_visible,
+        'images': [image.image_key.hex for image in message.images.all()],
+    }, ensure_ascii=False) for message in messages]
+    return gzip.compress('\n'.join(lines).encode('utf8'))
+
+
+def decode_segment(data):
+    records = []
+    for line in gzip.decompress(data).decode('utf8').splitlines():
+        record = json.loads(line)
+        record['created_at'] = datetime.datetime.fromisoformat(record['created_at'])
+        records.append(record)
+    return records
+
+
+def build_message(record, room):
+    """
+    archive record 를 저장되지 않은 ChatMessage 로 만듭니다. (images 는 set_images 로 넣습니다.)
+    DB 에서 읽은 message 와 같은 serializer / cursor 로 다룰 수 있습니다.
+    """
+    message = ChatMessage(id=record['id'], room=room, message_type=record['message_type'], text=record['text'],
+                          created_at=record['created_at'], owner_id=record['owner'],
+                          seller_visible=record['seller_visible'], buyer_visible=record['buyer_visible'])
+    message.set_images([ChatMessageImages(message=message, image_key=URLResolvableUUID(hex=key))
+                        for key in record['images']])
+    return message
+
+
+def load_segment(segment):
+    records = segment_cache.get(segment.pk)
+    if records is None:
+        with get_archive_storage().open(segment.storage_key, 'rb') as segment_file:
+            records = decode_segment(segment_file.read())
+        segment_cache.set(segment.pk, records)
+    return records
+
+
+class ArchivedHistory(object):
+    """
+    방의 archive 된 message (ChatArchiveSegment) 를 keyset 으로 읽습니다.
+    MonthlyWindowKeysetPagination 의 cold_source 로 사용하며, archive 된 message 는 항상 DB 에 남은 message 보다 오래됐습니다.
+    """
+
+    def __init__(self, room):
+        self.room = room
+
+    def fetch(self, ordering, position, limit):
+        """
+        ordering (('-created_at', '-id') 또는 반대) 순서로 position 뒤의 message 를 limit 개까지 return 합니다.
+        """
+        descending = ordering[0].startswith('-')
+        segments = ChatArchiveSegment.objects.filter(room=self.room)
+        if position is not None:
+            value = ChatMessage._meta.get_field('created_at').to_python(position[0])
+            key = (value, int(position[1]))
+            segments = segments.filter(first_created_at__lte=value) if descending \
+                else segments.filter(last_created_at__gte=value)
+        segments = segments.order_by('-last_created_at', '-last_message_id') if descending \
+            else segments.order_by('first_created_at', 'first_message_id')
+
+        rows = []
+        for segment in segments:
+            records = load_segment(segment)
+            if descending:
+                records = reversed(records)
+            for record in records:
+                if position is not None:
+                    record_key = (record['created_at'], record['id'])
+                    if (descending and record_key >= key) or (not descending and record_key <= key):
+                        continue
+                rows.append(build_message(record, self.room))
+                if len(rows) >= limit:
+                    return rows
+        return rows
+
+    def get(self, message_id):
+        """
+        archive 된 message 하나를 찾습니다. (?before= / ?after= 의 기준 message 가 archive 된 경우)
+        """
+        segments = ChatArchiveSegment.objects.filter(room=self.room, first_message_id__lte=message_id,
+                                                     last_message_id__gte=message_id)
+        for segment in segments:
+            for record in load_segment(segment):
+                if record['id'] == message_id:
+                    return build_message(record, self.room)
+        return None
+
+
+def archive_room(room, cutoff, segment_size, keep_latest=0):
+    """
+    방의 created_at < cutoff 인 message 를 오래된 순서로 segment_size 개씩 archive storage 에 쓰고 DB 에서 지웁니다.
+    segment 마다 (storage 에 쓰기 -> segment index 저장 + message / image 삭제 + archived_until 갱신) 순서로 하므로
+    중간에 실패해도 DB 와 archive 에 같은 message 가 둘 다 있거나 둘 다 없는 경우는 없습니다.
+    (storage 에 쓴 후 DB 가 실패하면 index 없는 object 만 남고, 다음 실행에서 다시 씁니다.)
+    :param keep_latest: cutoff 와 상관없이 DB 에 남길 최근 message 수 (inbox 의 마지막 message, history buffer 용)
+    :return: (만든 segment 수, archive 한 message 수)
+    """
+    if keep_latest:
+        kept = room.get_history().order_by('-created_at', '-id').values_list('created_at', flat=True)
+        boundary = list(kept[keep_latest - 1:keep_latest])
+        if not boundary:
+            return 0, 0
+        cutoff = min(cutoff, boundary[0])
+
+    storage = get_archive_storage()
+    segments = archived = 0
+    while True:
+        batch = list(room.get_history().filter(created_at__lt=cutoff)
+                     .order_by('created_at', 'id').prefetch_related('images')[:segment_size])
+        if not batch:
+            break
+        ids = [message.id for message in batch]
+        name = SEGMENT_KEY_FORMAT.format(room_id=room.pk, first_id=ids[0], last_id=ids[-1])
+        data = encode_segment(batch)
+        storage_key = storage.save(name, ContentFile(data))
+
+        with transaction.atomic():
+            ChatArchiveSegment.objects.create(
+                room=room, storage_key=storage_key, message_count=len(batch), size=len(data),
+                first_message_id=min(ids), last_message_id=max(ids),
+                first_created_at=batch[0].created_at, last_created_at=batch[-1].created_at)
+            ChatMessageImages.objects.filter(message_id__in=ids).delete()
+            ChatMessage.objects.filter(Q(room=room) & Q(id__in=ids)).delete()
+            # 남은 message 는 모두 archived_until 이후이므로 history 조회의 partition 하한으로 씁니다.
+            ChatRoom.objects.filter(pk=room.pk).update(archived_until=batch[-1].created_at)
+            room.archived_until = batch[-1].created_at
+
+        segments += 1
+        archived += len(batch)
+    return segments, archived
@@ -0,0 +1,165 @@
+import json
+import logging
+import uuid
+
+import redis
+from django.conf import settings
+
+from chat.serializers import ChatMessageBufferSerializer
+from core.redis import get_redis
+from core.resolvers import resolve_many
+
+logger = logging.getLogger(__name__)
+
+# buffer 가 있을 때만 (LPUSH + LTRIM + TTL 갱신 + version 갱신) 을 atomic 하게 수행합니다.
+_PUSH_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return 0
+end
+redis.call('LPUSH', KEYS[1], ARGV[1])
+redis.call('LTRIM', KEYS[1], 0, tonumber(ARGV[3]) - 1)
+redis.call('EXPIRE', KEYS[1], ARGV[4])
+redis.call('SET', KEYS[2], ARGV[2], 'EX', ARGV[4])
+return 1
+"""
+
+
+def serialize_message(message, room):
+    """
+    buffer 에 저장할 형태로 message 를 serialize 합니다. (ChatMessageBufferSerializer)
+    image url 과 is_read 는 저장하지 않고 꺼낼 때 만듭니다. (resolve_rows)
+    """
+    return serialize_messages([message], room)[0]
+
+
+def serialize_messages(messages, room):
+    return ChatMessageBufferSerializer(messages, many=True, context={'room': room}).data
+
+
+def resolve_rows(rows, room):
+    """
+    buffer 에서 꺼낸 row 를 ChatMessageReadSerializer 와 같은 형태로 바꿉니다.
+    image key 는 resolve_many 로 한번에 url 로 바꾸고, is_read 는 방의 watermark 로 계산합니다.
+    """
+    keys = [uuid.UUID(key) for row in rows for key in row['message_image_keys'] or ()]
+    urls = iter(resolve_many(keys))
+    for row in rows:
+        image_keys = row.pop('message_image_keys')
+        row['message_image_url'] = None if image_keys is None else [next(urls) for _ in image_keys]
+        row['is_read'] = room.is_read_message(row['id'], row['owner'])
+    return rows
+
+
+class RoomHistoryBuffer(object):
+    """
+    방별 최근 message 를 serialize 된 JSON 으로 Redis list 에 최신순으로 보관하는 ring buffer 입니다.
+    첫 page message history (deliver) 를 MySQL 대신 여기서 읽습니다.
+    - image : url (presigned url 은 만료됩니다) 이 아니라 image key 를 저장하고, 꺼낼 때 url 로 바꿉니다.
+    - size : CHAT_HISTORY_BUFFER_SIZE 개를 넘으면 오래된 message 부터 LTRIM 으로 버립니다.
+    - TTL : 마지막 write 이후 CHAT_HISTORY_BUFFER_TTL 초가 지나면 사라집니다.
+    - version : buffer 를 채울 때의 ChatRoom.updated_at 을 함께 저장합니다. message 가 저장될 때마다 updated_at 이
+      바뀌므로, 조회할 때 이미 읽어온 ChatRoom 의 updated_at 과 다르면 buffer 를 쓰지 않고 DB 에서 다시 채웁니다.
+    - cold start : buffer 가 없으면 push 는 무시되고, 다음 조회 때 DB 에서 최근 size 개로 채웁니다.
+    """
+    key_format = 'chat:history:{}'
+    version_key_format = 'chat:history:{}:version'
+
+    def __init__(self, room, client=None):
+        self.room = room
+        self.client = client or get_redis()
+        self.size = settings.CHAT_HISTORY_BUFFER_SIZE
+        self.ttl = settings.CHAT_HISTORY_BUFFER_TTL
+        self.key = self.key_format.format(room.pk)
+        self.version_key = self.version_key_format.format(room.pk)
+
+    @property
+    def version(self):
+        return str(self.room.updated_at)
+
+    def push(self, message):
+        """
+        새 message 를 buffer 앞에 넣습니다. ChatRoom.updated_at 이 message.created_at 으로 갱신된 후 호출합니다.
+        """
+        data = json.dumps(serialize_message(message, self.room))
+        try:
+            self.client.register_script(_PUSH_SCRIPT)(
+                keys=[self.key, self.version_key],
+                args=[data, str(message.created_at), self.size, self.ttl])
+        except redis.RedisError:
+            logger.exception('chat history buffer push failed (room %s)', self.room.pk)
+            self.invalidate()
+
+    def get(self):
+        """
+        buffer 에 보관된 message 를 최신순으로 return 합니다. buffer 가 없거나 version 이 다르면 None 입니다.
+        """
+        try:
+            with self.client.pipeline() as pipe:
+                pipe.lrange(self.key, 0, self.size - 1)
+                pipe.get(self.version_key)
+                (rows, version) = pipe.execute()
+        except redis.RedisError:
+            logger.exception('chat history buffer get failed (room %s)', self.room.pk)
+            return None
+        if not rows or version is None or version.decode() != self.version:
+            return None
+        rows = [json.loads(row) for row in rows]
+        if any('message_image_keys' not in row for row in rows):
+            # image url 을 저장하던 이전 형태의 buffer 는 다시 채웁니다.
+            return None
+        return rows
+
+    def fill(self):
+        """
+        DB 에서 최근 size 개 message 를 읽어 buffer 를 다시 채우고, 채운 message 를 return 합니다.
+        """
+        messages = self.room.get_history().prefetch_related('images').order_by('-created_at', '-id')[:self.size]
+        rows = serialize_messages(messages, self.room)
+        if not rows:
+            return rows
+        try:
+            with self.client.pipeline() as pipe:
+                pipe.delete(self.key)
+                pipe.rpush(self.key, *[json.dumps(row) for row in rows])
+                pipe.expire(self.key, self.ttl)
+                pipe.set(self.version_key, self.version, ex=self.ttl)
+                pipe.execute()
+        except redis.RedisError:
+            logger.exception('chat history buffer fill failed (room %s)', self.room.pk)
+        return rows
+
+    def invalidate(self):
+        try:
+            self.client.delete(self.key, self.version_key)
+        except redis.RedisError:
+            logger.exception('chat history buffer invalidate failed (room %s)', self.room.pk)
+
+    def get_latest(self, count):
+        """
+        최근 count 개 (다음 page 여부 확인을 위해 +1 개까지) message 를 최신순으로 return 합니다.
+        buffer 를 쓸 수 없으면 DB 에서 읽고 buffer 를 채웁니다.
+        """
+        rows = self.get()
+        if rows is None:
+            rows = self.fill()
+        return resolve_rows(rows[:count + 1], self.room)
+
+    def verify(self):
+        """
+        buffer 의 message id 들이 ChatMessage 의 최근 message id 들과 같은지 확인합니다.
+        다르면 buffer 를 지우고 False 를 return 합니다.
+        """
+        try:
+            rows = self.client.lrange(self.key, 0, self.size - 1)
+        except redis.RedisError:
+            logger.exception('chat history buffer verify failed (room %s)', self.room.pk)
+            return False
+        if not rows:
+            return True
+        buffered_ids = [json.loads(row)['id'] for row in rows]
+        db_ids = list(self.room.get_history().order_by('-created_at', '-id')
+                      .values_list('id', flat=True)[:len(buffered_ids)])
+        if buffered_ids == db_ids:
+            return True
+        self.invalidate()
+        return False
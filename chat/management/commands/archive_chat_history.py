@@ -0,0 +1,46 @@
+import datetime
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+
+from chat.archive import archive_room
+from chat.models import ChatRoom
+
+
+class Command(BaseCommand):
+    """
+    --older-than-days 보다 오래된 message 를 방별 gzip NDJSON segment 로 archive storage
+    (settings.CHAT_ARCHIVE_STORAGE) 에 옮기고 DB 에서 지웁니다. segment index 는 ChatArchiveSegment 에 남고,
+    deliver 의 이전 page 조회는 DB 의 message 가 끝나면 archive 를 이어서 읽습니다.
+    방마다 최근 --keep-latest 개 message 는 오래됐어도 DB 에 남깁니다. (inbox 의 마지막 message / history buffer)
+    월별 partition 을 DROP (partition_chat_messages --retain-months) 하기 전에 실행합니다.
+    - ex : python manage.py archive_chat_history --older-than-days 730 --room 1 2 3
+    """
+    help = 'Move old chat messages into per-room compressed segments in archive storage.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--older-than-days', type=int, default=365 * 2, help='이 일수보다 오래된 message 를 옮깁니다.')
+        parser.add_argument('--segment-size', type=int, default=settings.CHAT_ARCHIVE_SEGMENT_SIZE,
+                            help='segment 하나에 넣을 message 수')
+        parser.add_argument('--keep-latest', type=int, default=settings.CHAT_HISTORY_BUFFER_SIZE,
+                            help='방마다 DB 에 남길 최근 message 수')
+        parser.add_argument('--room', type=int, nargs='*', help='특정 room id 만 옮깁니다.')
+
+    def handle(self, *args, **options):
+        cutoff = datetime.datetime.now() - datetime.timedelta(days=options['older_than_days'])
+        rooms = ChatRoom.objects.filter(Q(archived_until__isnull=True) | Q(archived_until__lt=cutoff),
+                                        created_at__lt=cutoff)
+        if options['room']:
+            rooms = rooms.filter(pk__in=options['room'])
+
+        total_segments = total_messages = 0
+        for room in rooms.order_by('id').iterator():
+            segments, messages = archive_room(room, cutoff, options['segment_size'], options['keep_latest'])
+            if segments:
+                self.stdout.write('room {} : {} messages in {} segments'.format(room.pk, messages, segments))
+            total_segments += segments
+            total_messages += messages
+
+        self.stdout.write(self.style.SUCCESS('{} messages archived in {} segments (before {:%Y-%m-%d})'.format(
+            total_messages, total_segments, cutoff)))
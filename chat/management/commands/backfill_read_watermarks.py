@@ -0,0 +1,64 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import F, Max, Q
+
+from chat.models import ChatRoom, ChatMessage
+
+
+class Command(BaseCommand):
+    """
+    ChatMessage.is_read 로 기록되던 읽음 정보를 ChatRoom 의 buyer/seller_last_read_id (watermark) 로 옮깁니다.
+    상대방이 보낸 message 중 is_read=True 인 가장 큰 id 를 watermark 로 씁니다.
+    (기존 deliver 는 방의 message 를 한번에 모두 읽음 처리했기 때문에 그 아래 message 는 모두 읽은 것입니다.)
+
+    migration 순서
+    1. buyer/seller_last_read_id column 추가 후 배포 (이후로 is_read 는 update 되지 않습니다)
+    2. python manage.py backfill_read_watermarks
+    3. python manage.py rebuild_unread_counts
+    4. 다음 release 에서 ChatMessage.is_read column 제거
+    """
+    help = 'Backfill ChatRoom read watermarks from the deprecated ChatMessage.is_read column.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=500, help='한번에 처리할 ChatRoom 수')
+
+    def handle(self, *args, **options):
+        chunk_size = options['chunk_size']
+        last_pk = 0
+        updated = 0
+        while True:
+            room_ids = list(ChatRoom.objects.filter(pk__gt=last_pk).order_by('pk')
+                            .values_list('pk', flat=True)[:chunk_size])
+            if not room_ids:
+                break
+            last_pk = room_ids[-1]
+            updated += self._backfill_chunk(room_ids)
+            self.stdout.write('backfilled rooms ~{}'.format(last_pk))
+
+        self.stdout.write(self.style.SUCCESS('{} rooms backfilled'.format(updated)))
+
+    @transaction.atomic
+    def _backfill_chunk(self, room_ids):
+        rooms = list(ChatRoom.objects.select_for_update().filter(pk__in=room_ids))
+
+        watermark_qs = ChatMessage.objects.filter(room_id__in=room_ids, is_read=True)\
+            .order_by().values('room_id').annotate(
+                buyer_last_read_id=Max('id', filter=~Q(owner_id=F('room__buyer_id'))),
+                seller_last_read_id=Max('id', filter=~Q(owner_id=F('room__seller_id'))),
+            )
+        watermark_by_room = {row['room_id']: row for row in watermark_qs}
+
+        updated = 0
+        for room in rooms:
+            row = watermark_by_room.get(room.pk)
+            if row is None:
+                continue
+            # 이미 새 방식으로 읽은 방의 watermark 를 뒤로 돌리지 않습니다.
+            buyer_last_read_id = max(room.buyer_last_read_id, row['buyer_last_read_id'] or 0)
+            seller_last_read_id = max(room.seller_last_read_id, row['seller_last_read_id'] or 0)
+            if (buyer_last_read_id, seller_last_read_id) == (room.buyer_last_read_id, room.seller_last_read_id):
+                continue
+            ChatRoom.objects.filter(pk=room.pk).update(buyer_last_read_id=buyer_last_read_id,
+                                                       seller_last_read_id=seller_last_read_id)
+            updated += 1
+        return updated
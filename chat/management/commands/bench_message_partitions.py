@@ -0,0 +1,131 @@
+import datetime
+import random
+import statistics
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.models import Count, Q
+
+from accounts.models import User
+from chat.models import ChatRoom, ChatMessage
+from chat.partitions import MESSAGE_TABLE, get_partitions
+from core.dates import month_start
+
+SEED_PREFIX = 'partition_bench'
+BASE_ROWS = 10000
+MAX_INSERT_ROWS = 1000000  # INSERT ... SELECT 한번에 복사할 최대 row 수
+
+
+class Command(BaseCommand):
+    """
+    방 하나의 message history page 조회를 EXPLAIN 하고 시간을 재서, 기존 keyset query 와
+    월별 window query (MonthlyWindowKeysetPagination) 를 비교합니다. (MySQL 전용)
+    partition_chat_messages 실행 전 / 후에 각각 실행해 before / after 를 비교합니다.
+    - 최신 page : created_at 범위 없이 ORDER BY ... LIMIT  vs  created_at >= 이번 달 1일
+    - 이전 page : (created_at, id) < cursor  vs  cursor 의 달 1일 <= created_at 추가
+    - --seed-rows : benchmark 용 방 --rooms 개에 --months 달에 걸친 message 를 목표 개수까지 만듭니다.
+      (10000 개를 만든 후 INSERT ... SELECT 로 두배씩 늘립니다. ex. --seed-rows 50000000)
+    - ex : python manage.py bench_message_partitions --seed-rows 50000000
+           python manage.py partition_chat_messages && python manage.py bench_message_partitions
+    """
+    help = 'EXPLAIN and time chat history queries with and without monthly partition windows (MySQL).'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--seed-rows', type=int, default=0, help='benchmark 방들의 message 를 이 개수까지 만듭니다.')
+        parser.add_argument('--rooms', type=int, default=1000, help='--seed-rows 로 만들 방 수')
+        parser.add_argument('--months', type=int, default=24, help='--seed-rows 로 만들 message 의 기간 (달)')
+        parser.add_argument('--room', type=int, help='측정할 방 id (기본값은 benchmark 방 중 message 가 가장 많은 방)')
+        parser.add_argument('--repeat', type=int, default=20, help='query 별 측정 횟수')
+        parser.add_argument('--page-size', type=int, default=20)
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'mysql':
+            raise CommandError('this benchmark needs MySQL (current: {})'.format(connection.vendor))
+
+        if options['seed_rows']:
+            self._seed(options['seed_rows'], options['rooms'], options['months'])
+
+        room = self._get_room(options['room'])
+        with connection.cursor() as cursor:
+            partitions = get_partitions(cursor)
+        message_count = room.messages.count()
+        self.stdout.write('{} : {} partitions, room {} ({} messages)'.format(
+            MESSAGE_TABLE, len(partitions) or 'no', room.pk, message_count))
+
+        limit = options['page_size'] + 1
+        if message_count < limit * 2:
+            raise CommandError('room {} has too few messages to measure'.format(room.pk))
+        history = room.get_history().order_by('-created_at', '-id')
+        latest = history.first()
+        cursor_message = history[message_count // 2]
+        keyset = Q(created_at__lt=cursor_message.created_at) | \
+            Q(created_at=cursor_message.created_at, id__lt=cursor_message.id)
+
+        cases = (
+            ('latest page / keyset', room.messages.order_by('-created_at', '-id')[:limit]),
+            ('latest page / window', history.filter(created_at__gte=month_start(latest.created_at))[:limit]),
+            ('older page / keyset', room.messages.filter(keyset).order_by('-created_at', '-id')[:limit]),
+            ('older page / window',
+             history.filter(keyset, created_at__gte=month_start(cursor_message.created_at))[:limit]),
+        )
+        for name, queryset in cases:
+            self.stdout.write(self.style.MIGRATE_HEADING(name))
+            self.stdout.write(queryset.explain())
+            self.stdout.write('median {:.2f}ms'.format(self._time(queryset, options['repeat'])))
+
+    def _get_room(self, room_id):
+        if room_id is not None:
+            room = ChatRoom.objects.filter(pk=room_id).first()
+        else:
+            room = ChatRoom.objects.filter(buyer__nickname='{}_buyer'.format(SEED_PREFIX))\
+                .annotate(message_count=Count('messages')).order_by('-message_count').first()
+        if room is None:
+            raise CommandError('no room to measure (use --room or --seed-rows)')
+        return room
+
+    def _time(self, queryset, repeat):
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            list(queryset.all())
+            timings.append((time.perf_counter() - start) * 1000)
+        return statistics.median(timings)
+
+    def _seed(self, target, rooms, months):
+        now = datetime.datetime.now()
+        start = now - datetime.timedelta(days=30 * months)
+        buyer, created = User.objects.get_or_create(nickname='{}_buyer'.format(SEED_PREFIX),
+                                                    defaults={'phone': '01000000000'})
+        seller, _ = User.objects.get_or_create(nickname='{}_seller'.format(SEED_PREFIX),
+                                               defaults={'phone': '01000000000'})
+        room_qs = ChatRoom.objects.filter(buyer=buyer)
+        if created or not room_qs.exists():
+            ChatRoom.objects.bulk_create([ChatRoom(buyer=buyer, seller=seller) for _ in range(rooms)])
+            room_qs.update(created_at=start, updated_at=now)
+        room_ids = list(room_qs.values_list('id', flat=True))
+        messages = ChatMessage.objects.filter(room_id__in=room_ids)
+
+        count = messages.count()
+        if count < BASE_ROWS:
+            span = (now - start).total_seconds()
+            # created_at 을 기간 안에 흩어 놓습니다.
+            ChatMessage.objects.bulk_create([
+                ChatMessage(room_id=random.choice(room_ids), owner=buyer, text='{} {}'.format(SEED_PREFIX, i),
+                            created_at=start + datetime.timedelta(seconds=random.randint(0, int(span))))
+                for i in range(BASE_ROWS - count)
+            ], batch_size=5000)
+            count = BASE_ROWS
+
+        columns = 'message_type, room_id, text, created_at, is_read, owner_id, seller_visible, buyer_visible'
+        while count < target:
+            rows = min(count, target - count, MAX_INSERT_ROWS)
+            with transaction.atomic(), connection.cursor() as cursor:
+                cursor.execute(
+                    'INSERT INTO `{table}` ({columns}) '
+                    'SELECT message_type, room_id, text, LEAST(created_at + INTERVAL FLOOR(RAND() * 86400) SECOND, %s), '
+                    'is_read, owner_id, seller_visible, buyer_visible FROM `{table}` '
+                    'WHERE room_id BETWEEN %s AND %s LIMIT %s'.format(table=MESSAGE_TABLE, columns=columns),
+                    [now, min(room_ids), max(room_ids), rows])
+            count += rows
+            self.stdout.write('seeded {} / {} messages'.format(count, target))
@@ -0,0 +1,62 @@
+import time
+from datetime import datetime
+
+from asgiref.sync import async_to_sync
+from channels import layers
+from django.core.management.base import BaseCommand
+
+from chat.send_utils import MessageSender, new_message_event, get_room_group_name
+from core.stats import percentile
+
+
+class Command(BaseCommand):
+    """
+    view(sync 코드) 에서 room group 으로 event 를 보낼 때의 latency 를 경로별로 비교합니다. (DB 는 사용하지 않습니다.)
+    - async_to_sync : 기존 helper 처럼 호출마다 async_to_sync(channel_layer.group_send)
+    - sender : MessageSender.deliver_message (worker 당 하나의 loop / connection 재사용)
+    - deliver_many : MessageSender.deliver_many 로 --batch 개씩 보낼 때 event 한개당 latency
+    settings 의 CHANNEL_LAYERS 를 그대로 사용하므로 Redis channel layer 에서 측정해야 의미가 있습니다.
+    - ex : python manage.py bench_message_sender --count 2000 --batch 10
+    """
+    help = 'Benchmark p50/p99 group_send latency of async_to_sync helpers vs MessageSender.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--count', type=int, default=2000, help='경로별로 보낼 event 수')
+        parser.add_argument('--batch', type=int, default=10, help='deliver_many 한번에 보낼 event 수')
+        parser.add_argument('--room', type=int, default=0, help='event 를 보낼 room id (구독자가 없어도 됩니다)')
+
+    def handle(self, *args, **options):
+        channel_layer = layers.get_channel_layer()
+        room_id = options['room']
+        room_group_name = get_room_group_name(room_id)
+        count = options['count']
+        batch = options['batch']
+
+        latencies = []
+        for i in range(count):
+            start = time.perf_counter()
+            async_to_sync(channel_layer.group_send)(room_group_name,
+                                                    new_message_event('bench {}'.format(i), 1, datetime.now()))
+            latencies.append(time.perf_counter() - start)
+        self._report('async_to_sync', latencies)
+
+        sender = MessageSender(channel_layer=channel_layer, room_id=room_id, room=object())
+        latencies = []
+        for i in range(count):
+            start = time.perf_counter()
+            sender.deliver_message('bench {}'.format(i), 1, datetime.now())
+            latencies.append(time.perf_counter() - start)
+        self._report('sender', latencies)
+
+        latencies = []
+        for i in range(0, count, batch):
+            events = [new_message_event('bench {}'.format(j), 1, datetime.now()) for j in range(i, i + batch)]
+            start = time.perf_counter()
+            sender.deliver_many(events)
+            latencies.extend([(time.perf_counter() - start) / len(events)] * len(events))
+        self._report('deliver_many', latencies)
+
+    def _report(self, name, latencies):
+        self.stdout.write('{:<14} n={} mean={:.3f}ms p50={:.3f}ms p99={:.3f}ms'.format(
+            name, len(latencies), sum(latencies) / len(latencies) * 1000,
+            percentile(latencies, 50) * 1000, percentile(latencies, 99) * 1000))
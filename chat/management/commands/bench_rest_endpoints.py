@@ -0,0 +1,184 @@
+import json
+import os
+import statistics
+import time
+
+from django.db import connection, transaction
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIClient
+
+from accounts.models import User, Profile
+from chat.models import ChatRoom, ChatMessage
+from products.models import Product, ProdThumbnail
+from products.shopping_mall.models import ShoppingMall
+
+BUDGET_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))),
+                           'bench_budget.json')
+SCALES = (10, 1000, 100000)
+SEED_PREFIX = 'bench'
+# time budget 은 측정한 machine 에 따라 달라지므로 기본으로는 출력만 하고 (--enforce-time 일 때만 실패),
+# 몇 ms 짜리 budget 은 잡음(GC, 다른 job) 만으로도 넘으므로 이 값보다 낮추지 않습니다. (ms)
+TIME_BUDGET_FLOORS = {'wall_ms': 50.0, 'db_ms': 20.0}
+
+
+def get_limit(limit, key):
+    if key in TIME_BUDGET_FLOORS:
+        return max(limit[key], TIME_BUDGET_FLOORS[key])
+    return limit[key]
+
+
+def seed_scale(scale, rooms):
+    """
+    scale 별 benchmark 용 buyer / seller 와 방 rooms 개를 만듭니다. (이미 있으면 그대로 사용)
+    첫 방에는 message 를 scale 개, 나머지 방(inbox 용) 에는 10개씩 넣습니다.
+    :return: (buyer, 첫 방)
+    """
+    nickname = '{}{}_buyer'.format(SEED_PREFIX, scale)
+    buyer = User.objects.filter(nickname=nickname).first()
+    if buyer is not None:
+        return buyer, ChatRoom.objects.filter(buyer=buyer).order_by('id').first()
+
+    with transaction.atomic():
+        mall, _ = ShoppingMall.objects.get_or_create(name=SEED_PREFIX)
+        buyer = User.objects.create(nickname=nickname, phone='01000000000')
+        seller = User.objects.create(nickname='{}{}_seller'.format(SEED_PREFIX, scale), phone='01000000000')
+        Profile.objects.bulk_create([Profile(user=buyer), Profile(user=seller)])
+        first_room = None
+        for i in range(rooms):
+            product = Product.objects.create(seller=seller, condition=Product.UNOPENED, shopping_mall=mall,
+                                             name='{} {}'.format(SEED_PREFIX, i), price=10000, temp_save=False)
+            ProdThumbnail.objects.create(product=product, thumbnail='{}.jpg'.format(SEED_PREFIX))
+            room = ChatRoom.objects.create(buyer=buyer, seller=seller, product=product)
+            first_room = first_room or room
+            count = scale if i == 0 else 10
+            for start in range(0, count, 10000):
+                ChatMessage.objects.bulk_create([
+                    ChatMessage(room=room, owner=seller if j % 2 else buyer, text='{} message {}'.format(SEED_PREFIX, j))
+                    for j in range(start, min(count, start + 10000))
+                ])
+    return buyer, first_room
+
+
+class Command(BaseCommand):
+    """
+    chat REST endpoint 의 wall time / DB query 수 / DB time 을 scale(방 하나의 message 수) 별로 측정하고,
+    chat/bench_budget.json 의 query 수 budget 을 넘으면 실패합니다. (CI / 배포 전 회귀 확인용)
+    - endpoint : ChatRoomViewSet.list, ChatMessageViewSet.deliver (첫 page / ?before= 이전 page),
+      ChatMessageViewSet.message,
+      S3ImageUploadViewSet.image_key_list (presigned POST 는 local 에서 서명만 하므로 S3 에 접속하지 않습니다.)
+    - 처음 실행할 때 scale 별 user / product / 방 / message 를 만들고, 다음부터는 그대로 사용합니다.
+    - 각 endpoint 는 한번 호출해 cache 를 채운 후 --repeat 번 측정해서 time 은 중앙값, query 수는 최대값을 사용합니다.
+    - query 수 budget 은 machine 과 상관없는 정확한 값이므로 항상 확인합니다.
+    - time budget 은 machine 에 따라 다르므로 기본으로는 넘어도 SLOW 로 출력만 합니다. time 으로도 실패시키려면
+      같은 machine (ex. CI runner) 에서 --write-budget 으로 budget 을 만든 후 --enforce-time 으로 실행합니다.
+      (TIME_BUDGET_FLOORS 보다 낮게 잡지 않습니다.)
+    실제로 데이터를 만들고 message 를 저장하므로 local / 개발용 DB 에서만 사용합니다.
+    - ex : python manage.py bench_rest_endpoints --scale 10 --scale 1000
+           python manage.py bench_rest_endpoints --write-budget (측정값으로 budget 파일을 다시 씁니다.)
+           python manage.py bench_rest_endpoints --budget /tmp/ci_budget.json --enforce-time
+    """
+    help = 'Benchmark chat REST endpoints against the checked-in query budget (time budget is informational).'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scale', type=int, action='append', choices=SCALES,
+                            help='측정할 scale (방 하나의 message 수). 기본값은 모든 scale')
+        parser.add_argument('--rooms', type=int, default=30, help='scale 별 buyer 의 방 수 (inbox 크기)')
+        parser.add_argument('--repeat', type=int, default=5, help='endpoint 별 측정 횟수')
+        parser.add_argument('--budget', default=BUDGET_PATH, help='budget 파일 경로')
+        parser.add_argument('--write-budget', action='store_true',
+                            help='측정값으로 budget 을 씁니다. (query 수는 그대로, time 은 --headroom 배와 '
+                                 'TIME_BUDGET_FLOORS 중 큰 값)')
+        parser.add_argument('--headroom', type=float, default=2.0, help='--write-budget 시 time 에 곱할 여유 배수')
+        parser.add_argument('--enforce-time', action='store_true',
+                            help='time budget 을 넘어도 실패합니다. (budget 을 같은 machine 에서 만든 경우에만 사용)')
+
+    def handle(self, *args, **options):
+        results = {}
+        for scale in options['scale'] or SCALES:
+            self.stdout.write('seeding scale {} ...'.format(scale))
+            buyer, room = seed_scale(scale, options['rooms'])
+            for endpoint, call in self._endpoints(buyer, room):
+                results.setdefault(endpoint, {})[str(scale)] = self._measure(call, options['repeat'])
+
+        if options['write_budget']:
+            self._write_budget(results, options)
+            return
+
+        with open(options['budget']) as budget_file:
+            budget = json.load(budget_file)
+
+        gated_keys = ('queries', 'wall_ms', 'db_ms') if options['enforce_time'] else ('queries',)
+        failures = []
+        for endpoint, by_scale in sorted(results.items()):
+            for scale, measured in sorted(by_scale.items(), key=lambda item: int(item[0])):
+                limit = budget.get(endpoint, {}).get(scale)
+                over = [key for key in ('queries', 'wall_ms', 'db_ms')
+                        if limit and measured[key] > get_limit(limit, key)]
+                failed = [key for key in over if key in gated_keys]
+                slow = [key for key in over if key not in gated_keys]
+                if not limit:
+                    state = 'NO BUDGET'
+                elif failed:
+                    state = 'OVER ' + ','.join(over)
+                elif slow:
+                    state = 'ok (SLOW ' + ','.join(slow) + ')'
+                else:
+                    state = 'ok'
+                self.stdout.write('{:<15} scale={:<7} queries={:<3} wall={:>8.2f}ms db={:>8.2f}ms {}'.format(
+                    endpoint, scale, measured['queries'], measured['wall_ms'], measured['db_ms'], state))
+                if failed:
+                    failures.append('{} scale={} {}'.format(endpoint, scale, ','.join(failed)))
+
+        if failures:
+            raise CommandError('budget exceeded : {}'.format('; '.join(failures)))
+        self.stdout.write(self.style.SUCCESS('all endpoints within budget'))
+
+    def _endpoints(self, buyer, room):
+        client = APIClient()
+        client.force_authenticate(buyer)
+
+        # 첫 page 는 history buffer 에서 나오므로, 중간 message 이전 page 로 DB keyset 경로도 측정합니다.
+        message_ids = room.messages.order_by('id').values_list('id', flat=True)
+        middle_id = message_ids[message_ids.count() // 2]
+
+        return (
+            ('list', lambda: client.get('/chatroom/')),
+            ('deliver', lambda: client.get('/chat/{}/deliver/'.format(room.pk))),
+            ('deliver_older', lambda: client.get('/chat/{}/deliver/'.format(room.pk), {'before': middle_id})),
+            ('message', lambda: client.post('/chat/{}/message/'.format(room.pk),
+                                            {'message_type': 1, 'text': 'bench'}, format='json')),
+            ('image_key_list', lambda: client.post('/s3/image_key_list/', {'count': 10}, format='json')),
+        )
+
+    def _measure(self, call, repeat):
+        response = call()
+        if response.status_code >= 400:
+            raise CommandError('request failed ({})'.format(response.status_code))
+
+        walls, db_times, queries = [], [], []
+        for _ in range(repeat):
+            with CaptureQueriesContext(connection) as context:
+                start = time.perf_counter()
+                call()
+                walls.append((time.perf_counter() - start) * 1000)
+            queries.append(len(context.captured_queries))
+            db_times.append(sum(float(query['time']) for query in context.captured_queries) * 1000)
+        return {'queries': max(queries), 'wall_ms': statistics.median(walls), 'db_ms': statistics.median(db_times)}
+
+    def _write_budget(self, results, options):
+        budget = {}
+        if os.path.exists(options['budget']):
+            with open(options['budget']) as budget_file:
+                budget = json.load(budget_file)
+        for endpoint, by_scale in results.items():
+            for scale, measured in by_scale.items():
+                budget.setdefault(endpoint, {})[scale] = {
+                    'queries': measured['queries'],
+                    'wall_ms': round(max(measured['wall_ms'] * options['headroom'], TIME_BUDGET_FLOORS['wall_ms']), 1),
+                    'db_ms': round(max(measured['db_ms'] * options['headroom'], TIME_BUDGET_FLOORS['db_ms']), 1),
+                }
+        with open(options['budget'], 'w') as budget_file:
+            json.dump(budget, budget_file, indent=2, sort_keys=True)
+            budget_file.write('\n')
+        self.stdout.write(self.style.SUCCESS('budget written to {}'.format(options['budget'])))
@@ -0,0 +1,39 @@
+from django.core.management.base import BaseCommand
+
+from chat.history import RoomHistoryBuffer
+from chat.models import ChatRoom
+from core.redis import get_redis
+
+
+class Command(BaseCommand):
+    """
+    Redis 의 방별 최근 message buffer (chat.history.RoomHistoryBuffer) 를 ChatMessage 와 비교합니다.
+    다른 buffer 는 지워지고, 다음 deliver 때 DB 에서 다시 채워집니다.
+    - ex : python manage.py check_history_buffers --room 1 2 3
+    """
+    help = 'Verify Redis chat history buffers against ChatMessage and drop inconsistent ones.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--room', type=int, nargs='*', help='특정 room id 만 확인합니다. (없으면 buffer 전체)')
+
+    def handle(self, *args, **options):
+        client = get_redis()
+        room_ids = options['room'] or self._scan_room_ids(client)
+
+        checked = 0
+        dropped = 0
+        for room in ChatRoom.objects.filter(pk__in=room_ids).iterator():
+            checked += 1
+            if not RoomHistoryBuffer(room, client=client).verify():
+                dropped += 1
+                self.stdout.write('room {} : inconsistent buffer dropped'.format(room.pk))
+
+        self.stdout.write(self.style.SUCCESS('{} buffers checked, {} dropped'.format(checked, dropped)))
+
+    def _scan_room_ids(self, client):
+        room_ids = []
+        for key in client.scan_iter(match=RoomHistoryBuffer.key_format.format('*'), count=1000):
+            room_id = key.decode().rsplit(':', 1)[-1]
+            if room_id.isdigit():
+                room_ids.append(int(room_id))
+        return room_ids
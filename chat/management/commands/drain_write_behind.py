@@ -0,0 +1,56 @@
+import json
+
+import redis
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from chat.write_behind import JOURNAL_KEY_FORMAT, HEARTBEAT_KEY_FORMAT, persist_entries
+from core.redis import get_redis
+
+
+class Command(BaseCommand):
+    """
+    heartbeat 가 만료된(죽은) worker 의 write-behind journal 을 ChatMessage 로 저장합니다.
+    worker 가 flush 하지 못하고 죽었을 때 journal 에 남은 message 가 유실되지 않도록 주기적으로(cron 등) 실행합니다.
+    - ex : python manage.py drain_write_behind
+    """
+    help = 'Persist write-behind journals left behind by dead websocket workers.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true',
+                            help='heartbeat 와 상관없이 모든 journal 을 저장합니다. (모든 worker 를 내린 후에만 사용)')
+
+    def handle(self, *args, **options):
+        client = get_redis()
+        drained = 0
+        for key in client.scan_iter(match=JOURNAL_KEY_FORMAT.format('*'), count=1000):
+            key = key.decode()
+            if key.endswith(':draining'):
+                worker_id = key[len(JOURNAL_KEY_FORMAT.format('')):-len(':draining')]
+                draining_key = key
+            else:
+                worker_id = key[len(JOURNAL_KEY_FORMAT.format('')):]
+                if not options['all'] and client.exists(HEARTBEAT_KEY_FORMAT.format(worker_id)):
+                    continue
+                # 다른 drain 과 겹치지 않도록 journal 을 옮긴 후 처리합니다.
+                draining_key = key + ':draining'
+                try:
+                    client.rename(key, draining_key)
+                except redis.ResponseError:
+                    continue
+            drained += self._drain(client, worker_id, draining_key)
+
+        self.stdout.write(self.style.SUCCESS('{} messages drained'.format(drained)))
+
+    def _drain(self, client, worker_id, draining_key):
+        chunk_size = settings.CHAT_WRITE_BEHIND_BATCH_SIZE
+        drained = 0
+        while True:
+            rows = client.lrange(draining_key, 0, chunk_size - 1)
+            if not rows:
+                break
+            persist_entries([json.loads(row) for row in rows])
+            client.ltrim(draining_key, len(rows), -1)
+            drained += len(rows)
+        self.stdout.write('worker {} : {} messages'.format(worker_id, drained))
+        return drained
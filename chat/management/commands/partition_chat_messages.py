@@ -0,0 +1,73 @@
+import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from chat.models import ChatMessage
+from chat.partitions import (MESSAGE_TABLE, MAXVALUE_PARTITION, iter_months, partition_name, partition_month,
+                             build_partition_table_sql, build_add_partitions_sql, build_delete_partition_images_sql,
+                             build_drop_partitions_sql, get_partitions, get_foreign_keys)
+from core.dates import month_start, add_months
+
+
+class Command(BaseCommand):
+    """
+    chat_chatmessage 를 created_at 기준 월별 RANGE COLUMNS partition 으로 만들고, 미래의 partition 을 미리 만들어 둡니다.
+    (MySQL 전용. cron 으로 매달 실행합니다.)
+    - 처음 실행 : foreign key constraint 를 지우고 primary key 를 (id, created_at) 으로 바꾼 후, 가장 오래된 message 의
+      달부터 --months-ahead 달 뒤까지 partition 합니다. table 전체를 다시 쓰므로 점검 시간에 실행하거나
+      --dry-run 으로 SQL 을 뽑아 pt-online-schema-change 등으로 적용합니다.
+    - 이후 실행 : pmax 를 나눠 --months-ahead 달 뒤까지의 partition 을 추가합니다. (pmax 가 비어 있어 바로 끝납니다.)
+    - --retain-months : 그보다 오래된 partition 을 DROP 합니다. message 가 지워지므로 archive_chat_history 로 옮긴 후에만
+      사용합니다. ChatMessageImages 는 foreign key constraint 가 없어 함께 지워지지 않으므로, DROP 전에 해당 partition 의
+      message 에 달린 image row 를 먼저 DELETE 합니다.
+    - ex : python manage.py partition_chat_messages --months-ahead 3 --dry-run
+    """
+    help = 'Create and rotate monthly partitions of the chat message table (MySQL).'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--months-ahead', type=int, default=3, help='미리 만들어 둘 미래의 partition 달 수')
+        parser.add_argument('--retain-months', type=int, help='이 달 수보다 오래된 partition 을 DROP 합니다.')
+        parser.add_argument('--dry-run', action='store_true', help='실행할 SQL 만 출력합니다.')
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'mysql':
+            raise CommandError('partitioning is only supported on MySQL (current: {})'.format(connection.vendor))
+
+        this_month = month_start(datetime.datetime.now())
+        last_month = add_months(this_month, options['months_ahead'])
+        statements = []
+        with connection.cursor() as cursor:
+            partitions = get_partitions(cursor)
+            if not partitions:
+                oldest = ChatMessage.objects.order_by('created_at').values_list('created_at', flat=True).first()
+                for table, constraint in get_foreign_keys(cursor):
+                    statements.append('ALTER TABLE `{}` DROP FOREIGN KEY `{}`'.format(table, constraint))
+                statements.append(build_partition_table_sql(list(iter_months(oldest or this_month, last_month))))
+            else:
+                if partitions[-1] != MAXVALUE_PARTITION:
+                    raise CommandError('{} is not partitioned by this command (no {})'.format(
+                        MESSAGE_TABLE, MAXVALUE_PARTITION))
+                existing = {partition_month(name) for name in partitions}
+                newest = max(month for month in existing if month is not None)
+                missing = list(iter_months(add_months(newest, 1), last_month))
+                if missing:
+                    statements.append(build_add_partitions_sql(missing))
+
+            if options['retain_months'] is not None:
+                cutoff = add_months(this_month, -options['retain_months'])
+                expired = [name for name in partitions
+                           if partition_month(name) is not None and partition_month(name) < cutoff]
+                if expired:
+                    statements.append(build_delete_partition_images_sql(expired))
+                    statements.append(build_drop_partitions_sql(expired))
+
+            for statement in statements:
+                self.stdout.write(statement + ';')
+                if not options['dry_run']:
+                    cursor.execute(statement)
+
+        if not statements:
+            self.stdout.write('partitions up to {} already exist'.format(partition_name(last_month)))
+        self.stdout.write(self.style.SUCCESS('{} statements {}'.format(
+            len(statements), 'to run' if options['dry_run'] else 'executed')))
@@ -0,0 +1,64 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, F, Q
+
+from chat.models import ChatRoom, ChatMessage
+
+
+class Command(BaseCommand):
+    """
+    ChatMessage 를 기준으로 ChatRoom 의 buyer_unread_count / seller_unread_count 를 다시 계산합니다.
+    watermark(buyer/seller_last_read_id) 이후에 상대방이 보낸 message 수를 unread 로 봅니다.
+    counter 가 실제 unread message 수와 어긋났을 때(drift) 사용합니다.
+    - ex : python manage.py rebuild_unread_counts --chunk-size 500
+    """
+    help = 'Rebuild ChatRoom unread counters from ChatMessage in chunks.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=500, help='한번에 다시 계산할 ChatRoom 수')
+        parser.add_argument('--room', type=int, nargs='*', help='특정 room id 만 다시 계산합니다.')
+
+    def handle(self, *args, **options):
+        chunk_size = options['chunk_size']
+        room_qs = ChatRoom.objects.order_by('pk')
+        if options['room']:
+            room_qs = room_qs.filter(pk__in=options['room'])
+
+        last_pk = 0
+        fixed = 0
+        total = 0
+        while True:
+            room_ids = list(room_qs.filter(pk__gt=last_pk).values_list('pk', flat=True)[:chunk_size])
+            if not room_ids:
+                break
+            last_pk = room_ids[-1]
+            total += len(room_ids)
+            fixed += self._rebuild_chunk(room_ids)
+            self.stdout.write('rebuilt rooms ~{} ({} fixed)'.format(last_pk, fixed))
+
+        self.stdout.write(self.style.SUCCESS('{} rooms checked, {} rooms fixed'.format(total, fixed)))
+
+    @transaction.atomic
+    def _rebuild_chunk(self, room_ids):
+        # 계산하는 동안 새 message 의 F() update 가 끼어들지 않도록 chunk 단위로 lock 을 잡습니다.
+        rooms = list(ChatRoom.objects.select_for_update().filter(pk__in=room_ids))
+
+        unread_qs = ChatMessage.objects.filter(room_id__in=room_ids).order_by().values('room_id').annotate(
+            buyer_unread_count=Count('id', filter=Q(id__gt=F('room__buyer_last_read_id')) &
+                                     ~Q(owner_id=F('room__buyer_id'))),
+            seller_unread_count=Count('id', filter=Q(id__gt=F('room__seller_last_read_id')) &
+                                      ~Q(owner_id=F('room__seller_id'))),
+        )
+        unread_by_room = {row['room_id']: row for row in unread_qs}
+
+        fixed = 0
+        for room in rooms:
+            counts = unread_by_room.get(room.pk, {})
+            buyer_unread_count = counts.get('buyer_unread_count', 0)
+            seller_unread_count = counts.get('seller_unread_count', 0)
+            if room.buyer_unread_count == buyer_unread_count and room.seller_unread_count == seller_unread_count:
+                continue
+            ChatRoom.objects.filter(pk=room.pk).update(buyer_unread_count=buyer_unread_count,
+                                                       seller_unread_count=seller_unread_count)
+            fixed += 1
+        return fixed
@@ -1,5 +1,8 @@
 from django.db import models
+from django.db.models import F, OuterRef, Subquery
+from django.db.models.functions import Coalesce
 from django.conf import settings
+from django.utils import timezone
 from core.fields import S3ImageKeyField
 
 from payment.models import Deal
@@ -10,6 +13,19 @@ def img_directory_path_message(instance, filename):
     return 'chatroom/{}/message/{}'.format(instance.room.id, filename)
 
 
+class ChatRoomQuerySet(models.QuerySet):
+    def inbox(self, user):
+        """
+        채팅방 목록(inbox) 을 그리는데 필요한 정보를 방 개수와 상관없이 한번의 query 로 가져옵니다.
+        - product 와 buyer / seller 는 serializer 가 product snapshot / user card cache 로 한번에 가져오므로
+          join 하지 않습니다. (products.snapshots, accounts.cards)
+        - last_message_text : 가장 최근 message 의 text (Subquery)
+        - unread count 는 ChatRoom 의 buyer/seller_unread_count 를 그대로 사용합니다.
+        """
+        last_message = ChatMessage.objects.filter(room=OuterRef('pk')).order_by('-created_at', '-id')
+        return self.annotate(last_message_text=Subquery(last_message.values('text')[:1]))
+
+
 class ChatRoom(models.Model):
     seller = models.ForeignKey(settings.AUTH_USER_MODEL, null=True, related_name='seller_chat_rooms',
                                on_delete=models.SET_NULL)
@@ -23,8 +39,104 @@ class ChatRoom(models.Model):
                                    related_name='chat_room', on_delete=models.SET_NULL)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now_add=True)
+    buyer_unread_count = models.PositiveIntegerField(default=0, help_text='구매자가 읽지 않은 message 수')
+    seller_unread_count = models.PositiveIntegerField(default=0, help_text='판매자가 읽지 않은 message 수')
+    buyer_last_read_id = models.PositiveIntegerField(default=0, help_text='구매자가 마지막으로 읽은 ChatMessage id')
+    seller_last_read_id = models.PositiveIntegerField(default=0, help_text='판매자가 마지막으로 읽은 ChatMessage id')
+    archived_until = models.DateTimeField(null=True, blank=True,
+                                          help_text='이 시각 이전의 message 는 ChatArchiveSegment 로 옮겨졌습니다.')
+
+    objects = ChatRoomQuerySet.as_manager()
     # is_active = models.BooleanField(default=True, null=True)
 
+    def get_participant_role(self, user):
+        """
+        user 가 이 방의 'buyer' 인지 'seller' 인지 return 합니다. 참여자가 아니면 None 입니다.
+        """
+        if user.id == self.buyer_id:
+            return 'buyer'
+        elif user.id == self.seller_id:
+            return 'seller'
+        return None
+
+    def get_unread_count(self, user):
+        role = self.get_participant_role(user)
+        if role is None:
+            return 0
+        return getattr(self, '%s_unread_count' % role)
+
+    def increase_unread_count(self, owner, updated_at, **fields):
+        """
+        owner 가 보낸 message 가 저장된 후 호출합니다.
+        updated_at 을 갱신하고 상대방 unread counter 를 F() 로 올리기 때문에 동시에 들어온 message 도 누락되지 않습니다.
+        :param fields: 같은 UPDATE 에서 함께 쓸 field (ex. {'buyer_active': True})
+        """
+        if owner.id == self.buyer_id:
+            field = 'seller_unread_count'
+        elif owner.id == self.seller_id:
+            field = 'buyer_unread_count'
+        else:
+            return
+        ChatRoom.objects.filter(pk=self.pk).update(updated_at=updated_at, **{field: F(field) + 1}, **fields)
+        for name, value in fields.items():
+            setattr(self, name, value)
+
+    def mark_as_read(self, user):
+        """
+        user 가 방의 message 를 모두 읽은 것으로 처리합니다.
+        message row 는 건드리지 않고, user 의 watermark(마지막으로 읽은 message id) 와 unread counter 를
+        UPDATE 한번으로 씁니다.
+        - watermark 는 counter 와 상관없이 항상 최신 message 까지 올립니다.
+          (counter 가 0 이어도 watermark 가 뒤처져 있을 수 있습니다. ex. backfill 전, rebuild_unread_counts 전)
+        - counter 는 0 이 아닐 때만 씁니다. counter 가 0 이면 watermark 뒤에 다른 사람이 보낸 message 가 있을 때만
+          UPDATE 합니다. (자기 message 만 뒤에 있으면 읽음 여부가 바뀌지 않으므로 row 를 쓰지 않습니다.)
+        """
+        role = self.get_participant_role(user)
+        if role is None:
+            return
+        watermark_field = '%s_last_read_id' % role
+        counter_field = '%s_unread_count' % role
+        messages = ChatMessage.objects.filter(room=OuterRef('pk')).order_by('-id').values('id')
+        fields = {watermark_field: Coalesce(Subquery(messages[:1]), F(watermark_field))}
+        rooms = ChatRoom.objects.filter(pk=self.pk)
+        if getattr(self, counter_field):
+            fields[counter_field] = 0
+        else:
+            latest_received = messages.exclude(owner_id=user.id)[:1]
+            rooms = rooms.filter(**{'%s__lt' % watermark_field: Subquery(latest_received)})
+        if rooms.update(**fields):
+            setattr(self, counter_field, 0)
+            self.refresh_from_db(fields=[watermark_field])
+
+    @property
+    def history_floor(self):
+        """
+        DB 에 남은 message 의 created_at 하한입니다. (방이 생긴 시각, archive 된 방은 archived_until)
+        """
+        if self.archived_until is not None and self.archived_until > self.created_at:
+            return self.archived_until
+        return self.created_at
+
+    def get_history(self):
+        """
+        방의 message queryset 입니다. created_at >= history_floor 조건을 붙여, 월별로 partition 된
+        chat_chatmessage 에서 방이 생기기 전 (또는 archive 된) 기간의 partition 은 읽지 않습니다.
+        """
+        return self.messages.filter(created_at__gte=self.history_floor)
+
+    def is_read_message(self, message_id, owner_id):
+        """
+        message 를 받는 쪽의 watermark 로 읽음 여부를 판단합니다.
+        (owner 가 참여자가 아닌 message 는 두 참여자 모두 읽었을 때 읽은 것으로 봅니다.)
+        """
+        if owner_id == self.buyer_id:
+            watermark = self.seller_last_read_id
+        elif owner_id == self.seller_id:
+            watermark = self.buyer_last_read_id
+        else:
+            watermark = min(self.buyer_last_read_id, self.seller_last_read_id)
+        return message_id <= watermark
+
 
 class ChatMessage(models.Model):
     MESSAGE_TYPES = (
@@ -33,24 +145,88 @@ class ChatMessage(models.Model):
         (2, 'image')
     )
     message_type = models.IntegerField(choices=MESSAGE_TYPES, db_index=True, default=1)
-    room = models.ForeignKey(ChatRoom, related_name='messages', on_delete=models.CASCADE)
+    # chat_chatmessage 는 월별로 partition 되므로 (chat.partitions) DB foreign key constraint 를 만들지 않습니다.
+    room = models.ForeignKey(ChatRoom, related_name='messages', on_delete=models.CASCADE, db_constraint=False)
     text = models.TextField()
     # message_image = models.ImageField(null=True, blank=True, upload_to=img_directory_path_message)
-    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
-    is_read = models.BooleanField(default=False, help_text='상대방 입장에서 web socket 접속할 때 바뀌는 field')
+    # write-behind (chat.write_behind) 가 broadcast 한 시각을 그대로 저장할 수 있도록 auto_now_add 대신 default 를 씁니다.
+    created_at = models.DateTimeField(default=timezone.now, editable=False, db_index=True)
+    # deprecated : 읽음 여부는 ChatRoom 의 buyer/seller_last_read_id 로 판단합니다. (backfill_read_watermarks 참고)
+    is_read = models.BooleanField(default=False, help_text='[deprecated] 더 이상 update 되지 않는 field')
     owner = models.ForeignKey(settings.AUTH_USER_MODEL, null=True, related_name='owner_message',
-                              on_delete=models.SET_NULL)
+                              on_delete=models.SET_NULL, db_constraint=False)
     seller_visible = models.BooleanField(default=True, help_text='셀러에게 보여지지 않는 경우 false')
     buyer_visible = models.BooleanField(default=True, help_text='바이어에게 보여지지 않는 경우 false')
+    write_behind_id = models.UUIDField(null=True, blank=True, editable=False,
+                                       help_text='write-behind journal entry id (같은 entry 가 두번 저장되지 않도록 확인)')
 
     class Meta:
         ordering = ['created_at']
+        indexes = [
+            # 방별 message history 를 (created_at, id) keyset 으로 조회할 때 사용합니다. (partition 마다 만들어집니다.)
+            models.Index(fields=['room', 'created_at', 'id'], name='chat_message_history_idx'),
+        ]
+
+    def set_images(self, images):
+        """
+        이미 가지고 있는 ChatMessageImages 를 넣어 둡니다. get_images 가 images 를 다시 조회하지 않습니다.
+        (방금 저장한 message, archive 에서 만든 저장되지 않은 message)
+        """
+        self._loaded_images = list(images)
+
+    def get_images(self):
+        """
+        set_images 로 넣은 images 가 있으면 그것을, 없으면 message.images.all() 을 return 합니다.
+        (여러 message 는 prefetch_related('images') 로 가져옵니다.)
+        """
+        loaded_images = getattr(self, '_loaded_images', None)
+        if loaded_images is not None:
+            return loaded_images
+        return self.images.all()
 
 
 class ChatMessageImages(models.Model):
-    message = models.ForeignKey(ChatMessage, related_name="images", on_delete=models.CASCADE)
+    message = models.ForeignKey(ChatMessage, related_name="images", on_delete=models.CASCADE, db_constraint=False)
     image_key = S3ImageKeyField()
 
     @property
     def image_url(self):
-        return self.image_key.url
\ No newline at end of file
+        return self.image_key.url
+
+
+class ChatArchiveSegment(models.Model):
+    """
+    archive storage 로 옮긴 방의 message 묶음(gzip NDJSON) 하나의 index 입니다. (chat.archive)
+    segment 는 만든 후 바뀌지 않고, 한 방의 segment 들은 (created_at, id) 범위가 겹치지 않습니다.
+    방이 지워져도 storage 의 object 는 남습니다.
+    """
+    room = models.ForeignKey(ChatRoom, related_name='archive_segments', on_delete=models.CASCADE)
+    storage_key = models.CharField(max_length=255, help_text='archive storage 의 object 이름')
+    first_message_id = models.PositiveIntegerField(help_text='segment 안의 가장 작은 message id')
+    last_message_id = models.PositiveIntegerField(help_text='segment 안의 가장 큰 message id')
+    first_created_at = models.DateTimeField()
+    last_created_at = models.DateTimeField()
+    message_count = models.PositiveIntegerField()
+    size = models.PositiveIntegerField(help_text='압축된 크기 (bytes)')
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['room', 'last_created_at'], name='chat_archive_room_idx'),
+        ]
+
+
+class UploadedImage(models.Model):
+    """
+    image_key_list 로 발급한 image key 와 발급받은 user (uploader) 입니다.
+    client 가 presigned POST 로 bucket 에 직접 올린 후 uploader 가 confirm (S3ImageUploadViewSet.confirm) 하면
+    object 를 확인하고 size / content_type / confirmed_at 을 채웁니다.
+    message 에는 보내는 user 가 confirm 한 key 만 쓸 수 있습니다. (chat.pipeline)
+    """
+    image_key = S3ImageKeyField(unique=True)
+    uploader = models.ForeignKey(settings.AUTH_USER_MODEL, null=True, related_name='uploaded_images',
+                                 on_delete=models.SET_NULL)
+    size = models.PositiveIntegerField(null=True, blank=True, help_text='bytes')
+    content_type = models.CharField(max_length=100, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    confirmed_at = models.DateTimeField(null=True, blank=True)
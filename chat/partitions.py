@@ -0,0 +1,97 @@
+import datetime
+
+from core.dates import month_start, add_months
+
+MESSAGE_TABLE = 'chat_chatmessage'
+IMAGES_TABLE = 'chat_chatmessageimages'
+PARTITION_COLUMN = 'created_at'
+MAXVALUE_PARTITION = 'pmax'
+
+
+def partition_name(month):
+    return 'p{:%Y%m}'.format(month)
+
+
+def iter_months(start, end):
+    """
+    start 가 속한 달부터 end 가 속한 달까지 각 달의 1일을 return 합니다.
+    """
+    month = month_start(start)
+    while month <= end:
+        yield month
+        month = add_months(month, 1)
+
+
+def partition_definition(month):
+    # month 달의 partition 은 다음 달 1일 미만의 row 를 담습니다.
+    return "PARTITION {} VALUES LESS THAN ('{:%Y-%m-%d %H:%M:%S}')".format(partition_name(month), add_months(month, 1))
+
+
+def build_partition_table_sql(months, table=MESSAGE_TABLE):
+    """
+    아직 partition 되지 않은 table 을 월별 RANGE COLUMNS partition 으로 바꾸는 SQL 입니다.
+    MySQL 은 partition column 이 모든 unique key 에 들어가야 하므로 primary key 를 (id, created_at) 으로 바꿉니다.
+    (id 는 여전히 AUTO_INCREMENT 라 하나뿐이고, Django 는 계속 id 를 pk 로 사용합니다.)
+    """
+    definitions = [partition_definition(month) for month in months]
+    definitions.append('PARTITION {} VALUES LESS THAN (MAXVALUE)'.format(MAXVALUE_PARTITION))
+    return ('ALTER TABLE `{table}` DROP PRIMARY KEY, ADD PRIMARY KEY (`id`, `{column}`) '
+            'PARTITION BY RANGE COLUMNS(`{column}`) ({definitions})').format(
+        table=table, column=PARTITION_COLUMN, definitions=', '.join(definitions))
+
+
+def build_add_partitions_sql(months, table=MESSAGE_TABLE):
+    """
+    pmax 를 나눠 months 의 partition 을 앞에 추가하는 SQL 입니다. 아직 row 가 없는 미래의 달에 사용하면
+    pmax 가 비어 있으므로 data 를 옮기지 않고 바로 끝납니다.
+    """
+    definitions = [partition_definition(month) for month in months]
+    definitions.append('PARTITION {} VALUES LESS THAN (MAXVALUE)'.format(MAXVALUE_PARTITION))
+    return 'ALTER TABLE `{}` REORGANIZE PARTITION {} INTO ({})'.format(
+        table, MAXVALUE_PARTITION, ', '.join(definitions))
+
+
+def build_delete_partition_images_sql(names, table=MESSAGE_TABLE, images_table=IMAGES_TABLE):
+    """
+    names partition 의 message 에 달린 ChatMessageImages row 를 지우는 SQL 입니다. partition 을 DROP 하기 전에 실행합니다.
+    (ChatMessageImages.message 는 db_constraint=False 라 partition 을 DROP 해도 함께 지워지지 않습니다.)
+    """
+    return ('DELETE `i` FROM `{images_table}` AS `i` JOIN `{table}` PARTITION ({names}) AS `m` '
+            'ON `m`.`id` = `i`.`message_id`').format(images_table=images_table, table=table, names=', '.join(names))
+
+
+def build_drop_partitions_sql(names, table=MESSAGE_TABLE):
+    return 'ALTER TABLE `{}` DROP PARTITION {}'.format(table, ', '.join(names))
+
+
+def get_partitions(cursor, table=MESSAGE_TABLE):
+    """
+    table 의 partition 이름 목록을 순서대로 return 합니다. partition 되지 않은 table 이면 빈 list 입니다.
+    """
+    cursor.execute(
+        'SELECT PARTITION_NAME FROM information_schema.PARTITIONS '
+        'WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND PARTITION_NAME IS NOT NULL '
+        'ORDER BY PARTITION_ORDINAL_POSITION', [table])
+    return [row[0] for row in cursor.fetchall()]
+
+
+def get_foreign_keys(cursor, table=MESSAGE_TABLE):
+    """
+    table 이 참조하거나 table 을 참조하는 foreign key constraint 목록입니다. partition 된 InnoDB table 에는 둘 다
+    있을 수 없으므로 partition 전에 지웁니다. (model 은 db_constraint=False 로 다시 만들지 않습니다.)
+    :return: [(constraint 가 있는 table, constraint 이름)]
+    """
+    cursor.execute(
+        'SELECT TABLE_NAME, CONSTRAINT_NAME FROM information_schema.REFERENTIAL_CONSTRAINTS '
+        'WHERE CONSTRAINT_SCHEMA = DATABASE() AND (TABLE_NAME = %s OR REFERENCED_TABLE_NAME = %s)', [table, table])
+    return list(cursor.fetchall())
+
+
+def partition_month(name):
+    """
+    'p202008' -> datetime(2020, 8, 1). 월별 partition 이 아니면 None 입니다.
+    """
+    try:
+        return datetime.datetime.strptime(name[1:], '%Y%m')
+    except ValueError:
+        return None
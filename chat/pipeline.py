@@ -0,0 +1,52 @@
+from django.db import transaction
+from rest_framework import serializers
+
+from chat.history import RoomHistoryBuffer
+from chat.models import ChatMessageImages, UploadedImage
+from chat.serializers import ChatMessageWriteSerializer
+from core.fields import URLResolvableUUID
+
+
+def create_message(chat_room, owner, data, image_keys=()):
+    """
+    REST(ChatMessageViewSet.message) 와 websocket(ChatConsumer.receive) 이 함께 사용하는 message 저장 경로입니다.
+    transaction 하나에서 message INSERT, image bulk_create, ChatRoom UPDATE(unread counter / updated_at /
+    buyer_active, seller_active) 를 한번씩만 한 후 history buffer 에 넣습니다.
+    방을 나간(exit) 참여자가 있으면 같은 ChatRoom UPDATE 에서 다시 active 로 바꾸므로, chat_room 은 요청마다 새로
+    조회한 object 여야 합니다.
+    (sync 함수이므로 async 에서는 database_sync_to_async 로 호출합니다.)
+    :param data: {'message_type': Int, 'text': String}
+    :param image_keys: image message 의 S3 image key list (owner 가 confirm 한 key 만 쓸 수 있습니다.)
+    :return: ChatMessage object (images 는 set_images 로 넣은 상태)
+    :raises: serializers.ValidationError
+    """
+    serializer = ChatMessageWriteSerializer(data=data)
+    serializer.is_valid(raise_exception=True)
+    image_keys = _parse_image_keys(owner, image_keys)
+    room_fields = {field: True for field in ('buyer_active', 'seller_active') if not getattr(chat_room, field)}
+    with transaction.atomic():
+        new_message = serializer.save(room=chat_room, owner=owner)
+        images = ChatMessageImages.objects.bulk_create(
+            [ChatMessageImages(message=new_message, image_key=key) for key in image_keys])
+        # 상대방 unread counter 는 F() 로 올립니다. (chat_room.save() 는 counter 를 덮어쓰므로 사용하지 않음)
+        chat_room.increase_unread_count(owner=owner, updated_at=new_message.created_at, **room_fields)
+    new_message.set_images(images)
+    RoomHistoryBuffer(chat_room).push(new_message)
+    return new_message
+
+
+def _parse_image_keys(owner, image_keys):
+    """
+    image key 는 owner 가 발급받아 confirm 한 key (UploadedImage) 여야 합니다.
+    """
+    try:
+        image_keys = [URLResolvableUUID(hex=str(key)) for key in image_keys]
+    except ValueError:
+        raise serializers.ValidationError({'image_key': 'Invalid image key.'})
+    if image_keys:
+        confirmed = set(UploadedImage.objects.filter(image_key__in=image_keys, uploader=owner,
+                                                     confirmed_at__isnull=False)
+                        .values_list('image_key', flat=True))
+        if not confirmed.issuperset(image_keys):
+            raise serializers.ValidationError({'image_key': 'Unconfirmed image key.'})
+    return image_keys
@@ -1,7 +1,9 @@
 from chat.models import ChatRoom
-from asgiref.sync import async_to_sync
+from django.conf import settings
 from django.core.serializers.json import DjangoJSONEncoder
-import json, datetime
+from django.utils.functional import cached_property
+from core.metrics import timed_serialize
+import asyncio, concurrent.futures, json, datetime, os, threading
 
 
 def default(o):
@@ -9,48 +11,144 @@ def default(o):
         return o.isoformat()
 
 
+@timed_serialize
+def encode_event(payload):
+    """
+    client 에게 보낼 payload 를 한번만 JSON 으로 encode 해서 group event 의 frame 에 넣습니다.
+    consumer 는 frame 을 그대로 보내므로 수신자마다 json.dumps 를 반복하지 않고,
+    channel layer 도 dict 대신 문자열 하나만 serialize 합니다.
+    """
+    return {
+        'type': payload['type'],
+        'frame': json.dumps(payload, cls=DjangoJSONEncoder),
+    }
+
+
+def new_message_event(message, owner, created_at):
+    """
+    text message 를 room group 에 보낼 때 사용하는 event 입니다. (REST / websocket 경로 공통)
+    """
+    return encode_event({
+        'type': 'chat_message',
+        'message_type': 1,
+        'message': message,
+        'owner': owner,
+        'created_at': str(created_at),
+        'message_image_url': ''
+    })
+
+
+def new_image_event(image_urls, owner, created_at):
+    """
+    image message 를 room group 에 보낼 때 사용하는 event 입니다. album 의 image url 을 event 하나에 모두 담습니다.
+    """
+    return encode_event({
+        'type': 'chat_message',
+        'message_type': 2,
+        'message': '(사진)',
+        'owner': owner,
+        'created_at': str(created_at),
+        'message_image_url': image_urls
+    })
+
+
+def get_room_group_name(room_id):
+    return 'chat_%s' % str(room_id)
+
+
+class SenderLoop(object):
+    """
+    sync 코드(uwsgi worker 의 view 등) 에서 channel layer 를 호출할 때 사용하는 process 당 하나의 event loop thread 입니다.
+    async_to_sync 는 호출마다 event loop 를 새로 만들어 channels_redis 의 connection 도 매번 새로 맺지만,
+    이 loop 는 process 가 살아있는 동안 유지되므로 connection pool 을 재사용합니다.
+    fork(uwsgi prefork) 이후 처음 호출될 때 새 process 의 loop thread 를 띄웁니다.
+    """
+
+    def __init__(self):
+        self._loop = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def get_loop(self):
+        with self._lock:
+            if self._loop is None or self._pid != os.getpid():
+                self._loop = asyncio.new_event_loop()
+                self._pid = os.getpid()
+                threading.Thread(target=self._loop.run_forever, name='chat-sender-loop', daemon=True).start()
+            return self._loop
+
+    def run(self, coroutine):
+        future = asyncio.run_coroutine_threadsafe(coroutine, self.get_loop())
+        try:
+            return future.result(settings.CHAT_SENDER_TIMEOUT)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            raise
+
+
+sender_loop = SenderLoop()
+
+
+async def send_events(channel_layer, room_group_name, events):
+    # 같은 방의 event 는 순서가 바뀌지 않도록 차례대로 보냅니다.
+    for event in events:
+        await channel_layer.group_send(room_group_name, event)
+
+
+async def send_many(channel_layer, items):
+    """
+    여러 방에 event 를 한번에 보냅니다. 방끼리는 동시에(connection pool 위에서 겹쳐서) 보내고, 방 안에서는 순서를 지킵니다.
+    :param items: [(room_id, event)]
+    """
+    events_by_group = {}
+    for room_id, event in items:
+        events_by_group.setdefault(get_room_group_name(room_id), []).append(event)
+    await asyncio.gather(*[send_events(channel_layer, room_group_name, events)
+                           for room_group_name, events in events_by_group.items()])
+
+
 def send_new_message(channel_layer, room_group_name, message, owner, created_at):
-    async_to_sync(channel_layer.group_send)(
-        room_group_name,
-        {
-            'type': 'chat_message',
-            'message_type': 1,
-            'message': message,
-            'owner': owner,
-            'created_at': str(created_at),
-            'message_image_url': ''
-        }
-    )
-
-
-def send_new_image(channel_layer, room_group_name, image):
-    async_to_sync(channel_layer.group_send)(
-        room_group_name,
-        {
-            'type': 'chat_image',
-            'image': image
-        }
-    )
+    sender_loop.run(send_events(channel_layer, room_group_name, [new_message_event(message, owner, created_at)]))
+
+
+def send_new_images(channel_layer, room_group_name, image_urls, owner, created_at):
+    sender_loop.run(send_events(channel_layer, room_group_name, [new_image_event(image_urls, owner, created_at)]))
 
 
 class MessageSender(object):
     """
     Client에 메세지를 보낼 때 사용하는 함수들을 모아놓은 class입니다.
+    async 코드(consumer 등) 에서는 a* method 를 await 하고, sync 코드(view) 에서는 같은 이름의 sync method 를 사용합니다.
+    sync method 는 SenderLoop 의 event loop 에서 실행되므로 worker 당 channel layer connection 을 재사용합니다.
     """
-    def __init__(self, channel_layer, room_id):
+    def __init__(self, channel_layer, room_id, room=None):
         self.channel_layer = channel_layer
         self.room_id = room_id
-        self.room_group_name = 'chat_%s' % str(self.room_id)
+        self.room_group_name = get_room_group_name(self.room_id)
+        if room is not None:
+            self.__dict__['room'] = room
 
-    @property
+    @cached_property
     def room(self):
         return ChatRoom.objects.get(id=self.room_id)
 
-    def deliver_message(self, chat_msg, owner, created_at):
-        send_new_message(self.channel_layer, self.room_group_name, chat_msg, owner, created_at)
+    async def adeliver_many(self, events):
+        await send_events(self.channel_layer, self.room_group_name, events)
 
-    def deliver_image(self, chat_img):
-        send_new_image(self.channel_layer, self.room_group_name, chat_img)
+    async def adeliver_message(self, chat_msg, owner, created_at):
+        await self.adeliver_many([new_message_event(chat_msg, owner, created_at)])
 
+    async def adeliver_images(self, image_urls, owner, created_at):
+        await self.adeliver_many([new_image_event(image_urls, owner, created_at)])
 
+    def deliver_many(self, events):
+        """
+        event list 를 loop 전환 한번으로 순서대로 보냅니다.
+        """
+        sender_loop.run(self.adeliver_many(events))
+
+    def deliver_message(self, chat_msg, owner, created_at):
+        sender_loop.run(self.adeliver_message(chat_msg, owner, created_at))
 
+    def deliver_images(self, image_urls, owner, created_at):
+        sender_loop.run(self.adeliver_images(image_urls, owner, created_at))
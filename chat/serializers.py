@@ -1,28 +1,71 @@
 # -*- encoding: utf-8 -*-
 
-from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import models
 from rest_framework import serializers
+
+from accounts.cards import get_user_card, get_user_cards
 from chat.models import ChatRoom, ChatMessage
+from core.resolvers import resolve_many
+from products.snapshots import get_product_snapshot, get_product_snapshots
+
+User = get_user_model()
+
+
+class PrefetchListSerializer(serializers.ListSerializer):
+    """
+    page 의 모든 item 에 필요한 cache 값을 child.prefetch(items) 로 한번에 가져와 context 에 넣은 후 serialize 합니다.
+    """
+
+    def to_representation(self, data):
+        iterable = data.all() if isinstance(data, models.Manager) else data
+        items = list(iterable)
+        self.context.update(self.child.prefetch(items))
+        return super().to_representation(items)
+
 
-User = settings.AUTH_USER_MODEL
+class UserCardMixin(object):
+    """
+    참여자 정보를 user card cache 에서 가져옵니다. (accounts.cards)
+    child serializer 는 get_card_user_ids(obj) 로 obj 에 필요한 user id 들을 알려줍니다.
+    """
+
+    def get_card_user_ids(self, obj):
+        raise NotImplementedError
+
+    def prefetch(self, items):
+        return {'user_cards': get_user_cards(user_id for item in items for user_id in self.get_card_user_ids(item))}
+
+    def get_card(self, user_id):
+        # many=True 면 PrefetchListSerializer 가 미리 가져온 card 를, 아니면 cache 에서 하나씩 가져옵니다.
+        cards = self.context.get('user_cards')
+        if cards is not None and user_id in cards:
+            return cards[user_id]
+        if user_id is None:
+            return None
+        return get_user_card(user_id)
 
 
-class ChatUserSerializer(serializers.ModelSerializer):
+class ChatUserSerializer(UserCardMixin, serializers.ModelSerializer):
     nickname = serializers.SerializerMethodField()
     profile_image_url = serializers.SerializerMethodField()
 
     class Meta:
         model = User
         fields = ['id', 'nickname', 'profile_image_url']
+        list_serializer_class = PrefetchListSerializer
+
+    def get_card_user_ids(self, obj):
+        return [obj.id]
 
     def get_nickname(self, obj):
-        return obj.nickname
+        return self.get_card(obj.id)['nickname']
 
     def get_profile_image_url(self, obj):
-        return obj.profile.profile_img.url
+        return self.get_card(obj.id)['profile_image_url']
 
 
-class ChatRoomSerializer(serializers.ModelSerializer):
+class ChatRoomSerializer(UserCardMixin, serializers.ModelSerializer):
     seller = serializers.SerializerMethodField()
     buyer = serializers.SerializerMethodField()
     product = serializers.SerializerMethodField()
@@ -34,45 +77,54 @@ class ChatRoomSerializer(serializers.ModelSerializer):
         model = ChatRoom
         fields = ('id', 'product', 'deal', 'updated_at', 'buyer', 'seller',
                   'unread_count', 'last_message')
+        list_serializer_class = PrefetchListSerializer
+
+    def get_card_user_ids(self, obj):
+        return [obj.buyer_id, obj.seller_id]
+
+    def prefetch(self, items):
+        context = super().prefetch(items)
+        context['product_snapshots'] = get_product_snapshots(item.product_id for item in items)
+        return context
 
     def get_product(self, obj):
-        result = {
-            'id': obj.product.id,
-            'name': obj.product.name,
-            'price': obj.product.price,
-            'image_url': obj.product.prodthumbnail.thumbnail.url
+        # product 는 main 서버의 DB 이므로 join 하지 않고 product snapshot cache 에서 가져옵니다. (products.snapshots)
+        snapshots = self.context.get('product_snapshots')
+        if snapshots is not None and obj.product_id in snapshots:
+            snapshot = snapshots[obj.product_id]
+        elif obj.product_id is None:
+            return None
+        else:
+            snapshot = get_product_snapshot(obj.product_id)
+        if snapshot is None:
+            return None
+        return {
+            'id': snapshot['id'],
+            'name': snapshot['name'],
+            'price': snapshot['price'],
+            'image_url': snapshot['image_url'],
+            'sold': snapshot['sold'],
+            'hiding': snapshot['hiding'],
         }
-        return result
 
     def get_buyer(self, obj):
-        result = {
-            'id': obj.buyer.id,
-            'nickname': obj.buyer.nickname,
-            'profile_image_url': obj.buyer.profile.profile_image_url
-        }
-        return result
+        # buyer / seller 는 join 하지 않고 user card cache 에서 가져옵니다. (accounts.cards)
+        return self.get_card(obj.buyer_id)
 
     def get_seller(self, obj):
-        result = {
-            'id': obj.seller.id,
-            'nickname': obj.seller.nickname,
-            'profile_image_url': obj.seller.profile.profile_image_url
-        }
-        return result
+        return self.get_card(obj.seller_id)
 
     def get_unread_count(self, obj):
         user = self.context['request'].user
-        count = 0
-        unread_qs = obj.messages.filter(is_read=False).exclude(owner=user)
-        for unread in unread_qs:
-            count = count + 1
-        return count
+        return obj.get_unread_count(user)
 
     def get_updated_at(self, obj):
         updated_at = obj.updated_at
         return '{}월{}일'.format(updated_at.strftime('%m'), updated_at.strftime('%d'))
 
     def get_last_message(self, obj):
+        if hasattr(obj, 'last_message_text'):
+            return obj.last_message_text
         return obj.messages.last().text
 
 
@@ -83,19 +135,27 @@ class ChatMessageReadSerializer(serializers.ModelSerializer):
     message_image_url = serializers.SerializerMethodField()
     owner = serializers.SerializerMethodField()
     created_at = serializers.SerializerMethodField()
+    is_read = serializers.SerializerMethodField()
 
     class Meta:
         model = ChatMessage
-        fields = ('message_type', 'text', 'created_at', 'message_image_url', 'owner')
+        fields = ('id', 'message_type', 'text', 'created_at', 'message_image_url', 'owner', 'is_read')
+        list_serializer_class = PrefetchListSerializer
+
+    def prefetch(self, items):
+        # page 의 모든 image url 을 resolve_many 로 한번에 만듭니다.
+        keys = [image.image_key for item in items if item.message_type != 1 for image in item.get_images()]
+        return {'image_urls': dict(zip(keys, resolve_many(keys)))}
 
     def get_message_image_url(self, obj):
-        try:
-            return obj.images.image_url
-        except:
+        # image message 의 image url list 입니다. (text message 는 None, images 는 ChatMessage.get_images)
+        if obj.message_type == 1:
             return None
+        image_urls = self.context.get('image_urls', {})
+        return [image_urls.get(image.image_key) or image.image_url for image in obj.get_images()]
 
     def get_owner(self, obj):
-        return obj.owner.id
+        return obj.owner_id
 
     def get_created_at(self, obj):
         created_at = obj.created_at
@@ -103,14 +163,43 @@ class ChatMessageReadSerializer(serializers.ModelSerializer):
         # return '{}.{}.{}.{}.{}'.format(created_at.strftime('20'+'%y'), created_at.strftime('%m'),
         #                          created_at.strftime('%d'), created_at.strftime('%H'), created_at.strftime('%M'))
 
+    def get_is_read(self, obj):
+        # context 에 room 을 넘기면 message 마다 ChatRoom 을 조회하지 않습니다.
+        room = self.context.get('room') or obj.room
+        return room.is_read_message(obj.id, obj.owner_id)
+
+
+class ChatMessageBufferSerializer(ChatMessageReadSerializer):
+    """
+    RoomHistoryBuffer 에 저장하는 형태입니다. (chat.history)
+    presigned url 은 만료되므로 image url 대신 image key 를, is_read 는 watermark 에 따라 바뀌므로 저장하지 않고
+    buffer 에서 꺼낼 때 만듭니다.
+    """
+    message_image_url = None
+    is_read = None
+    message_image_keys = serializers.SerializerMethodField()
+
+    class Meta(ChatMessageReadSerializer.Meta):
+        fields = ('id', 'message_type', 'text', 'created_at', 'message_image_keys', 'owner')
+
+    def prefetch(self, items):
+        return {}
+
+    def get_message_image_keys(self, obj):
+        if obj.message_type == 1:
+            return None
+        return [str(image.image_key) for image in obj.get_images()]
+
 
 class ChatMessageWriteSerializer(serializers.ModelSerializer):
     """
     ChatMessage 를 write 할 때 사용하는 serializer 입니다.
+    room, owner 는 이미 조회한 object 를 save(room=, owner=) 로 넘겨받습니다. (pk 로 다시 조회하지 않음)
     """
 
     class Meta:
         model = ChatMessage
         fields = ('room', 'message_type', 'text', 'created_at', 'owner')
+        read_only_fields = ('room', 'owner')
 
 
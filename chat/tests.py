@@ -1,3 +1,624 @@
-from django.test import TestCase
+import datetime
+import io
+import json
+import uuid
+from unittest import mock
 
-# Create your tests here.
+import redis
+from asgiref.sync import async_to_sync
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.db import OperationalError
+from django.test import TestCase, SimpleTestCase, override_settings
+from django.utils import timezone
+from rest_framework import serializers
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from chat.archive import ArchivedHistory, segment_cache
+from chat.history import RoomHistoryBuffer, serialize_message
+from chat.models import ChatRoom, ChatMessage, ChatArchiveSegment, UploadedImage
+from chat.pipeline import _parse_image_keys
+from chat.views import ChatMessageViewSet, S3ImageUploadViewSet
+from chat.write_behind import WriteBehindBuffer, DEAD_LETTER_KEY, persist_entries
+from core.pagination import SiiotKeysetPagination, MonthlyWindowKeysetPagination
+
+
+def request(**params):
+    return Request(APIRequestFactory().get('/', params))
+
+
+def create_users(*nicknames):
+    return [get_user_model().objects.create(nickname=nickname, phone='01000000000') for nickname in nicknames]
+
+
+def create_messages(room, created_ats):
+    return [ChatMessage.objects.create(room=room, text=str(index), created_at=created_at)
+            for index, created_at in enumerate(created_ats)]
+
+
+class KeysetPaginationTest(TestCase):
+
+    def setUp(self):
+        self.room = ChatRoom.objects.create()
+        # 같은 created_at 이 page 경계에 걸치도록 만듭니다.
+        created_at = datetime.datetime(2020, 3, 1, 10)
+        self.messages = create_messages(self.room, [created_at] * 5 + [created_at + datetime.timedelta(hours=1)] * 2)
+        self.pagination = SiiotKeysetPagination()
+        self.pagination.page_size = 3
+        self.pagination.ordering = ('-created_at', '-id')
+
+    def newest_first(self):
+        return sorted(self.messages, key=lambda message: (message.created_at, message.id), reverse=True)
+
+    def paginate(self, **params):
+        return self.pagination.paginate_queryset(ChatMessage.objects.filter(room=self.room), request(**params))
+
+    def test_pages_through_ties_without_gaps(self):
+        seen = []
+        page = self.paginate()
+        while True:
+            seen += page
+            if not self.pagination.has_next:
+                break
+            page = self.paginate(cursor=self.pagination.get_next_link())
+        self.assertEqual(seen, self.newest_first())
+
+    def test_previous_link_returns_previous_page(self):
+        first = self.paginate()
+        self.paginate(cursor=self.pagination.get_next_link())
+        self.assertEqual(self.paginate(cursor=self.pagination.get_previous_link()), first)
+        self.assertFalse(self.pagination.has_previous)
+
+    def test_before_and_after_anchor(self):
+        ordered = self.newest_first()
+        self.assertEqual(self.paginate(before=ordered[2].id), ordered[3:6])
+        self.assertEqual(self.paginate(after=ordered[5].id), ordered[2:5])
+
+
+class MonthlyWindowKeysetPaginationTest(TestCase):
+
+    def setUp(self):
+        self.room = ChatRoom.objects.create()
+        # 2020-01 ~ 2020-06, 3월 / 4월은 비어 있습니다.
+        self.messages = create_messages(self.room, [
+            datetime.datetime(2020, 1, 10), datetime.datetime(2020, 1, 20), datetime.datetime(2020, 2, 10),
+            datetime.datetime(2020, 5, 10), datetime.datetime(2020, 6, 1), datetime.datetime(2020, 6, 20),
+        ])
+        self.pagination = MonthlyWindowKeysetPagination()
+        self.pagination.page_size = 2
+        self.pagination.ordering = ('-created_at', '-id')
+        self.pagination.window_floor = datetime.datetime(2020, 1, 1)
+        self.pagination.window_ceiling = datetime.datetime(2020, 6, 20)
+
+    def paginate(self, **params):
+        return self.pagination.paginate_queryset(ChatMessage.objects.filter(room=self.room), request(**params))
+
+    def collect(self):
+        seen = []
+        page = self.paginate()
+        while True:
+            seen += page
+            if not self.pagination.has_next:
+                return seen
+            page = self.paginate(cursor=self.pagination.get_next_link())
+
+    def test_descending_pages_cross_empty_months(self):
+        self.assertEqual(self.collect(), list(reversed(self.messages)))
+
+    def test_ascending_pages(self):
+        self.pagination.ordering = ('created_at', 'id')
+        self.assertEqual(self.collect(), self.messages)
+
+    def test_windows_are_bounded_by_month(self):
+        # 최신 page 는 window_ceiling 의 달 (6월) 부터 읽고, 다음 page 확인용 row 가 모자라 5월을 한번 더 읽습니다.
+        with self.assertNumQueries(2) as context:
+            self.assertEqual(self.paginate(), [self.messages[5], self.messages[4]])
+        (june, may) = [query['sql'] for query in context.captured_queries]
+        self.assertIn(">= '2020-06-01 00:00:00'", june)
+        self.assertIn(">= '2020-05-01 00:00:00' AND", may)
+        self.assertIn("< '2020-06-01 00:00:00'", may)
+
+    def test_last_window_reaches_floor(self):
+        # 마지막 window 는 row 가 없는 달을 건너 floor 까지 한번에 읽습니다. (6월 -> 5월~floor)
+        self.pagination.max_windows = 2
+        self.paginate()
+        self.assertEqual(self.paginate(cursor=self.pagination.get_next_link()),
+                         [self.messages[3], self.messages[2]])
+
+    def test_window_floor_excludes_older_rows(self):
+        self.pagination.window_floor = datetime.datetime(2020, 5, 1)
+        self.assertEqual(self.collect(), list(reversed(self.messages[3:])))
+
+
+class ArchivedHistoryTest(TestCase):
+
+    def setUp(self):
+        self.room = ChatRoom.objects.create()
+        self.records = [{'id': index, 'message_type': 1, 'text': str(index),
+                         'created_at': datetime.datetime(2020, 1, index), 'owner': None,
+                         'seller_visible': True, 'buyer_visible': True, 'images': []} for index in range(1, 7)]
+        # segment 두개 (1 ~ 3, 4 ~ 6) 의 record 는 storage 대신 segment_cache 에 넣어 둡니다.
+        for records in (self.records[:3], self.records[3:]):
+            segment = ChatArchiveSegment.objects.create(
+                room=self.room, storage_key='test', first_message_id=records[0]['id'],
+                last_message_id=records[-1]['id'], first_created_at=records[0]['created_at'],
+                last_created_at=records[-1]['created_at'], message_count=len(records), size=0)
+            segment_cache.set(segment.pk, records)
+        self.history = ArchivedHistory(self.room)
+
+    def tearDown(self):
+        segment_cache.clear()
+
+    def ids(self, messages):
+        return [message.id for message in messages]
+
+    def test_fetch_newest_first_across_segments(self):
+        self.assertEqual(self.ids(self.history.fetch(('-created_at', '-id'), None, 4)), [6, 5, 4, 3])
+
+    def test_fetch_after_position(self):
+        position = (str(datetime.datetime(2020, 1, 4)), '4')
+        self.assertEqual(self.ids(self.history.fetch(('-created_at', '-id'), position, 10)), [3, 2, 1])
+        self.assertEqual(self.ids(self.history.fetch(('created_at', 'id'), position, 10)), [5, 6])
+
+    def test_fetch_builds_unsaved_messages(self):
+        message = self.history.fetch(('created_at', 'id'), None, 1)[0]
+        self.assertEqual((message.id, message.room, message.text), (1, self.room, '1'))
+        self.assertEqual(message.get_images(), [])
+
+    def test_get(self):
+        self.assertEqual(self.history.get(5).text, '5')
+        self.assertIsNone(self.history.get(7))
+
+
+def journal_entry(room, text, created_at=None, counter='seller_unread_count'):
+    return {'id': uuid.uuid4().hex, 'message_type': 1, 'text': text, 'room': room.pk, 'owner': None,
+            'counter': counter, 'created_at': str(created_at or datetime.datetime(2020, 3, 1, 10))}
+
+
+class PersistEntriesTest(TestCase):
+
+    def setUp(self):
+        self.room = ChatRoom.objects.create()
+
+    def test_keeps_broadcast_time_and_updates_room(self):
+        created_at = datetime.datetime(2020, 3, 1, 10, 0, 0, 123456)
+        persist_entries([journal_entry(self.room, 'a', created_at), journal_entry(self.room, 'b', created_at)])
+        self.assertEqual(list(ChatMessage.objects.values_list('created_at', flat=True)), [created_at] * 2)
+        self.room.refresh_from_db()
+        self.assertEqual((self.room.updated_at, self.room.seller_unread_count), (created_at, 2))
+
+    def test_reactivates_room(self):
+        ChatRoom.objects.filter(pk=self.room.pk).update(buyer_active=False)
+        persist_entries([journal_entry(self.room, 'a')])
+        self.room.refresh_from_db()
+        self.assertEqual((self.room.buyer_active, self.room.seller_active), (True, True))
+
+    def test_skips_entries_already_saved(self):
+        entries = [journal_entry(self.room, 'a'), journal_entry(self.room, 'b')]
+        persist_entries(entries[:1])
+        persist_entries(entries)
+        self.assertEqual(sorted(ChatMessage.objects.values_list('text', flat=True)), ['a', 'b'])
+        self.room.refresh_from_db()
+        self.assertEqual(self.room.seller_unread_count, 2)
+
+
+@override_settings(CHAT_WRITE_BEHIND_BATCH_SIZE=10, CHAT_WRITE_BEHIND_MAX_ATTEMPTS=2)
+@mock.patch('chat.write_behind.get_redis')
+class WriteBehindFlushTest(SimpleTestCase):
+
+    def setUp(self):
+        self.buffer = WriteBehindBuffer()
+        self.room = ChatRoom(pk=1)
+        for text in ('a', 'bad', 'c'):
+            entry = journal_entry(self.room, text)
+            self.buffer._pending.append((json.dumps(entry), entry))
+
+    def pending_texts(self):
+        return [entry['text'] for raw, entry in self.buffer._pending]
+
+    def journal_calls(self, get_redis):
+        pipe = get_redis.return_value.pipeline.return_value.__enter__.return_value
+        removed = [json.loads(call[0][2])['text'] for call in pipe.lrem.call_args_list]
+        dead = [json.loads(call[0][1])['text'] for call in pipe.rpush.call_args_list if call[0][0] == DEAD_LETTER_KEY]
+        return removed, dead
+
+    def test_flush_saves_batch_and_trims_journal(self, get_redis):
+        with mock.patch('chat.write_behind.persist_entries') as persist:
+            async_to_sync(self.buffer.flush)()
+        persist.assert_called_once()
+        self.assertEqual(self.pending_texts(), [])
+        self.assertEqual(self.journal_calls(get_redis), (['a', 'bad', 'c'], []))
+        get_redis.return_value.set.assert_called_with(self.buffer.heartbeat_key, 1, ex=self.buffer.heartbeat_ttl)
+
+    def test_bad_entry_does_not_block_others(self, get_redis):
+        def persist(entries):
+            if any(entry['text'] == 'bad' for entry in entries):
+                raise ValueError('bad entry')
+
+        with mock.patch('chat.write_behind.persist_entries', side_effect=persist), \
+                self.assertLogs('chat.write_behind', 'ERROR'):
+            async_to_sync(self.buffer.flush)()
+            self.assertEqual(self.pending_texts(), ['bad'])
+            self.assertEqual(self.journal_calls(get_redis), (['a', 'c'], []))
+
+            # CHAT_WRITE_BEHIND_MAX_ATTEMPTS 번 실패하면 dead letter 로 옮깁니다.
+            async_to_sync(self.buffer.flush)()
+        self.assertEqual(self.pending_texts(), [])
+        self.assertEqual(self.journal_calls(get_redis), (['a', 'c', 'bad'], ['bad']))
+        self.assertEqual(self.buffer._attempts, {})
+
+    def test_connection_error_is_not_counted(self, get_redis):
+        with mock.patch('chat.write_behind.persist_entries', side_effect=OperationalError), \
+                self.assertLogs('chat.write_behind', 'ERROR'):
+            for _ in range(3):
+                async_to_sync(self.buffer.flush)()
+        self.assertEqual(self.pending_texts(), ['a', 'bad', 'c'])
+        self.assertEqual(self.buffer._attempts, {})
+        self.assertEqual(self.journal_calls(get_redis), ([], []))
+
+
+class FakeJournalRedis(object):
+    """
+    drain_write_behind 가 쓰는 Redis command 만 dict 로 흉내 냅니다.
+    """
+
+    def __init__(self, lists, alive=()):
+        self.lists = {key: [json.dumps(entry).encode() for entry in entries] for key, entries in lists.items()}
+        self.alive = set(alive)
+
+    def scan_iter(self, match, count):
+        prefix = match.rstrip('*')
+        return [key.encode() for key in list(self.lists) if key.startswith(prefix)]
+
+    def exists(self, key):
+        return key in self.alive
+
+    def rename(self, key, new_key):
+        self.lists[new_key] = self.lists.pop(key)
+
+    def lrange(self, key, start, end):
+        return self.lists.get(key, [])[start:end + 1]
+
+    def ltrim(self, key, start, end):
+        self.lists[key] = self.lists[key][start:]
+
+
+class DrainWriteBehindTest(TestCase):
+
+    def setUp(self):
+        self.room = ChatRoom.objects.create()
+
+    def drain(self, client, **options):
+        with mock.patch('chat.management.commands.drain_write_behind.get_redis', return_value=client), \
+                mock.patch('sys.stdout'):
+            call_command('drain_write_behind', **options)
+
+    def test_drains_only_dead_workers(self):
+        client = FakeJournalRedis({
+            'chat:write_behind:journal:dead': [journal_entry(self.room, 'a'), journal_entry(self.room, 'b')],
+            'chat:write_behind:journal:alive': [journal_entry(self.room, 'c')],
+        }, alive=['chat:write_behind:heartbeat:alive'])
+        self.drain(client)
+        self.assertEqual(sorted(ChatMessage.objects.values_list('text', flat=True)), ['a', 'b'])
+        self.assertEqual(client.lists['chat:write_behind:journal:dead:draining'], [])
+        self.assertEqual(len(client.lists['chat:write_behind:journal:alive']), 1)
+
+    def test_drain_is_idempotent_with_flush(self):
+        entries = [journal_entry(self.room, 'a'), journal_entry(self.room, 'b')]
+        persist_entries(entries[:1])
+        self.drain(FakeJournalRedis({'chat:write_behind:journal:w': entries}), all=True)
+        self.assertEqual(sorted(ChatMessage.objects.values_list('text', flat=True)), ['a', 'b'])
+
+
+class ReadWatermarkTest(TestCase):
+
+    def setUp(self):
+        self.buyer, self.seller, self.stranger = create_users('buyer', 'seller', 'stranger')
+        self.room = ChatRoom.objects.create(buyer=self.buyer, seller=self.seller)
+
+    def send(self, owner, text='hi'):
+        message = ChatMessage.objects.create(room=self.room, owner=owner, text=text)
+        self.room.increase_unread_count(owner, updated_at=message.created_at)
+        return message
+
+    def assertRoom(self, **expected):
+        room = ChatRoom.objects.get(pk=self.room.pk)
+        self.assertEqual({name: getattr(room, name) for name in expected}, expected)
+
+    def test_increase_unread_count_counts_other_side(self):
+        self.send(self.seller)
+        self.send(self.seller)
+        self.send(self.buyer)
+        self.assertRoom(buyer_unread_count=2, seller_unread_count=1)
+
+    def test_increase_unread_count_writes_extra_fields(self):
+        ChatRoom.objects.filter(pk=self.room.pk).update(buyer_active=False)
+        self.room.increase_unread_count(self.seller, updated_at=self.room.created_at, buyer_active=True)
+        self.assertTrue(self.room.buyer_active)
+        self.assertRoom(buyer_active=True, buyer_unread_count=1)
+
+    def test_increase_unread_count_ignores_non_participant(self):
+        with self.assertNumQueries(0):
+            self.room.increase_unread_count(self.stranger, updated_at=self.room.created_at)
+
+    def test_mark_as_read_resets_counter(self):
+        self.send(self.seller)
+        last = self.send(self.seller)
+        self.room.refresh_from_db()
+        with self.assertNumQueries(2):
+            self.room.mark_as_read(self.buyer)
+        self.assertEqual((self.room.buyer_unread_count, self.room.buyer_last_read_id), (0, last.id))
+        self.assertRoom(buyer_unread_count=0, buyer_last_read_id=last.id, seller_last_read_id=0)
+
+    def test_mark_as_read_advances_lagging_watermark_with_zero_counter(self):
+        # backfill / rebuild_unread_counts 전처럼 counter 는 0 인데 watermark 가 뒤처진 경우입니다.
+        last = ChatMessage.objects.create(room=self.room, owner=self.seller, text='hi')
+        self.room.mark_as_read(self.buyer)
+        self.assertEqual(self.room.buyer_last_read_id, last.id)
+        self.assertRoom(buyer_unread_count=0, buyer_last_read_id=last.id)
+
+    def test_mark_as_read_skips_write_when_only_own_messages_are_new(self):
+        received = self.send(self.seller)
+        self.room.refresh_from_db()
+        self.room.mark_as_read(self.buyer)
+        self.send(self.buyer)
+        # 조건부 UPDATE 한번만 실행되고, 바뀐 row 가 없으므로 refresh 하지 않습니다.
+        with self.assertNumQueries(1):
+            self.room.mark_as_read(self.buyer)
+        self.assertEqual(self.room.buyer_last_read_id, received.id)
+        self.assertRoom(buyer_unread_count=0, buyer_last_read_id=received.id)
+
+    def test_mark_as_read_ignores_non_participant(self):
+        self.send(self.seller)
+        with self.assertNumQueries(0):
+            self.room.mark_as_read(self.stranger)
+
+    def test_is_read_message_uses_receiver_watermark(self):
+        message = self.send(self.seller)
+        self.assertFalse(self.room.is_read_message(message.id, self.seller.id))
+        self.room.refresh_from_db()
+        self.room.mark_as_read(self.buyer)
+        self.assertTrue(self.room.is_read_message(message.id, self.seller.id))
+        self.assertFalse(self.room.is_read_message(message.id, self.stranger.id))
+
+
+class UnreadCountCommandTest(TestCase):
+
+    def setUp(self):
+        self.buyer, self.seller = create_users('buyer', 'seller')
+        self.room = ChatRoom.objects.create(buyer=self.buyer, seller=self.seller)
+        self.messages = [ChatMessage.objects.create(room=self.room, owner=owner, text=str(index), is_read=is_read)
+                         for index, (owner, is_read) in enumerate([(self.seller, True), (self.buyer, True),
+                                                                   (self.seller, False), (self.seller, False),
+                                                                   (self.buyer, False)])]
+        self.other_room = ChatRoom.objects.create(buyer=self.buyer, seller=self.seller)
+
+    def call(self, name, **options):
+        stdout = io.StringIO()
+        call_command(name, stdout=stdout, **options)
+        return stdout.getvalue()
+
+    def assertRoom(self, room, **expected):
+        room = ChatRoom.objects.get(pk=room.pk)
+        self.assertEqual({name: getattr(room, name) for name in expected}, expected)
+
+    def test_backfill_read_watermarks(self):
+        output = self.call('backfill_read_watermarks', chunk_size=1)
+        self.assertIn('1 rooms backfilled', output)
+        self.assertRoom(self.room, buyer_last_read_id=self.messages[0].id, seller_last_read_id=self.messages[1].id)
+        self.assertRoom(self.other_room, buyer_last_read_id=0, seller_last_read_id=0)
+
+    def test_backfill_never_moves_watermark_back(self):
+        ChatRoom.objects.filter(pk=self.room.pk).update(buyer_last_read_id=self.messages[3].id)
+        self.call('backfill_read_watermarks')
+        self.assertRoom(self.room, buyer_last_read_id=self.messages[3].id, seller_last_read_id=self.messages[1].id)
+
+    def test_rebuild_unread_counts(self):
+        ChatRoom.objects.filter(pk=self.room.pk).update(buyer_last_read_id=self.messages[0].id,
+                                                        seller_last_read_id=self.messages[1].id,
+                                                        buyer_unread_count=7)
+        ChatRoom.objects.filter(pk=self.other_room.pk).update(seller_unread_count=3)
+        output = self.call('rebuild_unread_counts', chunk_size=1)
+        self.assertIn('2 rooms checked, 2 rooms fixed', output)
+        # watermark 이후 상대방이 보낸 message 만 셉니다.
+        self.assertRoom(self.room, buyer_unread_count=2, seller_unread_count=1)
+        self.assertRoom(self.other_room, buyer_unread_count=0, seller_unread_count=0)
+
+    def test_rebuild_unread_counts_only_given_rooms(self):
+        ChatRoom.objects.filter(pk=self.other_room.pk).update(seller_unread_count=3)
+        output = self.call('rebuild_unread_counts', room=[self.room.pk])
+        self.assertIn('1 rooms checked, 1 rooms fixed', output)
+        self.assertRoom(self.other_room, seller_unread_count=3)
+
+
+class RoomHistoryBufferTest(TestCase):
+
+    def setUp(self):
+        self.room = ChatRoom.objects.create()
+        self.messages = create_messages(self.room, [self.room.created_at + datetime.timedelta(minutes=minute)
+                                                    for minute in range(4)])
+        self.client = mock.MagicMock()
+        self.pipe = self.client.pipeline.return_value.__enter__.return_value
+        self.buffer = RoomHistoryBuffer(self.room, client=self.client)
+
+    def buffered(self, rows, version=None):
+        self.pipe.execute.return_value = [[json.dumps(row).encode() for row in rows],
+                                          (version or self.buffer.version).encode()]
+
+    def rows(self, messages):
+        return [json.loads(json.dumps(serialize_message(message, self.room))) for message in messages]
+
+    def test_push_runs_script(self):
+        self.buffer.push(self.messages[0])
+        self.client.register_script.return_value.assert_called_once_with(
+            keys=['chat:history:%s' % self.room.pk, 'chat:history:%s:version' % self.room.pk],
+            args=[json.dumps(serialize_message(self.messages[0], self.room)), str(self.messages[0].created_at),
+                  self.buffer.size, self.buffer.ttl])
+
+    def test_push_error_invalidates(self):
+        self.client.register_script.return_value.side_effect = redis.ConnectionError
+        with self.assertLogs('chat.history', 'ERROR'):
+            self.buffer.push(self.messages[0])
+        self.client.delete.assert_called_once_with(self.buffer.key, self.buffer.version_key)
+
+    def test_get_returns_buffered_rows(self):
+        rows = self.rows(self.messages[::-1])
+        self.buffered(rows)
+        self.assertEqual(self.buffer.get(), rows)
+
+    def test_get_version_mismatch_is_miss(self):
+        self.buffered(self.rows(self.messages), version='2000-01-01 00:00:00')
+        self.assertIsNone(self.buffer.get())
+
+    def test_get_old_url_rows_is_miss(self):
+        rows = self.rows(self.messages)
+        for row in rows:
+            row['message_image_url'] = row.pop('message_image_keys')
+        self.buffered(rows)
+        self.assertIsNone(self.buffer.get())
+
+    def test_get_redis_error_is_miss(self):
+        self.pipe.execute.side_effect = redis.ConnectionError
+        with self.assertLogs('chat.history', 'ERROR'):
+            self.assertIsNone(self.buffer.get())
+
+    def test_get_latest_reads_buffer(self):
+        self.buffered(self.rows(self.messages[::-1]))
+        with self.assertNumQueries(0):
+            rows = self.buffer.get_latest(2)
+        self.assertEqual([row['id'] for row in rows], [message.id for message in self.messages[:0:-1]])
+        self.assertEqual((rows[0]['message_image_url'], rows[0]['is_read']), (None, False))
+
+    def test_get_latest_fills_from_db_on_miss(self):
+        self.pipe.execute.return_value = [[], None]
+        rows = self.buffer.get_latest(2)
+        self.assertEqual([row['id'] for row in rows], [message.id for message in self.messages[:0:-1]])
+        self.pipe.rpush.assert_called_once_with(
+            self.buffer.key, *[json.dumps(row) for row in self.rows(self.messages[::-1])])
+        self.pipe.set.assert_called_once_with(self.buffer.version_key, self.buffer.version, ex=self.buffer.ttl)
+
+    def test_verify(self):
+        self.client.lrange.return_value = [json.dumps(row) for row in self.rows(self.messages[:1:-1])]
+        self.assertTrue(self.buffer.verify())
+        self.client.delete.assert_not_called()
+
+        self.client.lrange.return_value = [json.dumps(row) for row in self.rows(self.messages[:2])]
+        self.assertFalse(self.buffer.verify())
+        self.client.delete.assert_called_once_with(self.buffer.key, self.buffer.version_key)
+
+
+class DeliverFirstPageTest(TestCase):
+
+    def setUp(self):
+        (self.buyer,) = create_users('buyer')
+        self.room = ChatRoom.objects.create(buyer=self.buyer)
+        created_at = self.room.created_at
+        self.messages = create_messages(self.room, [created_at + datetime.timedelta(minutes=minute)
+                                                    for minute in range(1, 4)])
+        ChatRoom.objects.filter(pk=self.room.pk).update(updated_at=self.messages[-1].created_at)
+
+    def deliver(self, rows):
+        request = APIRequestFactory().get('/')
+        force_authenticate(request, self.buyer)
+        with mock.patch('chat.views.RoomHistoryBuffer') as history_buffer:
+            history_buffer.return_value.size = 50
+            history_buffer.return_value.get_latest.return_value = rows
+            return ChatMessageViewSet.as_view({'get': 'deliver'})(request, pk=self.room.pk)
+
+    def ids(self, response):
+        return [row['id'] for row in response.data]
+
+    def test_short_buffer_is_whole_history(self):
+        rows = [{'id': message.id, 'created_at': str(message.created_at)} for message in self.messages[::-1]]
+        self.assertEqual(self.ids(self.deliver(rows)), [message.id for message in self.messages[::-1]])
+
+    def test_short_buffer_of_archived_room_falls_back_to_db(self):
+        ChatRoom.objects.filter(pk=self.room.pk).update(archived_until=self.room.created_at)
+        rows = [{'id': self.messages[-1].id, 'created_at': str(self.messages[-1].created_at)}]
+        self.assertEqual(self.ids(self.deliver(rows)), [message.id for message in self.messages[::-1]])
+
+
+@mock.patch('chat.views.head_image')
+class ImageConfirmTest(TestCase):
+
+    def setUp(self):
+        self.user, self.other = create_users('uploader', 'other')
+        self.keys = {name: uuid.uuid4() for name in ('issued', 'other', 'confirmed', 'not_image')}
+        UploadedImage.objects.bulk_create([
+            UploadedImage(image_key=self.keys['issued'], uploader=self.user),
+            UploadedImage(image_key=self.keys['other'], uploader=self.other),
+            UploadedImage(image_key=self.keys['confirmed'], uploader=self.user, size=10, content_type='image/png',
+                          confirmed_at=timezone.now()),
+            UploadedImage(image_key=self.keys['not_image'], uploader=self.user),
+        ])
+
+    def confirm(self, keys, user=None):
+        request = APIRequestFactory().post('/', {'image_key': [key.hex for key in keys]}, format='json')
+        force_authenticate(request, user or self.user)
+        return S3ImageUploadViewSet.as_view({'post': 'confirm'})(request)
+
+    def test_confirms_issued_image(self, head_image):
+        head_image.return_value = (100, 'image/jpeg')
+        response = self.confirm([self.keys['issued']])
+        self.assertEqual(response.data, {'confirmed': [self.keys['issued'].hex], 'missing': []})
+        upload = UploadedImage.objects.get(image_key=self.keys['issued'])
+        self.assertEqual((upload.size, upload.content_type), (100, 'image/jpeg'))
+        self.assertIsNotNone(upload.confirmed_at)
+
+    def test_key_issued_to_another_user_is_missing(self, head_image):
+        response = self.confirm([self.keys['other']])
+        self.assertEqual(response.data, {'confirmed': [], 'missing': [self.keys['other'].hex]})
+        head_image.assert_not_called()
+        self.assertIsNone(UploadedImage.objects.get(image_key=self.keys['other']).confirmed_at)
+
+    def test_key_never_issued_is_missing(self, head_image):
+        key = uuid.uuid4()
+        self.assertEqual(self.confirm([key]).data, {'confirmed': [], 'missing': [key.hex]})
+        head_image.assert_not_called()
+        self.assertFalse(UploadedImage.objects.filter(image_key=key).exists())
+
+    def test_already_confirmed_key_is_not_checked_again(self, head_image):
+        response = self.confirm([self.keys['confirmed']])
+        self.assertEqual(response.data, {'confirmed': [self.keys['confirmed'].hex], 'missing': []})
+        head_image.assert_not_called()
+
+    def test_non_image_content_type_is_missing(self, head_image):
+        head_image.return_value = (100, 'text/html')
+        response = self.confirm([self.keys['not_image']])
+        self.assertEqual(response.data, {'confirmed': [], 'missing': [self.keys['not_image'].hex]})
+        self.assertIsNone(UploadedImage.objects.get(image_key=self.keys['not_image']).confirmed_at)
+
+    def test_image_key_list_requires_login(self, head_image):
+        request = APIRequestFactory().post('/', {'count': 1}, format='json')
+        response = S3ImageUploadViewSet.as_view({'post': 'image_key_list'})(request)
+        self.assertEqual(response.status_code, 401)
+        self.assertFalse(UploadedImage.objects.filter(uploader__isnull=True).exists())
+
+
+class ParseImageKeysTest(TestCase):
+
+    def setUp(self):
+        self.user, self.other = create_users('uploader', 'other')
+        self.confirmed = uuid.uuid4()
+        self.unconfirmed = uuid.uuid4()
+        self.others = uuid.uuid4()
+        UploadedImage.objects.bulk_create([
+            UploadedImage(image_key=self.confirmed, uploader=self.user, confirmed_at=timezone.now()),
+            UploadedImage(image_key=self.unconfirmed, uploader=self.user),
+            UploadedImage(image_key=self.others, uploader=self.other, confirmed_at=timezone.now()),
+        ])
+
+    def test_confirmed_keys(self):
+        self.assertEqual(_parse_image_keys(self.user, [self.confirmed.hex]), [self.confirmed])
+        self.assertEqual(_parse_image_keys(self.user, []), [])
+
+    def test_rejects_unconfirmed_keys(self):
+        for key in (self.unconfirmed, self.others, uuid.uuid4()):
+            with self.subTest(key=key), self.assertRaises(serializers.ValidationError) as context:
+                _parse_image_keys(self.user, [self.confirmed.hex, key.hex])
+            self.assertEqual(context.exception.detail['image_key'], 'Unconfirmed image key.')
+
+    def test_rejects_invalid_keys(self):
+        with self.assertRaises(serializers.ValidationError):
+            _parse_image_keys(self.user, ['not-a-key'])
@@ -5,10 +5,12 @@ from rest_framework.routers import SimpleRouter
 from chat import views
 from chat.views import ChatRoomViewSet
 from chat.views import ChatMessageViewSet
+from chat.views import S3ImageUploadViewSet
 
 router = SimpleRouter()
 router.register('chatroom', ChatRoomViewSet)
 router.register('chat', ChatMessageViewSet)
+router.register('s3', S3ImageUploadViewSet, basename='s3')
 
 
 urlpatterns = [
@@ -1,5 +1,7 @@
+from django.conf import settings
 from django.utils.safestring import mark_safe
-import json, uuid
+from django.utils import timezone
+import concurrent.futures, json, logging, uuid
 
 from rest_framework import viewsets, mixins
 from rest_framework.response import Response
@@ -7,20 +9,25 @@ from rest_framework.decorators import action
 from rest_framework import status
 from accounts.models import User
 from products.models import Product
-from chat.models import ChatRoom, ChatMessage, ChatMessageImages
+from chat.models import ChatRoom, ChatMessage, UploadedImage
+from chat.archive import ArchivedHistory
+from chat.history import RoomHistoryBuffer
+from chat.pipeline import create_message
 from chat.send_utils import MessageSender
 from django.shortcuts import render, get_object_or_404
-from rest_framework.permissions import IsAuthenticated, AllowAny
-from core.pagination import SiiotPagination
+from rest_framework.permissions import IsAuthenticated
+from core.fields import URLResolvableUUID
+from core.resolvers import resolve_many
+from core.s3 import create_image_upload, head_image, image_key_name
+from core.pagination import SiiotKeysetPagination, MonthlyWindowKeysetPagination, paginate
 from django.db.models import Q, F
-from datetime import datetime
 
 from .serializers import ChatMessageReadSerializer, ChatMessageWriteSerializer, ChatRoomSerializer
-from realtime.websocket.utils import _set_user_websocket_activity, add_user_as_active_websocket,\
-    add_user_as_inactive_websocket, check_if_websocket_is_active
 
 from channels import layers
 
+logger = logging.getLogger(__name__)
+
 
 def index(request):
     return render(request, 'chat/index.html', {})
@@ -32,12 +39,13 @@ def room(request, room_name):
     })
 
 
-def _get_sender(room_id):
+def _get_sender(chat_room):
     channel_layer = layers.get_channel_layer()
     return MessageSender(channel_layer=channel_layer,
-                         room_id=room_id)
+                         room_id=chat_room.id, room=chat_room)
 
 
+@paginate(page_size=20, ordering=('-updated_at', '-id'), pagination_class=SiiotKeysetPagination)
 class ChatRoomViewSet(viewsets.ReadOnlyModelViewSet, mixins.CreateModelMixin):
     queryset = ChatRoom.objects.filter(Q(buyer_active=True) | Q(seller_active=True))
     permission_classes = [IsAuthenticated, ]
@@ -62,17 +70,19 @@ class ChatRoomViewSet(viewsets.ReadOnlyModelViewSet, mixins.CreateModelMixin):
 
     def list(self, request, *args, **kwargs):
         """
-        해당 user가 속해있는 chatroom list info를 모두 뿌려줍니다.
+        해당 user가 속해있는 chatroom list info를 (updated_at, id) keyset 으로 page 단위로 뿌려줍니다.
+        다음 page 는 response header 의 cursor-next 값을 ?cursor= 로 넘겨 받습니다.
         api : GET api/v1/chatroom/
         """
         # 해당 유저가 속해있는 방 최신 message created_at 순서로 만든 후에 serializer 형태로 제공
         qs = self.get_queryset()
         user = request.user
         chatroom_qs = qs.filter(Q(buyer=user) | Q(seller=user)).exclude(created_at=F("updated_at"))\
-            .order_by('-updated_at')
-        serializer = self.get_serializer(chatroom_qs, many=True)
+            .inbox(user)
+        page = self.paginate_queryset(chatroom_qs)
+        serializer = self.get_serializer(page, many=True)
 
-        return Response(serializer.data, status=status.HTTP_200_OK)
+        return self.get_paginated_response(serializer.data)
 
     @action(methods=['put'], detail=True)
     def exit(self, request, pk):
@@ -88,17 +98,18 @@ class ChatRoomViewSet(viewsets.ReadOnlyModelViewSet, mixins.CreateModelMixin):
         else:
             if chat_room.buyer == user:
                 chat_room.buyer_active = False
-                chat_room.save()
+                chat_room.save(update_fields=['buyer_active'])
             elif chat_room.seller == user:
                 chat_room.seller_active = False
-                chat_room.save()
+                chat_room.save(update_fields=['seller_active'])
             qs = self.get_queryset()
-            chatroom_qs = qs.filter(Q(buyer=user) | Q(seller=user)).order_by('updated_at')
+            chatroom_qs = qs.filter(Q(buyer=user) | Q(seller=user)).inbox(user).order_by('updated_at')
             serializer = self.get_serializer(chatroom_qs, many=True)
 
             return Response(serializer.data, status=status.HTTP_206_PARTIAL_CONTENT)
 
 
+@paginate(page_size=20, ordering=('-created_at', '-id'), pagination_class=MonthlyWindowKeysetPagination)
 class ChatMessageViewSet(viewsets.GenericViewSet):
     queryset = ChatRoom.objects.filter(Q(buyer_active=True) | Q(seller_active=True))
     permission_classes = [IsAuthenticated, ]
@@ -115,25 +126,43 @@ class ChatMessageViewSet(viewsets.GenericViewSet):
     def deliver(self, request, pk):
         """
         message를 room 및 user 등에게 deliver합니다.
+        최신 message 부터 (created_at, id) keyset 으로 page 단위로 return 하며, 전체 count 는 계산하지 않습니다.
         api: GET chat/{room_id}/deliver
+        query : ?before={message_id} (이전 message) / ?after={message_id} (이후 message) / ?cursor=
+                (header 의 cursor-next, cursor-prev 값)
         """
         user = request.user
         chat_room = get_object_or_404(ChatRoom, pk=pk)
-        if chat_room.buyer != user and chat_room.seller != user:
+        if chat_room.get_participant_role(user) is None:
             return Response(status=status.HTTP_403_FORBIDDEN)
         else:
-            message_qs = chat_room.messages.all().order_by('-created_at')
-            unread_qs = message_qs.exclude(owner=user)
-            for unread_msg in unread_qs:
-                unread_msg.is_read = True
-                unread_msg.save()
-            # sender = _get_sender(room_id=chat_room.id)
+            message_qs = chat_room.get_history().prefetch_related('images')
+            chat_room.mark_as_read(user)
+            # sender = _get_sender(chat_room)
             # for message in message_qs:
             #     sender.deliver_message(chat_msg=message.text)
-            paginator = SiiotPagination()
-            page = paginator.paginate_queryset(message_qs, request)
-            serializer = self.get_serializer(page, many=True)
-            return paginator.get_paginated_response(data=serializer.data)
+            paginator = self.paginator
+            if paginator.is_first_page_request(request):
+                # 첫 page 는 Redis 의 최근 message buffer 에서 바로 return 합니다.
+                # buffer 가 page_size 보다 짧으면 DB history 전체가 buffer 에 있고 archive 가 없을 때만 씁니다.
+                # (buffer 가 size 만큼 차 있거나 archive 가 있으면 더 오래된 message 가 있을 수 있습니다.)
+                history_buffer = RoomHistoryBuffer(chat_room)
+                rows = history_buffer.get_latest(paginator.page_size)
+                if len(rows) > paginator.page_size or \
+                        (len(rows) < history_buffer.size and chat_room.archived_until is None):
+                    return self.get_paginated_response(paginator.paginate_rows(rows, request))
+
+            # message 는 방이 생긴 후에만 쓰이므로 방의 created_at(archive 된 방은 archived_until) ~ updated_at 으로
+            # 월별 partition 을 골라 읽고, 그보다 오래된 message 는 archive 에서 읽습니다.
+            paginator.window_floor = chat_room.history_floor
+            paginator.window_ceiling = chat_room.updated_at
+            if chat_room.archived_until is not None:
+                paginator.cold_source = ArchivedHistory(chat_room)
+            page = self.paginate_queryset(message_qs)
+            context = self.get_serializer_context()
+            context['room'] = chat_room
+            serializer = self.get_serializer_class()(page, many=True, context=context)
+            return self.get_paginated_response(serializer.data)
 
     @action(methods=['post'], detail=True)
     def message(self, request, pk):
@@ -143,81 +172,113 @@ class ChatMessageViewSet(viewsets.GenericViewSet):
         data: {'message_type' : Int, 'text' : String, 'image_key' : [String]}
         """
         user = request.user
-        data = request.data
         message_type = request.data.get('message_type')
         if message_type == 1:
             image_key_list = []
             text = request.data.get('text', None)
             if text is None:
-                Response(status=status.HTTP_404_NOT_FOUND)
+                return Response(status=status.HTTP_400_BAD_REQUEST)
         else:
-            text = None
+            text = '(사진)'  # ImageMessageMixin.to_text 와 같은 값
             image_key_list = request.data.get('image_key', None)
             if not image_key_list or not isinstance(image_key_list, list):
-                Response(status=status.HTTP_400_BAD_REQUEST)
+                return Response(status=status.HTTP_400_BAD_REQUEST)
         chat_room = get_object_or_404(ChatRoom, pk=pk)
-        if not chat_room.buyer:
-            chat_room.buyer_active = True
-            chat_room.save()
-        if not chat_room.seller:
-            chat_room.seller_active = True
-            chat_room.save()
-        if chat_room.buyer != user and chat_room.seller != user:
+        if chat_room.get_participant_role(user) is None:
             return Response(status=status.HTTP_403_FORBIDDEN)
-        else:
-            data.update(owner=user.id)
-            data.update(room=chat_room.id)
-            serializer = self.get_serializer(data=data)
-            serializer.is_valid(raise_exception=True)
-            new_message = serializer.save()
-            chat_room.updated_at = datetime.now()
-            chat_room.save()
-            # new_message = ChatMessage(room=chat_room, text=text, owner=user)
-            # new_message.save()
-            # image save
-            # if not image_key_list or not isinstance(image_key_list, list):
-            #     return Response(status=status.HTTP_400_BAD_REQUEST)
-
-            image_url_list = []
-            # image object create
-            for key in image_key_list:
-                ChatMessageImages.objects.create(message=new_message, image_key=key)
-                image_url_list.append(ChatMessageImages.objects.get(message=new_message, image_key=key))
-
-            sender = _get_sender(room_id=chat_room.id)
+
+        new_message = create_message(chat_room, user, {'message_type': message_type, 'text': text},
+                                     image_keys=image_key_list)
+
+        # message 는 이미 저장되었으므로 broadcast 가 늦어도 201 을 return 합니다.
+        # (error 를 return 하면 client 가 다시 보내 같은 message 가 두번 저장됩니다. 상대방은 deliver 로 받습니다.)
+        sender = _get_sender(chat_room)
+        try:
             if message_type == 1:
-                sender.deliver_message(chat_msg=new_message.text, owner=user.id, created_at=datetime.now())
+                sender.deliver_message(chat_msg=new_message.text, owner=user.id, created_at=new_message.created_at)
             else:
-                for i in range(len(image_url_list)):
-                    sender.deliver_image(image_url=image_url_list[i])
-            return Response(status=status.HTTP_201_CREATED)
+                sender.deliver_images(image_urls=resolve_many(image.image_key for image in new_message.get_images()),
+                                      owner=user.id, created_at=new_message.created_at)
+        except concurrent.futures.TimeoutError:
+            logger.warning('chat message broadcast timed out (room %s, message %s)', chat_room.pk, new_message.pk)
+        return Response(status=status.HTTP_201_CREATED)
 
 
 class S3ImageUploadViewSet(viewsets.GenericViewSet):
-    permission_classes = [AllowAny, ]
+    """
+    image 는 client 가 presigned POST 로 S3 에 직접 올립니다. (app 서버는 image bytes 를 받지 않습니다.)
+    image_key_list 로 key 와 upload form 을 받아 올린 후, confirm 으로 올라간 key 를 등록하고 message 에 사용합니다.
+    발급한 key 를 user 에게 묶어야 하므로 image_key_list 도 로그인이 필요합니다. (이전에는 AllowAny 였으므로,
+    token 없이 호출하던 client 는 이제 401 을 받습니다.)
+    """
+    permission_classes = [IsAuthenticated, ]
 
     @action(methods=['post'], detail=False)
     def image_key_list(self, request):
         """
-        이미지 첨부시 uuid list를 발급받는 api 입니다. (TODO : presigned url)
+        이미지 첨부시 image key 와 presigned POST 를 발급받는 api 입니다.
         api: POST api/v1/s3/image_key_list/
         data : {'count' : int}
-
+        response : [{'key', 'image_key', 'url', 'fields', 'content_type', 'expires_in'}]
+                   (url 에 fields 와 마지막 'file' field 를 multipart/form-data 로 POST 합니다.)
         """
-        data = request.data
-        count = int(data['count'])
+        try:
+            count = int(request.data.get('count', 1))
+        except (TypeError, ValueError):
+            return Response(status=status.HTTP_400_BAD_REQUEST)
+        if not 0 < count <= settings.IMAGE_UPLOAD_MAX_COUNT:
+            return Response(status=status.HTTP_400_BAD_REQUEST)
         temp_key_list = []
         for i in range(count):
             temp_key = self.fun_temp_key()
             temp_key_list.append(temp_key)
+        # 누구에게 발급한 key 인지 기록합니다. (발급받은 user 만 confirm 할 수 있습니다.)
+        UploadedImage.objects.bulk_create(
+            [UploadedImage(image_key=item['key'], uploader=request.user) for item in temp_key_list])
         return Response(temp_key_list)
 
+    @action(methods=['post'], detail=False)
+    def confirm(self, request):
+        """
+        presigned POST 로 올린 image key 를 확인하고 등록하는 api 입니다.
+        요청한 user 가 발급받은 key 중 bucket 에 object 가 있고 image content type / 크기 제한에 맞는 key 만 등록합니다.
+        (다른 user 가 발급받았거나 발급되지 않은 key 는 missing 입니다. 이미 등록된 key 는 다시 확인하지 않습니다.)
+        api: POST api/v1/s3/confirm/
+        data : {'image_key' : [String]}
+        response : {'confirmed': [String], 'missing': [String]}
+        """
+        image_keys = request.data.get('image_key', None)
+        if not image_keys or not isinstance(image_keys, list) or len(image_keys) > settings.IMAGE_UPLOAD_MAX_COUNT:
+            return Response(status=status.HTTP_400_BAD_REQUEST)
+        try:
+            image_keys = [URLResolvableUUID(hex=str(key)) for key in image_keys]
+        except ValueError:
+            return Response(status=status.HTTP_400_BAD_REQUEST)
+
+        issued = {upload.image_key: upload
+                  for upload in UploadedImage.objects.filter(image_key__in=image_keys, uploader=request.user)}
+        confirmed, missing, uploads = [], [], []
+        now = timezone.now()
+        for key in image_keys:
+            upload = issued.get(key)
+            if upload is None:
+                missing.append(key.hex)
+                continue
+            if upload.confirmed_at is None:
+                head = head_image(key)
+                if head is None or not head[1].startswith('image/') or head[0] > settings.IMAGE_UPLOAD_MAX_SIZE:
+                    missing.append(key.hex)
+                    continue
+                (upload.size, upload.content_type, upload.confirmed_at) = (head[0], head[1], now)
+                uploads.append(upload)
+            confirmed.append(key.hex)
+        UploadedImage.objects.bulk_update(uploads, ['size', 'content_type', 'confirmed_at'])
+        return Response({'confirmed': confirmed, 'missing': missing})
+
     def fun_temp_key(self):
-        ext = 'jpg'
         key = uuid.uuid4()
-        image_key = "%s.%s" % (key, ext)
-        url = "https://{}.s3.amazonaws.com/".format('siiot-media-storage') # TODO: production s3
-        content_type = "image/jpeg"
-        data = {"url": url, "image_key": image_key, "content_type": content_type, "key": key}
+        upload = create_image_upload(key)
+        data = {"url": upload['url'], "fields": upload['fields'], "image_key": image_key_name(key),
+                "content_type": upload['fields']['Content-Type'], "key": key,
+                "expires_in": settings.IMAGE_UPLOAD_EXPIRE}
         return data
-
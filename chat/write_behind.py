@@ -0,0 +1,233 @@
+import asyncio
+import json
+import logging
+import os
+import socket
+import uuid
+from collections import defaultdict, Counter
+from datetime import datetime
+
+import redis
+from asgiref.sync import sync_to_async
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.db import transaction, OperationalError, InterfaceError
+from django.db.models import F
+from django.utils.dateparse import parse_datetime
+
+from chat.models import ChatRoom, ChatMessage
+from core.redis import get_redis
+
+logger = logging.getLogger(__name__)
+
+JOURNAL_KEY_FORMAT = 'chat:write_behind:journal:{}'
+HEARTBEAT_KEY_FORMAT = 'chat:write_behind:heartbeat:{}'
+DEAD_LETTER_KEY = 'chat:write_behind:dead'
+
+
+def persist_entries(entries):
+    """
+    journal entry 들을 bulk_create 로 한번에 저장하고, 방마다 updated_at 과 unread counter 를 UPDATE 한번으로 갱신합니다.
+    - created_at 은 broadcast 한 시각(entry['created_at']) 을 그대로 저장합니다.
+    - journal 은 at-least-once 이므로 (flush 와 drain 이 겹치거나, 저장 후 journal 을 지우기 전에 죽은 경우)
+      이미 저장된 entry id(ChatMessage.write_behind_id) 는 건너뜁니다. 방 row 를 먼저 lock 해서, 같은 방을 동시에
+      저장하는 worker / drain 이 서로의 INSERT 를 보고 확인하도록 합니다.
+    """
+    entries = [dict(entry, created_at=parse_datetime(entry['created_at'])) for entry in entries]
+    room_ids = sorted({entry['room'] for entry in entries})
+    with transaction.atomic():
+        list(ChatRoom.objects.select_for_update().filter(pk__in=room_ids).order_by('pk').values_list('pk', flat=True))
+        entry_ids = [entry['id'] for entry in entries if entry.get('id')]
+        saved_ids = set()
+        if entry_ids:
+            saved_ids = {value.hex for value in ChatMessage.objects.filter(
+                room_id__in=room_ids, created_at__gte=min(entry['created_at'] for entry in entries),
+                write_behind_id__in=entry_ids).values_list('write_behind_id', flat=True)}
+        entries = [entry for entry in entries if entry.get('id') not in saved_ids]
+
+        messages = [ChatMessage(room_id=entry['room'], owner_id=entry['owner'], message_type=entry['message_type'],
+                                text=entry['text'], created_at=entry['created_at'], write_behind_id=entry.get('id'))
+                    for entry in entries]
+        ChatMessage.objects.bulk_create(messages, batch_size=settings.CHAT_WRITE_BEHIND_BATCH_SIZE)
+
+        unread_counts = defaultdict(Counter)
+        latest_created_at = {}
+        for entry in entries:
+            if entry.get('counter'):
+                unread_counts[entry['room']][entry['counter']] += 1
+            latest_created_at[entry['room']] = max(entry['created_at'],
+                                                   latest_created_at.get(entry['room'], entry['created_at']))
+
+        for room_id, updated_at in latest_created_at.items():
+            fields = {field: F(field) + count for field, count in unread_counts[room_id].items()}
+            if fields:
+                # 참여자가 보낸 message 가 있으면 create_message 와 같이 방을 나간 참여자를 다시 active 로 바꿉니다.
+                fields.update(buyer_active=True, seller_active=True)
+            ChatRoom.objects.filter(pk=room_id).update(updated_at=updated_at, **fields)
+
+
+class WriteBehindBuffer(object):
+    """
+    websocket 으로 들어온 message 를 worker(process) 별로 모아서 저장하는 write-behind buffer 입니다.
+    settings.CHAT_WRITE_BEHIND 가 True 일 때만 ChatConsumer 가 사용합니다.
+    1. accept : entry 를 Redis 의 worker 별 journal 에 RPUSH 한 후 memory buffer 에 넣고, 바로 broadcast 할 event 를
+       return 합니다. (journal 에 쓰지 못하면 None 을 return 하고, consumer 는 바로 저장하는 경로를 사용합니다.)
+    2. flush : CHAT_WRITE_BEHIND_BATCH_SIZE 개가 모이거나 CHAT_WRITE_BEHIND_FLUSH_INTERVAL 초가 지나면 persist_entries
+       로 저장한 후, 저장한 entry 를 journal 에서 LREM 으로 지웁니다.
+       - batch 저장이 실패하면 entry 를 하나씩 저장합니다. 저장되지 않는 entry 는 flush 마다 다시 시도하고,
+         CHAT_WRITE_BEHIND_MAX_ATTEMPTS 번 실패하면 DEAD_LETTER_KEY list 로 옮겨 뒤의 message 를 막지 않습니다.
+       - DB 연결 error 는 entry 의 문제가 아니므로 시도 횟수에 넣지 않고 다음 flush 에서 다시 시도합니다.
+       - heartbeat 는 flush 가 실패해도 갱신합니다.
+    3. worker 가 죽으면 journal 이 Redis 에 남고 heartbeat 가 만료됩니다. 이런 journal 은 drain_write_behind 가 저장합니다.
+       drain 이 살아 있는 worker 의 journal 을 가져간 경우에도 journal 은 entry 값으로 지우므로 저장하지 않은 entry 를
+       지우지 않고, 두번 저장된 entry 는 persist_entries 가 건너뜁니다.
+    """
+
+    def __init__(self):
+        self.worker_id = '{}:{}:{}'.format(socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+        self.journal_key = JOURNAL_KEY_FORMAT.format(self.worker_id)
+        self.heartbeat_key = HEARTBEAT_KEY_FORMAT.format(self.worker_id)
+        self.batch_size = settings.CHAT_WRITE_BEHIND_BATCH_SIZE
+        self.flush_interval = settings.CHAT_WRITE_BEHIND_FLUSH_INTERVAL
+        self.heartbeat_ttl = settings.CHAT_WRITE_BEHIND_HEARTBEAT_TTL
+        self.max_attempts = settings.CHAT_WRITE_BEHIND_MAX_ATTEMPTS
+        # [(journal 에 쓴 raw entry, entry)]
+        self._pending = []
+        # entry id : 실패한 횟수
+        self._attempts = {}
+        self._loop = None
+        self._lock = None
+        self._full = None
+        self._flusher = None
+
+    def _start(self):
+        # flush task 는 process 의 event loop 에 하나만 띄웁니다.
+        loop = asyncio.get_event_loop()
+        if self._flusher is None or self._flusher.done() or self._loop is not loop:
+            self._loop = loop
+            self._lock = asyncio.Lock()
+            self._full = asyncio.Event()
+            self._flusher = asyncio.ensure_future(self._run())
+
+    async def accept(self, chat_room, owner, data):
+        """
+        :param data: 검증된 {'message_type': Int, 'text': String}
+        :return: room group 에 보낼 new_message_event 인자 (text, owner_id, created_at) or None
+        """
+        self._start()
+        if owner.id == chat_room.buyer_id:
+            counter = 'seller_unread_count'
+        elif owner.id == chat_room.seller_id:
+            counter = 'buyer_unread_count'
+        else:
+            counter = None
+        created_at = datetime.now()
+        entry = dict(data, id=uuid.uuid4().hex, room=chat_room.pk, owner=owner.id, counter=counter,
+                     created_at=str(created_at))
+        raw_entry = json.dumps(entry)
+
+        async with self._lock:
+            try:
+                await sync_to_async(self._journal)(raw_entry)
+            except redis.RedisError:
+                logger.exception('chat write-behind journal failed (room %s)', chat_room.pk)
+                return None
+            self._pending.append((raw_entry, entry))
+
+        if len(self._pending) >= self.batch_size:
+            self._full.set()
+        return (entry['text'], owner.id, created_at)
+
+    def _journal(self, raw_entry):
+        with get_redis().pipeline() as pipe:
+            pipe.rpush(self.journal_key, raw_entry)
+            pipe.set(self.heartbeat_key, 1, ex=self.heartbeat_ttl)
+            pipe.execute()
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._full.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._full.clear()
+            await self.flush()
+
+    async def flush(self):
+        """
+        지금 buffer 에 있는 entry 를 batch_size 개씩 저장합니다. 저장하지 못한 entry 는 buffer 와 journal 에 남습니다.
+        """
+        try:
+            items = list(self._pending)
+            for start in range(0, len(items), self.batch_size):
+                batch = items[start:start + self.batch_size]
+                saved, failed, interrupted = await database_sync_to_async(self._persist_batch)(batch)
+                dead = []
+                for item in failed:
+                    entry_id = item[1]['id']
+                    self._attempts[entry_id] = self._attempts.get(entry_id, 0) + 1
+                    if self._attempts[entry_id] >= self.max_attempts:
+                        logger.error('chat write-behind entry moved to %s after %s attempts (room %s)',
+                                     DEAD_LETTER_KEY, self._attempts[entry_id], item[1]['room'])
+                        dead.append(item)
+                done = saved + dead
+                if done:
+                    done_ids = {item[1]['id'] for item in done}
+                    self._pending = [item for item in self._pending if item[1]['id'] not in done_ids]
+                    for entry_id in done_ids:
+                        self._attempts.pop(entry_id, None)
+                    try:
+                        await sync_to_async(self._remove_from_journal)([raw for raw, entry in saved],
+                                                                       [raw for raw, entry in dead])
+                    except redis.RedisError:
+                        logger.exception('chat write-behind journal trim failed')
+                if interrupted:
+                    break
+        finally:
+            try:
+                await sync_to_async(get_redis().set)(self.heartbeat_key, 1, ex=self.heartbeat_ttl)
+            except redis.RedisError:
+                logger.exception('chat write-behind heartbeat failed')
+
+    def _persist_batch(self, batch):
+        """
+        :return: (저장된 item list, 저장하지 못한 item list, DB 연결 error 로 중단했는지)
+        """
+        try:
+            persist_entries([entry for raw, entry in batch])
+            return batch, [], False
+        except (OperationalError, InterfaceError):
+            logger.exception('chat write-behind flush failed (%s messages)', len(batch))
+            return [], [], True
+        except Exception:
+            logger.exception('chat write-behind flush failed (%s messages), retrying one by one', len(batch))
+
+        saved, failed = [], []
+        for item in batch:
+            try:
+                persist_entries([item[1]])
+            except (OperationalError, InterfaceError):
+                logger.exception('chat write-behind flush failed (room %s)', item[1]['room'])
+                return saved, failed, True
+            except Exception:
+                logger.exception('chat write-behind entry failed (room %s)', item[1]['room'])
+                failed.append(item)
+            else:
+                saved.append(item)
+        return saved, failed, False
+
+    def _remove_from_journal(self, saved, dead):
+        """
+        journal 에서 저장한 entry 를 값으로 지우고, dead entry 는 DEAD_LETTER_KEY 로 옮깁니다.
+        entry 는 id 가 있어 값이 겹치지 않으므로, drain_write_behind 가 journal 을 가져간 후 새로 생긴 journal 에서도
+        다른 entry 를 지우지 않습니다. (지울 entry 는 journal 앞쪽에 있으므로 LREM 은 앞부분만 읽습니다.)
+        """
+        with get_redis().pipeline() as pipe:
+            for raw_entry in saved + dead:
+                pipe.lrem(self.journal_key, 1, raw_entry)
+            for raw_entry in dead:
+                pipe.rpush(DEAD_LETTER_KEY, raw_entry)
+            pipe.execute()
+
+
+write_behind = WriteBehindBuffer()
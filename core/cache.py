@@ -0,0 +1,187 @@
+import logging
+import pickle
+import threading
+import time
+from collections import OrderedDict
+
+import redis
+
+from core.redis import get_redis
+
+logger = logging.getLogger(__name__)
+
+
+class LRUCache(object):
+    """
+    process 안에서만 쓰는 크기 제한 + TTL LRU cache 입니다. (thread-safe)
+    maxsize 를 넘으면 가장 오래 사용하지 않은 key 부터 버립니다.
+    """
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+            (expires_at, value) = item
+            if expires_at < time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class TieredCache(object):
+    """
+    L1 (process 안의 LRUCache) + L2 (Redis) 2단계 cache 입니다. L2 에는 value 를 pickle 로 저장합니다.
+    - get / get_many : L1 -> L2 순서로 찾고, L2 에서 찾은 값은 L1 에 채웁니다. (get_many 는 MGET 한번)
+    - delete : L1 과 L2 에서 지웁니다. 다른 process 의 L1 은 l1_ttl 이 지나야 사라지므로 l1_ttl 은 짧게 둡니다.
+    Redis 에 문제가 있으면 L2 는 없는 것으로 보고 동작합니다.
+    """
+
+    def __init__(self, namespace, l1_maxsize, l1_ttl, l2_ttl):
+        self.namespace = namespace
+        self.l1 = LRUCache(l1_maxsize, l1_ttl)
+        self.l2_ttl = l2_ttl
+
+    def make_key(self, key):
+        return '{}:{}'.format(self.namespace, key)
+
+    def get_local(self, key):
+        return self.l1.get(key)
+
+    def get(self, key):
+        return self.get_many([key]).get(key)
+
+    def get_many(self, keys):
+        """
+        :return: {key: value} (찾지 못한 key 는 포함되지 않습니다.)
+        """
+        result = {}
+        missing = []
+        for key in keys:
+            value = self.l1.get(key)
+            if value is None:
+                missing.append(key)
+            else:
+                result[key] = value
+        if not missing:
+            return result
+
+        try:
+            rows = get_redis().mget([self.make_key(key) for key in missing])
+        except redis.RedisError:
+            logger.exception('%s cache get failed', self.namespace)
+            return result
+        for key, row in zip(missing, rows):
+            if row is None:
+                continue
+            value = pickle.loads(row)
+            self.l1.set(key, value)
+            result[key] = value
+        return result
+
+    def set(self, key, value):
+        self.set_many({key: value})
+
+    def set_many(self, mapping):
+        for key, value in mapping.items():
+            self.l1.set(key, value)
+        try:
+            with get_redis().pipeline(transaction=False) as pipe:
+                for key, value in mapping.items():
+                    pipe.set(self.make_key(key), pickle.dumps(value), ex=self.l2_ttl)
+                pipe.execute()
+        except redis.RedisError:
+            logger.exception('%s cache set failed', self.namespace)
+
+    def delete(self, key):
+        self.delete_many([key])
+
+    def delete_many(self, keys):
+        keys = list(keys)
+        if not keys:
+            return
+        for key in keys:
+            self.l1.delete(key)
+        try:
+            get_redis().delete(*[self.make_key(key) for key in keys])
+        except redis.RedisError:
+            logger.exception('%s cache delete failed', self.namespace)
+
+
+class VersionedTieredCache(TieredCache):
+    """
+    전체 version 으로 한번에 무효화할 수 있는 TieredCache 입니다.
+    value 는 만들 때의 version 을 'version' key 로 담은 dict 이고, 지금 version 과 다르면 cache 에 있어도 버립니다.
+    - version : Redis 의 '<namespace>:version' 값입니다. page 마다 Redis 를 한번 더 읽지 않도록 process 에서 l1_ttl 동안
+      들고 있고, bump_version 은 다른 process 에 l1_ttl 안에 반영됩니다.
+    - Redis 에 문제가 있으면 이 process 가 마지막으로 읽은 version (없으면 0) 을 사용합니다.
+    """
+
+    def __init__(self, namespace, l1_maxsize, l1_ttl, l2_ttl):
+        super().__init__(namespace, l1_maxsize, l1_ttl, l2_ttl)
+        self.version_key = '{}:version'.format(namespace)
+        self._version = LRUCache(1, l1_ttl)
+        self._last_version = 0
+
+    def _remember_version(self, version):
+        self._version.set(self.version_key, version)
+        self._last_version = version
+
+    def get_version(self):
+        version = self._version.get(self.version_key)
+        if version is not None:
+            return version
+        try:
+            version = int(get_redis().get(self.version_key) or 0)
+        except redis.RedisError:
+            logger.exception('%s cache version get failed', self.namespace)
+            return self._last_version
+        self._remember_version(version)
+        return version
+
+    def bump_version(self):
+        """
+        모든 value 를 한번에 무효화합니다.
+        """
+        version = get_redis().incr(self.version_key)
+        self._remember_version(version)
+        return version
+
+    def get_or_load_many(self, keys, load):
+        """
+        지금 version 의 value 를 cache 에서 찾고, 없는 key 만 load 로 한번에 만들어 cache 에 넣습니다.
+        :param load: load(missing_keys, version) -> {key: value}
+        :return: {key: value} (load 가 만들지 못한 key 는 포함되지 않습니다.)
+        """
+        version = self.get_version()
+        values = {key: value for key, value in self.get_many(keys).items() if value.get('version') == version}
+        missing = set(keys) - set(values)
+        if missing:
+            loaded = load(missing, version)
+            if loaded:
+                self.set_many(loaded)
+            values.update(loaded)
+        return values
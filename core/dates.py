@@ -0,0 +1,16 @@
+import datetime
+
+
+def month_start(value):
+    """
+    value 가 속한 달의 1일 0시입니다.
+    """
+    return datetime.datetime(value.year, value.month, 1)
+
+
+def add_months(value, months):
+    """
+    value 가 속한 달의 1일에서 months 만큼 이동한 달의 1일을 return 합니다.
+    """
+    index = value.year * 12 + value.month - 1 + months
+    return datetime.datetime(index // 12, index % 12 + 1, 1)
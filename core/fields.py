@@ -8,7 +8,8 @@ from django.template.loader import render_to_string
 from django.utils.deconstruct import deconstructible
 from django.utils.safestring import mark_safe
 from rest_framework import fields as rest_framework_fields
-from . import S3_HOST
+
+from core.resolvers import resolve
 
 """
 Django model field
@@ -17,7 +18,8 @@ Django model field
 
 def _resolve(key):
     # return '%s/resolve/?key=%s' % (FILESERVER_HOST, key)
-    return '%s/%s.jpg' % (S3_HOST, key)
+    # settings.IMAGE_URL_RESOLVER 로 url 을 만듭니다. (여러 key 는 core.resolvers.resolve_many 로 한번에)
+    return resolve(key)
 
 
 class URLResolvableUUID(uuid.UUID):
@@ -0,0 +1,373 @@
+import contextvars
+import functools
+import hashlib
+import logging
+import random
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+import redis
+from django.conf import settings
+from django.db.backends.signals import connection_created
+from django.db import connections
+from rest_framework.renderers import JSONRenderer
+
+from core.redis import get_redis
+
+logger = logging.getLogger(__name__)
+
+KEY_PREFIX = 'metrics:endpoint'
+ENDPOINTS_KEY = 'metrics:endpoints'
+STATEMENTS_KEY = 'metrics:statements'
+# 요청 하나의 query 수 histogram bucket 입니다. N+1 이 있는 endpoint 는 큰 bucket 쪽으로 몰립니다.
+QUERY_BUCKETS = (1, 2, 5, 10, 20, 50, 100)
+# endpoint 별 ':slowest' zset 에 남기는 statement 수 (느린 순서)
+SLOWEST_STATEMENTS_KEPT = 20
+
+# endpoint 별로 가장 느렸던 statement 의 시간만 더 클 때 바꿉니다. (여러 process 가 함께 씁니다.)
+SET_SLOWEST_SCRIPT = """
+local current = redis.call('ZSCORE', KEYS[1], ARGV[2])
+if not current or tonumber(current) < tonumber(ARGV[1]) then
+    redis.call('ZADD', KEYS[1], ARGV[1], ARGV[2])
+end
+return 1
+"""
+
+_current = contextvars.ContextVar('query_metrics', default=None)
+
+_STRING_RE = re.compile(r"'(?:[^'\\]|\\.|'')*'")
+_NUMBER_RE = re.compile(r'\b\d+(?:\.\d+)?\b')
+_IN_LIST_RE = re.compile(r'\((?:\s*(?:%s|\?)\s*,)*\s*(?:%s|\?)\s*\)')
+_SPACE_RE = re.compile(r'\s+')
+
+
+def fingerprint(sql):
+    """
+    literal / IN (...) 의 길이가 달라도 같은 statement 로 묶이도록 SQL 을 정규화합니다.
+    :return: (8자리 hash, 정규화한 SQL)
+    """
+    normalized = _STRING_RE.sub('?', sql)
+    normalized = _NUMBER_RE.sub('?', normalized)
+    normalized = _IN_LIST_RE.sub('(...)', normalized)
+    normalized = _SPACE_RE.sub(' ', normalized).strip()
+    return hashlib.md5(normalized.encode('utf8')).hexdigest()[:8], normalized
+
+
+class RequestStats(object):
+    """
+    요청(또는 consumer handler) 하나 동안 실행한 query 수 / SQL 시간 / 가장 느린 statement / serialize 시간입니다.
+    """
+
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.sampled = False
+        self.queries = 0
+        self.db_time = 0.0
+        self.serialize_time = 0.0
+        self.slowest_time = 0.0
+        self.slowest_sql = None
+
+    def add_query(self, sql, duration):
+        self.queries += 1
+        self.db_time += duration
+        if duration > self.slowest_time:
+            self.slowest_time = duration
+            self.slowest_sql = sql
+
+
+class _EndpointTotals(object):
+    __slots__ = ('requests', 'sampled', 'queries', 'db_time', 'serialize_time', 'buckets', 'slowest')
+
+    def __init__(self):
+        self.requests = 0
+        self.sampled = 0
+        self.queries = 0
+        self.db_time = 0.0
+        self.serialize_time = 0.0
+        self.buckets = [0] * (len(QUERY_BUCKETS) + 1)
+        self.slowest = {}  # fingerprint -> (time, normalized sql)
+
+
+class QueryMetrics(object):
+    """
+    endpoint 별 DB query 지표를 process 안에 모았다가 settings.METRICS_FLUSH_INTERVAL 마다 Redis 로 합칩니다.
+    (uwsgi / daphne worker 가 여러개여도 metrics endpoint 는 Redis 의 합계를 보여줍니다.)
+    - 요청마다 settings.METRICS_SAMPLE_RATE 확률로 sample 하고, sample 된 요청에서만 query 를 기록합니다.
+      sample 되지 않은 요청은 요청 수만 셉니다.
+    - query 는 모든 DB connection 의 execute_wrapper 로 기록하고, 지금 기록 중인 요청은 contextvar 로 찾습니다.
+      (database_sync_to_async 의 thread 에도 contextvar 가 전달되므로 consumer 의 query 도 기록됩니다.)
+    - flush 는 별도 thread 에서 합니다. 요청 thread 나 daphne 의 event loop (QueryMetricsConsumerMixin) 가
+      Redis 를 기다리지 않습니다.
+    Redis 에 문제가 있으면 모은 값을 버리고 계속 동작합니다.
+    """
+
+    def __init__(self):
+        self._totals = {}
+        self._lock = threading.Lock()
+        self._last_flush = time.monotonic()
+        self._flushing = False
+
+    @contextmanager
+    def record(self, endpoint):
+        """
+        with 안에서 실행한 query 를 RequestStats 에 기록합니다.
+        endpoint 는 with 안에서 stats.endpoint 로 바꿀 수 있습니다. (url resolve 후 등)
+        """
+        stats = RequestStats(endpoint)
+        stats.sampled = random.random() < settings.METRICS_SAMPLE_RATE
+        token = _current.set(stats) if stats.sampled else None
+        try:
+            yield stats
+        finally:
+            if token is not None:
+                _current.reset(token)
+            self._add(stats)
+
+    @contextmanager
+    def serialize_timer(self):
+        """
+        with 안의 시간을 지금 기록 중인 요청의 serialize 시간에 더합니다.
+        """
+        stats = _current.get()
+        if stats is None:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            stats.serialize_time += time.perf_counter() - start
+
+    def _add(self, stats):
+        with self._lock:
+            totals = self._totals.get(stats.endpoint)
+            if totals is None:
+                totals = self._totals[stats.endpoint] = _EndpointTotals()
+            totals.requests += 1
+            if stats.sampled:
+                totals.sampled += 1
+                totals.queries += stats.queries
+                totals.db_time += stats.db_time
+                totals.serialize_time += stats.serialize_time
+                totals.buckets[self._bucket_index(stats.queries)] += 1
+                if stats.slowest_sql is not None:
+                    key, normalized = fingerprint(stats.slowest_sql)
+                    if stats.slowest_time > totals.slowest.get(key, (0,))[0]:
+                        totals.slowest[key] = (stats.slowest_time, normalized)
+            due = not self._flushing and time.monotonic() - self._last_flush >= settings.METRICS_FLUSH_INTERVAL
+            if due:
+                self._flushing = True
+        if due:
+            threading.Thread(target=self._background_flush, name='query-metrics-flush', daemon=True).start()
+
+    def _background_flush(self):
+        try:
+            self.flush()
+        finally:
+            self._flushing = False
+
+    @staticmethod
+    def _bucket_index(queries):
+        for index, bound in enumerate(QUERY_BUCKETS):
+            if queries <= bound:
+                return index
+        return len(QUERY_BUCKETS)
+
+    def flush(self):
+        """
+        process 에 모은 값을 Redis 에 더하고 비웁니다.
+        """
+        with self._lock:
+            totals, self._totals = self._totals, {}
+            self._last_flush = time.monotonic()
+        if not totals:
+            return
+
+        try:
+            client = get_redis()
+            set_slowest = client.register_script(SET_SLOWEST_SCRIPT)
+            pipe = client.pipeline(transaction=False)
+            for endpoint, total in totals.items():
+                key = '{}:{}'.format(KEY_PREFIX, endpoint)
+                pipe.sadd(ENDPOINTS_KEY, endpoint)
+                pipe.hincrby(key, 'requests', total.requests)
+                pipe.hincrby(key, 'sampled', total.sampled)
+                pipe.hincrby(key, 'queries', total.queries)
+                pipe.hincrbyfloat(key, 'db_time', total.db_time)
+                pipe.hincrbyfloat(key, 'serialize_time', total.serialize_time)
+                for index, count in enumerate(total.buckets):
+                    if count:
+                        pipe.hincrby(key, 'bucket:{}'.format(index), count)
+                for statement_key, (duration, normalized) in total.slowest.items():
+                    pipe.hset(STATEMENTS_KEY, statement_key, normalized)
+                    set_slowest(keys=['{}:slowest'.format(key)], args=[duration, statement_key], client=pipe)
+                if total.slowest:
+                    pipe.zremrangebyrank('{}:slowest'.format(key), 0, -SLOWEST_STATEMENTS_KEPT - 1)
+            pipe.execute()
+        except redis.RedisError:
+            logger.warning('query metrics flush failed', exc_info=True)
+
+    def collect(self):
+        """
+        Redis 에 모인 endpoint 별 합계를 return 합니다. (이 process 에 남은 값을 먼저 flush 합니다.)
+        :return: {endpoint: {'requests', 'sampled', 'queries', 'db_time', 'serialize_time', 'buckets',
+                             'slowest': (fingerprint, normalized sql, seconds) 또는 None}}
+        """
+        self.flush()
+        client = get_redis()
+        endpoints = sorted(endpoint.decode('utf8') for endpoint in client.smembers(ENDPOINTS_KEY))
+        pipe = client.pipeline(transaction=False)
+        for endpoint in endpoints:
+            key = '{}:{}'.format(KEY_PREFIX, endpoint)
+            pipe.hgetall(key)
+            pipe.zrevrange('{}:slowest'.format(key), 0, 0, withscores=True)
+        replies = pipe.execute()
+
+        slowest_keys = [slowest[0][0] for slowest in replies[1::2] if slowest]
+        statements = dict(zip(slowest_keys, client.hmget(STATEMENTS_KEY, slowest_keys))) if slowest_keys else {}
+
+        result = {}
+        for endpoint, fields, slowest in zip(endpoints, replies[0::2], replies[1::2]):
+            fields = {name.decode('utf8'): value for name, value in fields.items()}
+            result[endpoint] = {
+                'requests': int(fields.get('requests', 0)),
+                'sampled': int(fields.get('sampled', 0)),
+                'queries': int(fields.get('queries', 0)),
+                'db_time': float(fields.get('db_time', 0)),
+                'serialize_time': float(fields.get('serialize_time', 0)),
+                'buckets': [int(fields.get('bucket:{}'.format(index), 0)) for index in range(len(QUERY_BUCKETS) + 1)],
+                'slowest': None,
+            }
+            if slowest:
+                statement_key, duration = slowest[0]
+                statement = statements.get(statement_key) or b''
+                result[endpoint]['slowest'] = (statement_key.decode('utf8'), statement.decode('utf8'), duration)
+        return result
+
+
+query_metrics = QueryMetrics()
+
+
+def _record_query(execute, sql, params, many, context):
+    stats = _current.get()
+    if stats is None:
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        stats.add_query(sql, time.perf_counter() - start)
+
+
+def install_query_wrapper(connection, **kwargs):
+    """
+    connection 에 query 기록용 execute_wrapper 를 한번만 붙입니다. (connection_created signal receiver)
+    """
+    if _record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_record_query)
+
+
+connection_created.connect(install_query_wrapper)
+
+
+def prometheus_text(collected):
+    """
+    collect() 결과를 Prometheus text format (0.0.4) 으로 만듭니다.
+    """
+
+    def label(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', ' ')
+
+    lines = []
+    counters = (
+        ('siiot_requests_total', 'requests', 'Requests handled (sampled or not).'),
+        ('siiot_sampled_requests_total', 'sampled', 'Requests whose queries were recorded.'),
+        ('siiot_db_queries_total', 'queries', 'SQL statements executed by sampled requests.'),
+        ('siiot_db_time_seconds_total', 'db_time', 'SQL time of sampled requests.'),
+        ('siiot_serialize_seconds_total', 'serialize_time', 'Response / frame serialization time of sampled requests.'),
+    )
+    for name, field, help_text in counters:
+        lines += ['# HELP {} {}'.format(name, help_text), '# TYPE {} counter'.format(name)]
+        for endpoint, values in collected.items():
+            lines.append('{}{{endpoint="{}"}} {}'.format(name, label(endpoint), values[field]))
+
+    name = 'siiot_db_queries_per_request'
+    lines += ['# HELP {} SQL statements per sampled request.'.format(name), '# TYPE {} histogram'.format(name)]
+    for endpoint, values in collected.items():
+        cumulative = 0
+        for bound, count in zip(QUERY_BUCKETS + ('+Inf',), values['buckets']):
+            cumulative += count
+            lines.append('{}_bucket{{endpoint="{}",le="{}"}} {}'.format(name, label(endpoint), bound, cumulative))
+        lines.append('{}_sum{{endpoint="{}"}} {}'.format(name, label(endpoint), values['queries']))
+        lines.append('{}_count{{endpoint="{}"}} {}'.format(name, label(endpoint), values['sampled']))
+
+    name = 'siiot_db_slowest_query_seconds'
+    lines += ['# HELP {} Slowest SQL statement seen per endpoint.'.format(name), '# TYPE {} gauge'.format(name)]
+    for endpoint, values in collected.items():
+        if values['slowest']:
+            statement_key, statement, duration = values['slowest']
+            lines.append('{}{{endpoint="{}",fingerprint="{}",statement="{}"}} {}'.format(
+                name, label(endpoint), statement_key, label(statement[:200]), duration))
+    return '\n'.join(lines) + '\n'
+
+
+class QueryMetricsMiddleware(object):
+    """
+    REST / admin 요청마다 query 수, SQL 시간, 가장 느린 statement, serialize 시간을 기록합니다.
+    endpoint 이름은 '<METHOD> <url name>' 입니다. (url 에 이름이 없으면 route, 없으면 'unresolved')
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        # 이미 열려 있는 connection 은 connection_created 가 오지 않으므로 여기서 붙입니다.
+        for connection in connections.all():
+            install_query_wrapper(connection)
+
+    def __call__(self, request):
+        with query_metrics.record('http') as stats:
+            response = self.get_response(request)
+            stats.endpoint = self._endpoint_name(request)
+        return response
+
+    @staticmethod
+    def _endpoint_name(request):
+        match = request.resolver_match
+        if match is None:
+            return '{} unresolved'.format(request.method)
+        return '{} {}'.format(request.method, match.url_name or match.route)
+
+
+class QueryMetricsConsumerMixin(object):
+    """
+    consumer 의 handler (websocket.receive, chat_message 등) 마다 query 지표를 기록합니다.
+    endpoint 이름은 'ws <Consumer>.<message type>' 입니다. AsyncConsumer 보다 앞에 상속합니다.
+    """
+
+    async def dispatch(self, message):
+        endpoint = 'ws {}.{}'.format(type(self).__name__, message['type'].replace('.', '_'))
+        with query_metrics.record(endpoint):
+            await super().dispatch(message)
+
+
+class MetricsJSONRenderer(JSONRenderer):
+    """
+    JSON encode 시간을 지금 요청의 serialize 시간으로 기록하는 JSONRenderer 입니다.
+    """
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        with query_metrics.serialize_timer():
+            return super().render(data, accepted_media_type, renderer_context)
+
+
+def timed_serialize(func):
+    """
+    함수 실행 시간을 지금 요청의 serialize 시간으로 기록하는 decorator 입니다. (encode_event 등)
+    """
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with query_metrics.serialize_timer():
+            return func(*args, **kwargs)
+    return wrapper
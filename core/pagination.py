@@ -1,9 +1,14 @@
-from rest_framework.pagination import CursorPagination, PageNumberPagination
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import Cursor, CursorPagination, PageNumberPagination
 from rest_framework.response import Response
 from urllib import parse as urlparse
 from base64 import b64decode, b64encode
 from collections import OrderedDict
 
+from core.dates import month_start, add_months
+
 
 def _reverse_ordering(ordering_tuple):
     """
@@ -68,9 +73,242 @@ class SiiotCursorPagination(CursorPagination):
         return encoded
 
 
-def paginate(page_size=None, ordering=None):
+class SiiotKeysetPagination(SiiotCursorPagination):
+    """
+    (정렬 field, id) 복합 keyset 으로 paginate 합니다.
+    CursorPagination 은 첫번째 ordering field 만 position 으로 쓰고 같은 값은 offset 으로 건너뛰기 때문에,
+    정렬 값이 겹치는 row 가 많으면 결국 offset scan 이 됩니다.
+    여기서는 page 끝 row 의 (value, id) 를 cursor 에 담아 WHERE (value, id) < (...) 로만 조회하므로
+    몇번째 page 든 첫 page 와 비용이 같고, COUNT(*) 도 하지 않습니다.
+    - ordering 은 ('-updated_at', '-id') 처럼 (정렬 field, unique 한 tie-breaker) 두개로 지정합니다.
+    - cursor 대신 ?before={id} / ?after={id} 로 기준 row 를 지정할 수 있습니다.
+      before 는 ordering 상 기준 row 다음(뒤) page, after 는 기준 row 이전(앞) page 를 return 합니다.
+    """
+    page_size = 20
+    ordering = ('-updated_at', '-id')
+    before_query_param = 'before'
+    after_query_param = 'after'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.page_size = self.get_page_size(request)
+        if not self.page_size:
+            return None
+
+        self.request = request
+        self.cursor = self.decode_anchor(request, queryset) or self.decode_cursor(request)
+        if self.cursor is None:
+            (reverse, position) = (False, None)
+        else:
+            (reverse, position) = (self.cursor.reverse, self.cursor.position)
+
+        ordering = _reverse_ordering(self.ordering) if reverse else self.ordering
+        queryset = queryset.order_by(*ordering)
+        if position is not None:
+            queryset = queryset.filter(self.get_keyset_filter(queryset.model, ordering, position))
+
+        # page_size + 1 개를 가져와서 다음 page 가 있는지 확인합니다. (COUNT 대신)
+        results = self.fetch_rows(queryset, ordering, position, self.page_size + 1)
+        has_more = len(results) > self.page_size
+        self.page = results[:self.page_size]
+
+        if reverse:
+            self.page = list(reversed(self.page))
+            self.has_next = position is not None
+            self.has_previous = has_more
+        else:
+            self.has_next = has_more
+            self.has_previous = position is not None
+        return self.page
+
+    def fetch_rows(self, queryset, ordering, position, limit):
+        return list(queryset[:limit])
+
+    def get_keyset_filter(self, model, ordering, position):
+        """
+        (field, tie_breaker) 가 position 보다 '뒤' 에 있는 row 만 남기는 Q 를 만듭니다.
+        """
+        (field, tie_breaker) = [item.lstrip('-') for item in ordering]
+        lookup = 'lt' if ordering[0].startswith('-') else 'gt'
+        tie_lookup = 'lt' if ordering[1].startswith('-') else 'gt'
+        try:
+            value = model._meta.get_field(field).to_python(position[0])
+            tie_value = model._meta.get_field(tie_breaker).to_python(position[1])
+        except ValidationError:
+            raise NotFound(self.invalid_cursor_message)
+        return Q(**{'%s__%s' % (field, lookup): value}) | \
+            Q(**{field: value, '%s__%s' % (tie_breaker, tie_lookup): tie_value})
+
+    def is_first_page_request(self, request):
+        params = request.query_params
+        return all(param not in params
+                   for param in (self.cursor_query_param, self.before_query_param, self.after_query_param))
+
+    def paginate_rows(self, rows, request):
+        """
+        cache 등에서 이미 ordering 순서로 꺼낸 첫 page row(dict) 를 같은 cursor 형식으로 paginate 합니다.
+        다음 page 여부를 알 수 있도록 rows 에는 page_size 보다 1개 많은 row 까지 담아 넘깁니다.
+        """
+        self.page_size = self.get_page_size(request)
+        self.request = request
+        self.cursor = None
+        self.page = list(rows[:self.page_size])
+        self.has_next = len(rows) > self.page_size
+        self.has_previous = False
+        return self.page
+
+    def get_position_from_instance(self, instance, ordering):
+        (field, tie_breaker) = [item.lstrip('-') for item in ordering]
+        if isinstance(instance, dict):
+            return (str(instance[field]), str(instance[tie_breaker]))
+        return (str(getattr(instance, field)), str(getattr(instance, tie_breaker)))
+
+    def decode_anchor(self, request, queryset):
+        """
+        ?before={id} / ?after={id} 로 넘어온 기준 row 의 (value, id) 를 Cursor 로 바꿉니다. (pk 로 한 row 만 조회)
+        """
+        before = request.query_params.get(self.before_query_param)
+        after = request.query_params.get(self.after_query_param)
+        if before is None and after is None:
+            return None
+
+        fields = [item.lstrip('-') for item in self.ordering]
+        try:
+            anchor = queryset.order_by().filter(pk=before if before is not None else after).only(*fields).first()
+        except (TypeError, ValueError, ValidationError):
+            anchor = None
+        if anchor is None:
+            raise NotFound(self.invalid_cursor_message)
+
+        position = self.get_position_from_instance(anchor, self.ordering)
+        return Cursor(offset=0, reverse=before is None, position=position)
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        position = self.get_position_from_instance(self.page[-1], self.ordering)
+        return self.encode_cursor(Cursor(offset=0, reverse=False, position=position))
+
+    def get_previous_link(self):
+        if not self.has_previous:
+            return None
+        position = self.get_position_from_instance(self.page[0], self.ordering)
+        return self.encode_cursor(Cursor(offset=0, reverse=True, position=position))
+
+    def encode_cursor(self, cursor):
+        tokens = {'p': cursor.position[0], 'i': cursor.position[1]}
+        if cursor.reverse:
+            tokens['r'] = '1'
+
+        querystring = urlparse.urlencode(tokens, doseq=True)
+        encoded = b64encode(querystring.encode('ascii')).decode('ascii')
+        return encoded
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if encoded is None:
+            return None
+
+        try:
+            querystring = b64decode(encoded.encode('ascii')).decode('ascii')
+            tokens = urlparse.parse_qs(querystring, keep_blank_values=True)
+            reverse = bool(int(tokens.get('r', ['0'])[0]))
+            position = (tokens['p'][0], tokens['i'][0])
+        except (TypeError, ValueError, KeyError):
+            raise NotFound(self.invalid_cursor_message)
+
+        return Cursor(offset=0, reverse=reverse, position=position)
+
+
+class MonthlyWindowKeysetPagination(SiiotKeysetPagination):
+    """
+    정렬 field 로 월별 partition 된 table 을 partition 하나씩 읽도록 한달 단위 범위 조건을 붙여 paginate 합니다.
+    keyset 조건만으로는 정렬 방향 반대쪽에 범위가 없어 모든 partition 의 index 를 보게 되므로,
+    기준 row(없으면 window_ceiling) 의 달부터 한달씩 옮겨가며 page 가 찰 때까지 조회합니다.
+    - view 에서 paginate 전에 window_floor(이보다 오래된 row 는 없음, ex. 방의 created_at) 와
+      window_ceiling(가장 최근 row 의 시각, ex. 방의 updated_at) 을 지정합니다. floor 가 없으면 SiiotKeysetPagination 과 같습니다.
+    - row 가 없는 달이 이어지면 max_windows 번째 조회는 남은 범위 전체(floor 또는 ceiling 까지) 를 한번에 봅니다.
+    - cold_source : floor 보다 오래된 row 를 DB 밖(archive 등) 에서 읽는 object 입니다. (fetch(ordering, position, limit),
+      get(pk)) 최신순 page 는 DB 의 row 가 모자랄 때 이어서 읽고, 오래된순 page 는 cold_source 를 먼저 읽습니다.
+    """
+    max_windows = 3
+    window_floor = None
+    window_ceiling = None
+    cold_source = None
+
+    def fetch_rows(self, queryset, ordering, position, limit):
+        if self.cold_source is None:
+            return self.fetch_window_rows(queryset, ordering, position, limit)
+
+        if ordering[0].startswith('-'):
+            rows = []
+            field = queryset.model._meta.get_field(ordering[0].lstrip('-'))
+            if position is None or self.window_floor is None or field.to_python(position[0]) >= self.window_floor:
+                rows = self.fetch_window_rows(queryset, ordering, position, limit)
+            if len(rows) < limit:
+                last = self.get_position_from_instance(rows[-1], ordering) if rows else position
+                rows += self.cold_source.fetch(ordering, last, limit - len(rows))
+            return rows
+        rows = self.cold_source.fetch(ordering, position, limit)
+        if len(rows) < limit:
+            rows += self.fetch_window_rows(queryset, ordering, position, limit - len(rows))
+        return rows
+
+    def decode_anchor(self, request, queryset):
+        try:
+            return super().decode_anchor(request, queryset)
+        except NotFound:
+            if self.cold_source is None:
+                raise
+        # 기준 row 가 cold_source 로 옮겨진 경우
+        pk = request.query_params.get(self.before_query_param) or request.query_params.get(self.after_query_param)
+        try:
+            anchor = self.cold_source.get(int(pk))
+        except (TypeError, ValueError):
+            anchor = None
+        if anchor is None:
+            raise NotFound(self.invalid_cursor_message)
+        before = request.query_params.get(self.before_query_param)
+        return Cursor(offset=0, reverse=before is None, position=self.get_position_from_instance(anchor, self.ordering))
+
+    def fetch_window_rows(self, queryset, ordering, position, limit):
+        if self.window_floor is None:
+            return super().fetch_rows(queryset, ordering, position, limit)
+
+        field = ordering[0].lstrip('-')
+        descending = ordering[0].startswith('-')
+        if position is not None:
+            start = queryset.model._meta.get_field(field).to_python(position[0])
+        else:
+            start = self.window_ceiling if descending else self.window_floor
+        start = max(start or self.window_floor, self.window_floor)
+
+        rows = []
+        month = month_start(start)
+        for window in range(self.max_windows):
+            next_month = add_months(month, 1)
+            if descending:
+                # 마지막 window 는 floor 까지, 그 전에는 month 한달만 봅니다. (첫 window 의 위쪽은 keyset 조건이 막습니다.)
+                last = window == self.max_windows - 1 or month <= self.window_floor
+                window_qs = queryset.filter(**{'%s__gte' % field: self.window_floor if last else month})
+                if window:
+                    window_qs = window_qs.filter(**{'%s__lt' % field: next_month})
+            else:
+                # ceiling 이 속한 달(또는 마지막 window) 은 위쪽을 열어 두어 그 후에 쓰인 row 도 읽습니다.
+                last = window == self.max_windows - 1 or \
+                    (self.window_ceiling is not None and next_month > self.window_ceiling)
+                window_qs = queryset.filter(**{'%s__gte' % field: max(month, self.window_floor)})
+                if not last:
+                    window_qs = window_qs.filter(**{'%s__lt' % field: next_month})
+            rows += list(window_qs[:limit - len(rows)])
+            if len(rows) >= limit or last:
+                break
+            month = add_months(month, -1 if descending else 1)
+        return rows
+
+
+def paginate(page_size=None, ordering=None, pagination_class=SiiotCursorPagination):
 
-    class _Pagination(SiiotCursorPagination):
+    class _Pagination(pagination_class):
         def __init__(self):
             self.page_size = page_size
             self.ordering = ordering
@@ -0,0 +1,15 @@
+import redis
+from django.conf import settings
+
+_connection_pool = None
+
+
+def get_redis():
+    """
+    channel layer 와 같은 Redis(settings.REDIS_URL) 에 붙는 client 를 return 합니다.
+    connection pool 은 process 당 하나를 만들어 공유합니다.
+    """
+    global _connection_pool
+    if _connection_pool is None:
+        _connection_pool = redis.ConnectionPool.from_url(settings.REDIS_URL)
+    return redis.Redis(connection_pool=_connection_pool)
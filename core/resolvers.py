@@ -0,0 +1,153 @@
+import time
+import uuid
+from urllib.parse import urlsplit, urlunsplit
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.db.models.fields.files import FieldFile
+from django.utils.module_loading import import_string
+from storages.backends.s3boto3 import S3Boto3Storage
+from storages.utils import clean_name
+
+from core import S3_HOST
+from core.cache import TieredCache
+from core.s3 import get_s3_client, get_image_key_bucket, image_key_name
+
+_resolver = None
+
+
+def _locate(ref):
+    """
+    image reference -> (storage, name). S3ImageKeyField 의 image key 는 S3_HOST bucket 에 '<key>.jpg' 로 있으므로
+    storage 가 None 입니다. 비어 있는 reference 는 (None, None) 입니다.
+    """
+    if isinstance(ref, uuid.UUID):
+        return None, image_key_name(ref)
+    if isinstance(ref, FieldFile):
+        return (ref.storage, ref.name) if ref else (None, None)
+    if ref:
+        return default_storage, ref
+    return None, None
+
+
+class ImageURLResolver(object):
+    """
+    image reference 를 client 에 내려줄 url 로 바꿉니다.
+    reference : S3ImageKeyField 값 (uuid), ImageField 값 (FieldFile), default storage 의 file 이름 (str)
+    - cdn_host : 'https://cdn.example.com' 처럼 주면 url 의 scheme / host 를 바꿉니다. (path 와 query 는 그대로)
+    serializer 는 page 의 reference 를 모아 resolve_many 를 한번 호출합니다.
+    """
+
+    def __init__(self, cdn_host=None):
+        self.cdn_host = urlsplit(cdn_host) if cdn_host else None
+
+    def resolve(self, ref):
+        return self.resolve_many([ref])[0]
+
+    def resolve_many(self, refs):
+        """
+        :return: refs 와 같은 순서의 url list (비어 있는 reference 는 None)
+        """
+        raise NotImplementedError
+
+    def rewrite_host(self, url):
+        if self.cdn_host is None or url is None:
+            return url
+        parts = urlsplit(url)
+        return urlunsplit((self.cdn_host.scheme or parts.scheme, self.cdn_host.netloc,
+                           self.cdn_host.path.rstrip('/') + parts.path, parts.query, parts.fragment))
+
+
+class PublicURLResolver(ImageURLResolver):
+    """
+    공개 object 의 url 입니다. image key 는 S3_HOST 로, file 은 storage.url 로 만듭니다. (signing 없음)
+    """
+
+    def resolve_many(self, refs):
+        urls = []
+        for ref in refs:
+            storage, name = _locate(ref)
+            if name is None:
+                urls.append(None)
+            elif storage is None:
+                urls.append(self.rewrite_host('%s/%s' % (S3_HOST, name)))
+            else:
+                urls.append(self.rewrite_host(storage.url(name)))
+        return urls
+
+
+class PresignedURLResolver(ImageURLResolver):
+    """
+    private bucket 용 presigned GET url 입니다. 만든 url 은 (bucket, key) 별로 TieredCache 에 두고, 만료
+    refresh_margin 초 전까지 다시 사용합니다. (같은 image 의 url 이 page / process 마다 바뀌지 않습니다.)
+    - expires_in : presigned url 의 유효 시간 (초). client 는 받은 url 을 최소 refresh_margin 초 동안 쓸 수 있습니다.
+      url 은 만료되므로 cache (chat history buffer 등) 에는 url 이 아니라 image reference 를 저장합니다.
+    - key_bucket : image key 가 있는 bucket (기본값은 S3_HOST 의 bucket)
+    S3Boto3Storage 가 아닌 storage 의 file 은 storage.url 을 그대로 사용합니다.
+    """
+
+    def __init__(self, cdn_host=None, expires_in=60 * 60, refresh_margin=60 * 10, key_bucket=None):
+        super().__init__(cdn_host)
+        self.expires_in = expires_in
+        self.refresh_margin = refresh_margin
+        self.key_bucket = key_bucket or get_image_key_bucket()
+        cache_ttl = expires_in - refresh_margin
+        self.cache = TieredCache('images:signed', l1_maxsize=settings.IMAGE_URL_CACHE_SIZE,
+                                 l1_ttl=cache_ttl, l2_ttl=cache_ttl)
+
+    def _object(self, storage, name):
+        # presign 할 (bucket, key). presign 할 수 없으면 None 입니다.
+        if storage is None:
+            return self.key_bucket, name
+        if isinstance(storage, S3Boto3Storage):
+            return storage.bucket_name, storage._normalize_name(clean_name(name))
+        return None
+
+    def resolve_many(self, refs):
+        urls = [None] * len(refs)
+        targets = {}
+        for index, ref in enumerate(refs):
+            storage, name = _locate(ref)
+            if name is None:
+                continue
+            target = self._object(storage, name)
+            if target is None:
+                urls[index] = self.rewrite_host(storage.url(name))
+            else:
+                targets.setdefault('%s/%s' % target, []).append(index)
+
+        now = time.time()
+        signed = {cache_key: url for cache_key, (url, expires_at) in self.cache.get_many(targets).items()
+                  if expires_at - self.refresh_margin > now}
+        missing = {}
+        for cache_key in targets.keys() - signed.keys():
+            (bucket, key) = cache_key.split('/', 1)
+            url = self.rewrite_host(get_s3_client().generate_presigned_url(
+                'get_object', Params={'Bucket': bucket, 'Key': key}, ExpiresIn=self.expires_in))
+            missing[cache_key] = (url, now + self.expires_in)
+            signed[cache_key] = url
+        if missing:
+            self.cache.set_many(missing)
+
+        for cache_key, indexes in targets.items():
+            for index in indexes:
+                urls[index] = signed[cache_key]
+        return urls
+
+
+def get_resolver():
+    """
+    settings.IMAGE_URL_RESOLVER (resolver class 경로) 와 IMAGE_URL_RESOLVER_OPTIONS 로 만든 resolver 입니다.
+    """
+    global _resolver
+    if _resolver is None:
+        _resolver = import_string(settings.IMAGE_URL_RESOLVER)(**settings.IMAGE_URL_RESOLVER_OPTIONS)
+    return _resolver
+
+
+def resolve(ref):
+    return get_resolver().resolve(ref)
+
+
+def resolve_many(refs):
+    return get_resolver().resolve_many(list(refs))
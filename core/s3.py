@@ -0,0 +1,78 @@
+import threading
+from urllib.parse import urlsplit
+
+import boto3
+from botocore.client import Config
+from botocore.exceptions import ClientError
+from django.conf import settings
+
+from core import S3_HOST
+
+IMAGE_KEY_FORMAT = '%s.jpg'
+
+_clients = {}
+_lock = threading.Lock()
+
+
+def get_s3_client(aws_access_key_id=None, aws_secret_access_key=None):
+    """
+    process 에서 같이 쓰는 boto3 S3 client 입니다. credential 별로 하나씩 만들어 둡니다. (기본값은 settings.AWS_*)
+    client 는 thread-safe 이고, 만들 때 credential / endpoint 를 읽느라 느리므로 요청마다 만들지 않습니다.
+    settings.AWS_S3_ENDPOINT_URL 을 주면 local S3 (minio, moto server 등) 에 붙습니다.
+    """
+    credentials = (aws_access_key_id or settings.AWS_ACCESS_KEY_ID,
+                   aws_secret_access_key or settings.AWS_SECRET_ACCESS_KEY)
+    client = _clients.get(credentials)
+    if client is None:
+        with _lock:
+            client = _clients.get(credentials)
+            if client is None:
+                client = _clients[credentials] = boto3.client(
+                    's3', region_name=settings.AWS_S3_REGION_NAME, endpoint_url=settings.AWS_S3_ENDPOINT_URL,
+                    aws_access_key_id=credentials[0], aws_secret_access_key=credentials[1],
+                    config=Config(signature_version=settings.AWS_S3_SIGNATURE_VERSION,
+                                  max_pool_connections=settings.AWS_S3_MAX_POOL_CONNECTIONS))
+    return client
+
+
+def get_image_key_bucket():
+    """
+    S3ImageKeyField 의 image 가 '<key>.jpg' 로 올라가는 bucket 입니다. (S3_HOST 의 bucket)
+    """
+    return urlsplit(S3_HOST).netloc.split('.s3')[0]
+
+
+def image_key_name(key):
+    return IMAGE_KEY_FORMAT % key
+
+
+def create_image_upload(key):
+    """
+    client 가 image key 하나를 bucket 에 직접 올릴 presigned POST 입니다.
+    object 이름은 key 로 고정하고, image content type 과 settings.IMAGE_UPLOAD_MAX_SIZE 이하만 받습니다.
+    :return: {'url', 'fields'} (client 는 fields 를 form field 로, file 을 마지막 'file' field 로 POST 합니다.)
+    """
+    fields = {'Content-Type': 'image/jpeg'}
+    conditions = [
+        ['starts-with', '$Content-Type', 'image/'],
+        ['content-length-range', 1, settings.IMAGE_UPLOAD_MAX_SIZE],
+    ]
+    if settings.AWS_DEFAULT_ACL:
+        fields['acl'] = settings.AWS_DEFAULT_ACL
+        conditions.append({'acl': settings.AWS_DEFAULT_ACL})
+    return get_s3_client().generate_presigned_post(
+        get_image_key_bucket(), image_key_name(key), Fields=fields, Conditions=conditions,
+        ExpiresIn=settings.IMAGE_UPLOAD_EXPIRE)
+
+
+def head_image(key):
+    """
+    올라간 image key object 의 (크기, content type) 입니다. 없으면 None 입니다.
+    """
+    try:
+        response = get_s3_client().head_object(Bucket=get_image_key_bucket(), Key=image_key_name(key))
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+            return None
+        raise
+    return response['ContentLength'], response.get('ContentType', '')
@@ -0,0 +1,9 @@
+def percentile(values, percent):
+    """
+    benchmark / load test command 가 latency 를 보고할 때 사용하는 nearest-rank percentile 입니다.
+    :param values: 비어 있지 않은 숫자 list
+    :param percent: 0 ~ 100
+    """
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(percent / 100.0 * (len(values) - 1))))
+    return values[index]
@@ -0,0 +1,20 @@
+from django.apps import apps
+from django.test.runner import DiscoverRunner
+
+
+class UnmanagedModelTestRunner(DiscoverRunner):
+    """
+    main 서버가 관리하는 (managed = False) User / Product 등의 table 도 test DB 에 만듭니다.
+    chat 의 model 이 이 table 들을 foreign key 로 참조하므로 test 동안만 managed 로 바꿉니다.
+    """
+
+    def setup_test_environment(self, *args, **kwargs):
+        self.unmanaged_models = [model for model in apps.get_models() if not model._meta.managed]
+        for model in self.unmanaged_models:
+            model._meta.managed = True
+        super().setup_test_environment(*args, **kwargs)
+
+    def teardown_test_environment(self, *args, **kwargs):
+        super().teardown_test_environment(*args, **kwargs)
+        for model in self.unmanaged_models:
+            model._meta.managed = False
@@ -0,0 +1,345 @@
+import datetime
+import io
+import pickle
+import uuid
+from unittest import mock
+
+import redis
+from django.core.files.storage import FileSystemStorage
+from django.test import SimpleTestCase, override_settings
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import Cursor
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory
+
+from SIIOT_chat_server.storage import CustomS3Boto3Storage, NonClosingFile, build_transfer_config
+from chat.models import ChatMessage
+from core.cache import LRUCache, TieredCache, VersionedTieredCache
+from core.dates import month_start, add_months
+from core.metrics import QueryMetrics, SLOWEST_STATEMENTS_KEPT, fingerprint, _record_query
+from core.pagination import SiiotKeysetPagination
+from core.resolvers import PresignedURLResolver
+
+
+class LRUCacheTest(SimpleTestCase):
+
+    def test_evicts_least_recently_used(self):
+        cache = LRUCache(maxsize=2, ttl=60)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('c'), 3)
+
+    @mock.patch('core.cache.time.monotonic')
+    def test_expires_after_ttl(self, monotonic):
+        cache = LRUCache(maxsize=10, ttl=60)
+        monotonic.return_value = 100.0
+        cache.set('a', 1)
+        cache.set('b', 2, ttl=10)
+        monotonic.return_value = 150.0
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('b', 'expired'), 'expired')
+        monotonic.return_value = 161.0
+        self.assertIsNone(cache.get('a'))
+
+
+@mock.patch('core.cache.get_redis')
+class TieredCacheTest(SimpleTestCase):
+
+    def setUp(self):
+        self.cache = TieredCache('test', l1_maxsize=10, l1_ttl=60, l2_ttl=600)
+
+    def test_l1_hit_does_not_read_redis(self, get_redis):
+        self.cache.l1.set(1, 'one')
+        self.assertEqual(self.cache.get_many([1]), {1: 'one'})
+        get_redis.assert_not_called()
+
+    def test_l2_hit_fills_l1(self, get_redis):
+        get_redis.return_value.mget.return_value = [pickle.dumps('two'), None]
+        self.assertEqual(self.cache.get_many([2, 3]), {2: 'two'})
+        get_redis.return_value.mget.assert_called_once_with(['test:2', 'test:3'])
+        self.assertEqual(self.cache.get_local(2), 'two')
+        self.assertIsNone(self.cache.get_local(3))
+
+    def test_redis_error_falls_back_to_l1(self, get_redis):
+        get_redis.return_value.mget.side_effect = redis.ConnectionError
+        self.cache.l1.set(1, 'one')
+        with self.assertLogs('core.cache', 'ERROR'):
+            self.assertEqual(self.cache.get_many([1, 2]), {1: 'one'})
+
+    def test_set_many_writes_both_tiers(self, get_redis):
+        pipe = get_redis.return_value.pipeline.return_value.__enter__.return_value
+        self.cache.set_many({1: 'one'})
+        self.assertEqual(self.cache.get_local(1), 'one')
+        pipe.set.assert_called_once_with('test:1', pickle.dumps('one'), ex=600)
+
+    def test_delete_many_clears_both_tiers(self, get_redis):
+        self.cache.l1.set(1, 'one')
+        self.cache.delete_many([1, 2])
+        self.assertIsNone(self.cache.get_local(1))
+        get_redis.return_value.delete.assert_called_once_with('test:1', 'test:2')
+
+
+@mock.patch('core.cache.get_redis')
+class VersionedTieredCacheTest(SimpleTestCase):
+
+    def setUp(self):
+        self.cache = VersionedTieredCache('test', l1_maxsize=10, l1_ttl=60, l2_ttl=600)
+
+    def test_version_is_kept_in_process(self, get_redis):
+        get_redis.return_value.get.return_value = b'3'
+        self.assertEqual(self.cache.get_version(), 3)
+        self.assertEqual(self.cache.get_version(), 3)
+        get_redis.return_value.get.assert_called_once_with('test:version')
+
+    def test_redis_error_uses_last_read_version(self, get_redis):
+        with self.assertLogs('core.cache', 'ERROR'):
+            get_redis.return_value.get.side_effect = redis.ConnectionError
+            self.assertEqual(self.cache.get_version(), 0)
+
+            get_redis.return_value.get.side_effect = None
+            get_redis.return_value.get.return_value = b'3'
+            self.assertEqual(self.cache.get_version(), 3)
+
+            # process 의 version 이 만료된 후 Redis 를 읽지 못하면 마지막으로 읽은 값을 사용합니다.
+            self.cache._version.clear()
+            get_redis.return_value.get.side_effect = redis.ConnectionError
+            self.assertEqual(self.cache.get_version(), 3)
+
+    def test_bump_version(self, get_redis):
+        get_redis.return_value.incr.return_value = 4
+        self.assertEqual(self.cache.bump_version(), 4)
+        get_redis.return_value.incr.assert_called_once_with('test:version')
+        self.assertEqual(self.cache.get_version(), 4)
+        get_redis.return_value.get.assert_not_called()
+
+    def test_get_or_load_many_reloads_other_versions(self, get_redis):
+        get_redis.return_value.get.return_value = b'2'
+        self.cache.l1.set(1, {'value': 'old', 'version': 1})
+        self.cache.l1.set(2, {'value': 'two', 'version': 2})
+        get_redis.return_value.mget.return_value = [None]
+        load = mock.Mock(return_value={1: {'value': 'one', 'version': 2}})
+        self.assertEqual(self.cache.get_or_load_many({1, 2, 3}, load),
+                         {1: {'value': 'one', 'version': 2}, 2: {'value': 'two', 'version': 2}})
+        load.assert_called_once_with({1, 3}, 2)
+        self.assertEqual(self.cache.get_local(1), {'value': 'one', 'version': 2})
+
+
+class MonthTest(SimpleTestCase):
+
+    def test_month_start(self):
+        self.assertEqual(month_start(datetime.datetime(2020, 3, 15, 12, 30)), datetime.datetime(2020, 3, 1))
+
+    def test_add_months_crosses_year(self):
+        self.assertEqual(add_months(datetime.datetime(2020, 11, 1), 3), datetime.datetime(2021, 2, 1))
+        self.assertEqual(add_months(datetime.datetime(2020, 1, 1), -1), datetime.datetime(2019, 12, 1))
+
+
+class KeysetCursorTest(SimpleTestCase):
+
+    def setUp(self):
+        self.pagination = SiiotKeysetPagination()
+        self.pagination.ordering = ('-created_at', '-id')
+
+    def request(self, **params):
+        return Request(APIRequestFactory().get('/', params))
+
+    def test_cursor_round_trip(self):
+        cursor = Cursor(offset=0, reverse=True, position=('2020-03-01 10:00:00', '42'))
+        encoded = self.pagination.encode_cursor(cursor)
+        decoded = self.pagination.decode_cursor(self.request(cursor=encoded))
+        self.assertEqual(decoded, cursor)
+
+    def test_invalid_cursor(self):
+        with self.assertRaises(NotFound):
+            self.pagination.decode_cursor(self.request(cursor='not-a-cursor'))
+
+    def test_keyset_filter_breaks_ties_with_id(self):
+        q = self.pagination.get_keyset_filter(ChatMessage, ('-created_at', '-id'), ('2020-03-01 10:00:00', '42'))
+        value = datetime.datetime(2020, 3, 1, 10)
+        self.assertEqual(q.connector, 'OR')
+        self.assertEqual(q.children[0], ('created_at__lt', value))
+        self.assertEqual(sorted(q.children[1].children), [('created_at', value), ('id__lt', 42)])
+
+    def test_keyset_filter_ascending(self):
+        q = self.pagination.get_keyset_filter(ChatMessage, ('created_at', 'id'), ('2020-03-01 10:00:00', '42'))
+        value = datetime.datetime(2020, 3, 1, 10)
+        self.assertEqual(q.children[0], ('created_at__gt', value))
+        self.assertEqual(sorted(q.children[1].children), [('created_at', value), ('id__gt', 42)])
+
+    def test_invalid_position(self):
+        with self.assertRaises(NotFound):
+            self.pagination.get_keyset_filter(ChatMessage, ('-created_at', '-id'), ('yesterday', '42'))
+
+    def test_first_page_request(self):
+        self.assertTrue(self.pagination.is_first_page_request(self.request()))
+        self.assertFalse(self.pagination.is_first_page_request(self.request(before=1)))
+
+
+class FingerprintTest(SimpleTestCase):
+
+    def test_collapses_literals(self):
+        key, normalized = fingerprint("SELECT * FROM t WHERE id = 42 AND name = 'a''b'  AND price > 1.5")
+        self.assertEqual(normalized, 'SELECT * FROM t WHERE id = ? AND name = ? AND price > ?')
+        self.assertEqual(key, fingerprint("SELECT *  FROM t WHERE id = 7 AND name = 'x' AND price > 3")[0])
+
+    def test_collapses_in_lists_of_any_length(self):
+        keys = {fingerprint(sql)[0] for sql in ('SELECT * FROM t WHERE id IN (%s)',
+                                                'SELECT * FROM t WHERE id IN (%s, %s, %s)',
+                                                'SELECT * FROM t WHERE id IN (1)',
+                                                'SELECT * FROM t WHERE id IN (1, 2)')}
+        self.assertEqual(len(keys), 1)
+        self.assertEqual(fingerprint('SELECT * FROM t WHERE id IN (1, 2)')[1], 'SELECT * FROM t WHERE id IN (...)')
+
+    def test_different_statements(self):
+        self.assertNotEqual(fingerprint('SELECT * FROM a WHERE id = 1')[0],
+                            fingerprint('SELECT * FROM b WHERE id = 1')[0])
+
+
+@override_settings(METRICS_SAMPLE_RATE=0.5, METRICS_FLUSH_INTERVAL=3600)
+class QueryMetricsTest(SimpleTestCase):
+
+    def setUp(self):
+        self.metrics = QueryMetrics()
+
+    def run_request(self, endpoint, statements):
+        with self.metrics.record(endpoint):
+            for sql in statements:
+                _record_query(lambda *args: None, sql, None, False, {})
+
+    @mock.patch('core.metrics.random.random')
+    def test_only_sampled_requests_record_queries(self, random):
+        random.return_value = 0.7
+        self.run_request('GET a', ['SELECT 1', 'SELECT 2'])
+        random.return_value = 0.2
+        self.run_request('GET a', ['SELECT 3'])
+        totals = self.metrics._totals['GET a']
+        self.assertEqual((totals.requests, totals.sampled, totals.queries), (2, 1, 1))
+        self.assertEqual(totals.buckets[0], 1)
+        self.assertEqual([normalized for _, normalized in totals.slowest.values()], ['SELECT ?'])
+
+    @mock.patch('core.metrics.get_redis')
+    @mock.patch('core.metrics.random.random', return_value=0.0)
+    def test_flush_trims_slowest(self, random, get_redis):
+        self.run_request('GET a', ['SELECT * FROM a'])
+        self.run_request('GET b', [])
+        self.metrics.flush()
+        pipe = get_redis.return_value.pipeline.return_value
+        set_slowest = get_redis.return_value.register_script.return_value
+        key, _ = fingerprint('SELECT * FROM a')
+        self.assertEqual(set_slowest.call_args[1]['keys'], ['metrics:endpoint:GET a:slowest'])
+        self.assertEqual((set_slowest.call_args[1]['args'][1], set_slowest.call_args[1]['client']), (key, pipe))
+        # statement 가 없는 endpoint 는 trim 하지 않습니다.
+        pipe.zremrangebyrank.assert_called_once_with('metrics:endpoint:GET a:slowest', 0,
+                                                     -SLOWEST_STATEMENTS_KEPT - 1)
+        pipe.execute.assert_called_once_with()
+        self.assertEqual(self.metrics._totals, {})
+
+    @mock.patch('core.metrics.get_redis')
+    def test_flush_drops_totals_on_redis_error(self, get_redis):
+        get_redis.return_value.pipeline.return_value.execute.side_effect = redis.ConnectionError
+        self.run_request('GET a', [])
+        with self.assertLogs('core.metrics', 'WARNING'):
+            self.metrics.flush()
+        self.assertEqual(self.metrics._totals, {})
+
+
+def presigned_url(operation, Params, ExpiresIn):
+    return 'https://%s.s3.amazonaws.com/%s?X-Amz-Expires=%s' % (Params['Bucket'], Params['Key'], ExpiresIn)
+
+
+@mock.patch('core.cache.get_redis')
+@mock.patch('core.resolvers.get_s3_client')
+@mock.patch('core.resolvers.time.time', return_value=1000.0)
+class PresignedURLResolverTest(SimpleTestCase):
+
+    def setUp(self):
+        self.resolver = PresignedURLResolver(expires_in=3600, refresh_margin=600, key_bucket='images')
+        self.key = uuid.UUID('12345678123456781234567812345678')
+
+    def sign(self, get_s3_client):
+        generate = get_s3_client.return_value.generate_presigned_url
+        generate.side_effect = presigned_url
+        return generate
+
+    def test_batches_and_signs_each_object_once(self, now, get_s3_client, get_redis):
+        generate = self.sign(get_s3_client)
+        other = uuid.uuid4()
+        get_redis.return_value.mget.return_value = [None, None]
+        urls = self.resolver.resolve_many([self.key, None, other, self.key])
+        self.assertEqual(urls[0], 'https://images.s3.amazonaws.com/%s.jpg?X-Amz-Expires=3600' % self.key)
+        self.assertEqual((urls[1], urls[3]), (None, urls[0]))
+        self.assertEqual(generate.call_count, 2)
+        # cache 는 MGET 한번으로 읽고 pipeline 한번으로 씁니다.
+        get_redis.return_value.mget.assert_called_once()
+        pipe = get_redis.return_value.pipeline.return_value.__enter__.return_value
+        self.assertEqual(pipe.set.call_count, 2)
+        pipe.execute.assert_called_once_with()
+        self.assertEqual(self.resolver.cache.get_local('images/%s.jpg' % self.key), (urls[0], 1000.0 + 3600))
+
+    def test_reuses_url_until_refresh_margin(self, now, get_s3_client, get_redis):
+        generate = self.sign(get_s3_client)
+        cache_key = 'images/%s.jpg' % self.key
+        self.resolver.cache.l1.set(cache_key, ('cached', 1000.0 + 601))
+        self.assertEqual(self.resolver.resolve(self.key), 'cached')
+        generate.assert_not_called()
+
+        # 만료 refresh_margin 초 전부터는 client 가 쓸 시간이 부족하므로 다시 서명합니다.
+        self.resolver.cache.l1.set(cache_key, ('cached', 1000.0 + 600))
+        self.assertNotEqual(self.resolver.resolve(self.key), 'cached')
+        generate.assert_called_once()
+
+    def test_rewrites_host_to_cdn(self, now, get_s3_client, get_redis):
+        self.sign(get_s3_client)
+        get_redis.return_value.mget.return_value = [None]
+        resolver = PresignedURLResolver(cdn_host='https://cdn.example.com/img', key_bucket='images')
+        self.assertEqual(resolver.resolve(self.key),
+                         'https://cdn.example.com/img/%s.jpg?X-Amz-Expires=3600' % self.key)
+
+    def test_non_s3_storage_uses_storage_url(self, now, get_s3_client, get_redis):
+        with mock.patch('core.resolvers.default_storage', FileSystemStorage(base_url='/media/')):
+            self.assertEqual(self.resolver.resolve_many(['a.jpg', '']), ['/media/a.jpg', None])
+        get_s3_client.assert_not_called()
+
+
+class NonClosingFileTest(SimpleTestCase):
+
+    def test_close_leaves_file_open(self):
+        content = io.BytesIO(b'line1\nline2\n')
+        wrapped = NonClosingFile(content)
+        self.assertEqual(wrapped.read(5), b'line1')
+        wrapped.close()
+        self.assertFalse(wrapped.closed)
+        self.assertFalse(content.closed)
+        content.seek(0)
+        self.assertEqual(list(wrapped), [b'line1\n', b'line2\n'])
+
+
+@override_settings(AWS_S3_MULTIPART_THRESHOLD=16, AWS_S3_MULTIPART_CHUNKSIZE=8, AWS_S3_MAX_CONCURRENCY=2)
+class CustomS3Boto3StorageTest(SimpleTestCase):
+
+    def test_transfer_config(self):
+        config = build_transfer_config()
+        self.assertEqual((config.multipart_threshold, config.multipart_chunksize, config.max_concurrency),
+                         (16, 8, 2))
+        self.assertEqual(config.max_in_memory_upload_chunks, 2)
+
+    @mock.patch.object(CustomS3Boto3Storage, 'bucket', new_callable=mock.PropertyMock)
+    def test_save_uploads_without_copy(self, bucket):
+        storage = CustomS3Boto3Storage()
+        content = io.BytesIO(b'image')
+        content.read()
+        with mock.patch('SIIOT_chat_server.storage.build_transfer_config') as transfer_config:
+            name = storage._save('a.jpg', content)
+        self.assertEqual(name, 'a.jpg')
+        obj = bucket.return_value.Object.return_value
+        (fileobj,), kwargs = obj.upload_fileobj.call_args
+        self.assertIsInstance(fileobj, NonClosingFile)
+        self.assertIs(fileobj._file, content)
+        self.assertIs(kwargs['Config'], transfer_config.return_value)
+        # upload 전에 처음으로 돌려 놓고, upload 후에도 content 를 닫지 않습니다.
+        self.assertEqual(content.tell(), 0)
+        self.assertFalse(content.closed)
@@ -0,0 +1,25 @@
+import redis
+from django.http import HttpResponse
+from rest_framework.authentication import SessionAuthentication
+from rest_framework.permissions import IsAdminUser
+from rest_framework.views import APIView
+
+from accounts.authentication import CachedTokenAuthentication
+from core.metrics import query_metrics, prometheus_text
+
+
+class MetricsView(APIView):
+    """
+    endpoint 별 DB query 지표(core.metrics) 를 Prometheus text format 으로 보여줍니다. staff 만 볼 수 있습니다.
+    Prometheus 는 staff 계정의 token 을 Authorization: Token <key> header 로 보내고,
+    staff panel 에 login 한 경우에는 browser 로도 볼 수 있습니다.
+    """
+    authentication_classes = (CachedTokenAuthentication, SessionAuthentication)
+    permission_classes = (IsAdminUser,)
+
+    def get(self, request, *args, **kwargs):
+        try:
+            collected = query_metrics.collect()
+        except redis.RedisError:
+            return HttpResponse('metrics backend unavailable\n', status=503, content_type='text/plain')
+        return HttpResponse(prometheus_text(collected), content_type='text/plain; version=0.0.4; charset=utf-8')
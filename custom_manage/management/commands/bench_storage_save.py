@@ -0,0 +1,62 @@
+import os
+import tempfile
+import time
+import tracemalloc
+import uuid
+
+from django.conf import settings
+from django.core.files import File
+from django.core.files.base import ContentFile
+from django.core.management.base import BaseCommand
+from django.utils.module_loading import import_string
+
+MB = 1024 * 1024
+
+
+class Command(BaseCommand):
+    """
+    storage 에 file 을 저장할 때의 Python memory 최대 사용량(tracemalloc peak) 과 시간을 크기별로 잽니다.
+    - stream : 지금의 CustomS3Boto3Storage._save (content 를 NonClosingFile 로 감싸 multipart upload 로 바로 보냄)
+    - spooled_copy : 예전 _save_content 처럼 content 전체를 SpooledTemporaryFile 에 복사한 후 올림
+    file 은 disk 의 임시 file 에서 읽고, 올린 object 는 측정 후 지웁니다.
+    local S3 (settings.AWS_S3_ENDPOINT_URL, minio 등) 또는 개발용 bucket 에서만 사용합니다.
+    - ex : python manage.py bench_storage_save --sizes 1 20 200
+    """
+    help = 'Measure peak memory and time of saving files of several sizes through the media storage.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', type=int, nargs='*', default=[1, 20, 200], help='file 크기 (MB)')
+        parser.add_argument('--storage', default=settings.DEFAULT_FILE_STORAGE, help='측정할 storage class 경로')
+
+    def handle(self, *args, **options):
+        storage = import_string(options['storage'])()
+        # client / resource 를 만드는 memory 가 첫 측정에 들어가지 않도록 작은 file 을 한번 올려 둡니다.
+        storage.delete(storage.save('bench/warmup.bin', ContentFile(b'warmup')))
+        self.stdout.write('part size {}MB, concurrency {}'.format(
+            settings.AWS_S3_MULTIPART_CHUNKSIZE // MB, settings.AWS_S3_MAX_CONCURRENCY))
+        for size in options['sizes']:
+            with tempfile.TemporaryFile() as source:
+                for _ in range(size):
+                    source.write(os.urandom(MB))
+                for strategy in ('stream', 'spooled_copy'):
+                    source.seek(0)
+                    (peak, elapsed) = self._measure(storage, File(source, name='bench.bin'), strategy)
+                    self.stdout.write('{:>5}MB {:<13} peak={:>8.1f}MB time={:>7.2f}s'.format(
+                        size, strategy, peak / MB, elapsed))
+
+    def _measure(self, storage, content, strategy):
+        name = 'bench/{}.bin'.format(uuid.uuid4().hex)
+        tracemalloc.start()
+        start = time.perf_counter()
+        if strategy == 'spooled_copy':
+            copy = tempfile.SpooledTemporaryFile()
+            copy.write(content.read())
+            content = File(copy, name=content.name)
+        saved_name = storage.save(name, content)
+        elapsed = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        if strategy == 'spooled_copy':
+            content.close()
+        storage.delete(saved_name)
+        return peak, elapsed
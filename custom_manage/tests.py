@@ -0,0 +1,64 @@
+from botocore.exceptions import (ClientError, EndpointConnectionError, ReadTimeoutError, NoCredentialsError,
+                                 ParamValidationError)
+from unittest import mock
+
+from django.test import SimpleTestCase
+
+from custom_manage.utils import S3Uploader, UploadResult, _is_retryable
+
+
+def client_error(code):
+    return ClientError({'Error': {'Code': code}}, 'PutObject')
+
+
+class RetryableErrorTest(SimpleTestCase):
+
+    def test_connection_and_timeout_errors_are_retried(self):
+        self.assertTrue(_is_retryable(EndpointConnectionError(endpoint_url='https://s3')))
+        self.assertTrue(_is_retryable(ReadTimeoutError(endpoint_url='https://s3')))
+        self.assertTrue(_is_retryable(client_error('RequestTimeout')))
+
+    def test_errors_botocore_already_retries_are_not_retried(self):
+        for code in ('500', '503', 'SlowDown', 'Throttling', 'InternalError'):
+            self.assertFalse(_is_retryable(client_error(code)), code)
+
+    def test_permanent_errors_are_not_retried(self):
+        for code in ('AccessDenied', 'NoSuchBucket', 'RequestTimeTooSkewed'):
+            self.assertFalse(_is_retryable(client_error(code)), code)
+        self.assertFalse(_is_retryable(NoCredentialsError()))
+        self.assertFalse(_is_retryable(ParamValidationError(report='bad')))
+
+
+@mock.patch.object(S3Uploader, 'client', new_callable=mock.PropertyMock)
+class UploadAllTest(SimpleTestCase):
+
+    def setUp(self):
+        self.uploader = S3Uploader(bucket='images', max_workers=2, retries=0, backoff=0)
+        self.files = [(mock.Mock(), 'a.jpg'), (mock.Mock(), 'b.jpg'), (mock.Mock(), 'c.jpg')]
+
+    def test_all_uploaded(self, client):
+        results = [UploadResult(name, True, 1, None) for _, name in self.files]
+        with mock.patch.object(self.uploader, 'upload_many', return_value=results) as upload_many:
+            self.assertEqual(self.uploader.upload_all(self.files), results)
+        upload_many.assert_called_once_with(self.files, 'image/jpeg')
+        client.return_value.delete_objects.assert_not_called()
+
+    def test_failure_deletes_uploaded_objects(self, client):
+        error = client_error('AccessDenied')
+        results = [UploadResult('a.jpg', True, 1, None), UploadResult('b.jpg', False, 1, error),
+                   UploadResult('c.jpg', True, 1, None)]
+        with mock.patch.object(self.uploader, 'upload_many', return_value=results), \
+                self.assertRaises(ClientError) as context:
+            self.uploader.upload_all(self.files)
+        self.assertIs(context.exception, error)
+        client.return_value.delete_objects.assert_called_once_with(
+            Bucket='images', Delete={'Objects': [{'Key': 'a.jpg'}, {'Key': 'c.jpg'}], 'Quiet': True})
+
+    def test_delete_error_still_raises_upload_error(self, client):
+        error = client_error('AccessDenied')
+        results = [UploadResult('a.jpg', True, 1, None), UploadResult('b.jpg', False, 1, error)]
+        client.return_value.delete_objects.side_effect = client_error('InternalError')
+        with mock.patch.object(self.uploader, 'upload_many', return_value=results), \
+                self.assertLogs('custom_manage.utils', 'ERROR'), self.assertRaises(ClientError) as context:
+            self.uploader.upload_all(self.files)
+        self.assertIs(context.exception, error)
@@ -1,13 +1,118 @@
-import boto3
-
-from SIIOT_chat_server.loader import load_credential
-
-ACCESS_KEY = load_credential("_AWS_ACCESS_KEY_ID","")
-SECRET_ACCESS_KEY = load_credential("_AWS_SECRET_ACCESS_KEY","")
-
-# s3 client 생성
-def upload_s3(file, name):
-    s3 = boto3.client('s3', aws_access_key_id=ACCESS_KEY, aws_secret_access_key=SECRET_ACCESS_KEY)
-    s3.upload_fileobj(file, 'siiot-media-storage', name, ExtraArgs={
-        "ContentType": 'image/jpeg'
-    })
\ No newline at end of file
+import logging
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from botocore.exceptions import (BotoCoreError, ClientError, EndpointConnectionError, ConnectTimeoutError,
+                                 ConnectionClosedError, ReadTimeoutError)
+from django.conf import settings
+
+from SIIOT_chat_server.loader import load_credential
+from SIIOT_chat_server.storage import NonClosingFile, build_transfer_config
+from core.s3 import get_s3_client, get_image_key_bucket
+
+logger = logging.getLogger(__name__)
+
+ACCESS_KEY = load_credential("_AWS_ACCESS_KEY_ID","")
+SECRET_ACCESS_KEY = load_credential("_AWS_SECRET_ACCESS_KEY","")
+
+# botocore 의 retry 를 다 쓴 후에도 다시 시도하는 연결 / timeout error 입니다.
+# (5xx / throttling 은 botocore 가 이미 retry 하고, 그 외 error 는 다시 올려도 같은 결과입니다.)
+RETRYABLE_ERRORS = (EndpointConnectionError, ConnectTimeoutError, ConnectionClosedError, ReadTimeoutError)
+RETRYABLE_ERROR_CODES = ('RequestTimeout',)  # S3 가 upload body 를 제시간에 받지 못한 경우
+
+# name : object 이름, ok : 성공 여부, attempts : 시도 횟수, error : 마지막 exception (성공하면 None)
+UploadResult = namedtuple('UploadResult', ['name', 'ok', 'attempts', 'error'])
+
+
+def _is_retryable(error):
+    if isinstance(error, ClientError):
+        return error.response.get('Error', {}).get('Code') in RETRYABLE_ERROR_CODES
+    return isinstance(error, RETRYABLE_ERRORS)
+
+
+class S3Uploader(object):
+    """
+    staff 의 상품 image 를 S3 에 올립니다. client 는 process 에서 credential 별로 하나를 같이 쓰고 (core.s3),
+    upload_many 는 file 들을 thread pool 에서 동시에 올립니다.
+    - 큰 file 은 CustomS3Boto3Storage 와 같은 TransferConfig (build_transfer_config) 로 multipart upload 합니다.
+    - 연결 / timeout error 로 실패하면 retries 번까지 backoff x 2^n 초 쉬었다가 다시 올립니다. (_is_retryable)
+    """
+
+    def __init__(self, bucket=None, max_workers=None, retries=None, backoff=None):
+        self.bucket = bucket or get_image_key_bucket()
+        self.max_workers = max_workers or settings.S3_UPLOAD_MAX_WORKERS
+        self.retries = settings.S3_UPLOAD_RETRIES if retries is None else retries
+        self.backoff = settings.S3_UPLOAD_BACKOFF if backoff is None else backoff
+        self.transfer_config = build_transfer_config()
+
+    @property
+    def client(self):
+        return get_s3_client(ACCESS_KEY or None, SECRET_ACCESS_KEY or None)
+
+    def upload(self, file, name, content_type='image/jpeg'):
+        """
+        file 하나를 올리고 UploadResult 를 return 합니다. (exception 을 raise 하지 않습니다.)
+        """
+        attempts = 0
+        while True:
+            attempts += 1
+            try:
+                file.seek(0)
+                self.client.upload_fileobj(NonClosingFile(file), self.bucket, name,
+                                           ExtraArgs={"ContentType": content_type}, Config=self.transfer_config)
+                return UploadResult(name, True, attempts, None)
+            except (BotoCoreError, ClientError) as e:
+                if attempts > self.retries or not _is_retryable(e):
+                    logger.exception('s3 upload failed (%s, %s attempts)', name, attempts)
+                    return UploadResult(name, False, attempts, e)
+                time.sleep(self.backoff * 2 ** (attempts - 1))
+
+    def upload_many(self, files, content_type='image/jpeg'):
+        """
+        :param files: [(file, object 이름)]
+        :return: files 와 같은 순서의 UploadResult list
+        """
+        files = list(files)
+        if not files:
+            return []
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(files))) as executor:
+            futures = [executor.submit(self.upload, file, name, content_type) for (file, name) in files]
+            return [future.result() for future in futures]
+
+    def upload_all(self, files, content_type='image/jpeg'):
+        """
+        upload_many 로 모두 올리고, 하나라도 실패하면 이미 올라간 object 를 지운 후 첫 error 를 raise 합니다.
+        (DB transaction 이 rollback 되어도 어디에서도 쓰지 않는 object 가 bucket 에 남지 않도록)
+        :return: files 와 같은 순서의 UploadResult list (모두 성공)
+        """
+        results = self.upload_many(files, content_type)
+        failed = [result for result in results if not result.ok]
+        if failed:
+            self.delete_many([result.name for result in results if result.ok])
+            raise failed[0].error
+        return results
+
+    def delete_many(self, names):
+        """
+        object 들을 DeleteObjects 한번으로 지웁니다. 지우지 못한 object 는 log 만 남깁니다.
+        """
+        if not names:
+            return
+        try:
+            response = self.client.delete_objects(
+                Bucket=self.bucket, Delete={'Objects': [{'Key': name} for name in names], 'Quiet': True})
+        except (BotoCoreError, ClientError):
+            logger.exception('s3 delete failed (%s)', ', '.join(names))
+            return
+        for error in response.get('Errors', []):
+            logger.error('s3 delete failed (%s, %s)', error.get('Key'), error.get('Code'))
+
+
+uploader = S3Uploader()
+
+
+def upload_s3(file, name):
+    result = uploader.upload(file, name)
+    if not result.ok:
+        raise result.error
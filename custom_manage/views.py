@@ -8,7 +8,7 @@ from core.permissions import StaffPermission
 from crawler.models import CrawlProduct
 from custom_manage.forms import UploadRequestForm, InitialProductUploadForm, ProductImagesUploadForm, \
     ProductInfoUploadForm
-from custom_manage.utils import upload_s3
+from custom_manage.utils import uploader
 from products.models import ProductUploadRequest, Product, ProductImages, ProductStatus, ProdThumbnail
 from products.slack import slack_message
 from products.supplymentary.models import PurchasedTime
@@ -168,11 +168,11 @@ class ProductImagesUploadTemplateView(DetailView):
             _image_key_list.append(image_key)
             _key_list.append(key)
 
+        # image 들을 동시에 올리고, 하나라도 실패하면 올라간 image 를 지운 후 transaction 을 rollback 합니다.
+        uploader.upload_all(zip(files, _image_key_list))
+
         image_save_list = []
         for i, f in enumerate(files):
-
-            upload_s3(f, _image_key_list[i])
-
             image_save_list.append(ProductImages(
                 product=product,
                 image_key=_key_list[i]
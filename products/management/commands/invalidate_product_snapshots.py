@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+
+from products.snapshots import product_snapshot_cache, invalidate_product_snapshots
+
+
+class Command(BaseCommand):
+    """
+    채팅방 header 의 product snapshot cache 를 무효화합니다. (products.snapshots)
+    product 는 main 서버가 수정하므로 이 서버의 signal 로는 알 수 없는 변경이 있을 때 사용합니다.
+    - --product : 해당 product 의 snapshot 만 지웁니다.
+    - 생략 : snapshot version 을 올려 모든 snapshot 을 무효화합니다.
+    - ex : python manage.py invalidate_product_snapshots --product 10 11
+    """
+    help = 'Invalidate cached product snapshots used by chat room headers.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--product', type=int, nargs='*', help='snapshot 을 지울 product id')
+
+    def handle(self, *args, **options):
+        if options['product']:
+            invalidate_product_snapshots(options['product'])
+            self.stdout.write(self.style.SUCCESS('invalidated {} product snapshots'.format(len(options['product']))))
+        else:
+            version = product_snapshot_cache.bump_version()
+            self.stdout.write(self.style.SUCCESS('product snapshot version is now {}'.format(version)))
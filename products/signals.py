@@ -0,0 +1,20 @@
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from products.models import Product, ProductStatus, ProdThumbnail
+from products.snapshots import invalidate_product_snapshot
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+def product_changed(sender, instance, **kwargs):
+    invalidate_product_snapshot(instance.pk)
+
+
+@receiver(post_save, sender=ProductStatus)
+@receiver(post_delete, sender=ProductStatus)
+@receiver(post_save, sender=ProdThumbnail)
+@receiver(post_delete, sender=ProdThumbnail)
+def product_detail_changed(sender, instance, **kwargs):
+    # sold / hiding, thumbnail 이 바뀌어도 snapshot 을 다시 만듭니다.
+    invalidate_product_snapshot(instance.product_id)
@@ -0,0 +1,61 @@
+from django.conf import settings
+
+from core.cache import VersionedTieredCache
+from core.resolvers import resolve_many
+from products.models import Product
+
+# product id -> snapshot ({'id', 'name', 'price', 'thumbnail', 'sold', 'hiding', 'version'})
+# thumbnail 은 storage 의 file 이름이고, url 은 꺼낼 때 만듭니다. (presigned url 은 만료되므로)
+# version 을 올리면 (bump_version) 모든 snapshot 이 한번에 무효화됩니다. (thumbnail storage 변경, main 서버의 일괄 수정 등)
+product_snapshot_cache = VersionedTieredCache('products:snapshot',
+                                              l1_maxsize=settings.PRODUCT_SNAPSHOT_CACHE_SIZE,
+                                              l1_ttl=settings.PRODUCT_SNAPSHOT_CACHE_L1_TTL,
+                                              l2_ttl=settings.PRODUCT_SNAPSHOT_CACHE_TTL)
+
+
+def build_snapshot(product, version):
+    """
+    채팅방 header 에 필요한 product 정보입니다. thumbnail / status 가 없는 product 도 만들 수 있습니다.
+    """
+    thumbnail = getattr(product, 'prodthumbnail', None)
+    status = getattr(product, 'status', None)
+    return {
+        'id': product.id,
+        'name': product.name,
+        'price': product.price,
+        'thumbnail': thumbnail.thumbnail.name if thumbnail is not None and thumbnail.thumbnail else None,
+        'sold': status.sold if status is not None else False,
+        'hiding': status.hiding if status is not None else False,
+        'version': version,
+    }
+
+
+def _load_snapshots(product_ids, version):
+    products = Product.objects.filter(id__in=product_ids).select_related('prodthumbnail', 'status')
+    return {product.id: build_snapshot(product, version) for product in products}
+
+
+def get_product_snapshots(product_ids):
+    """
+    여러 product 의 snapshot 을 한번에 가져옵니다. (process LRU -> Redis MGET -> 없는 product 만 DB 한번)
+    thumbnail url 은 resolve_many 로 한번에 만들어 image_url 에 넣습니다.
+    :return: {product_id: snapshot} (None / 없는 product 는 포함되지 않습니다.)
+    """
+    product_ids = {product_id for product_id in product_ids if product_id is not None}
+    if not product_ids:
+        return {}
+    snapshots = product_snapshot_cache.get_or_load_many(product_ids, _load_snapshots)
+    urls = resolve_many(snapshot['thumbnail'] for snapshot in snapshots.values())
+    return {product_id: dict(snapshot, image_url=url) for (product_id, snapshot), url in zip(snapshots.items(), urls)}
+
+
+def get_product_snapshot(product_id):
+    return get_product_snapshots([product_id]).get(product_id)
+
+
+def invalidate_product_snapshot(product_id):
+    product_snapshot_cache.delete(product_id)
+
+
+def invalidate_product_snapshots(product_ids):
+    product_snapshot_cache.delete_many(product_ids)
@@ -0,0 +1,74 @@
+import bisect
+import hashlib
+import time
+
+from channels_redis.core import RedisChannelLayer
+
+from realtime.metrics import realtime_metrics
+
+
+def get_host_name(host):
+    """
+    ring 위에서 host 를 구분하는 이름입니다. (decode_hosts 가 만든 kwargs 의 address)
+    host 순서가 바뀌어도 같은 이름이면 같은 자리를 가집니다.
+    """
+    address = host['address']
+    if isinstance(address, (list, tuple)):
+        return '{}:{}'.format(*address)
+    return str(address)
+
+
+def _hash(value):
+    return int.from_bytes(hashlib.md5(value).digest()[:8], 'big')
+
+
+def build_ring(host_names, replicas):
+    """
+    host 마다 virtual node 를 replicas 개씩 ring 에 올립니다.
+    :return: (정렬된 ring point list, point 별 host index list)
+    """
+    ring = sorted((_hash('{}#{}'.format(name, i).encode('utf8')), index)
+                  for index, name in enumerate(host_names) for i in range(replicas))
+    return [point for point, _ in ring], [index for _, index in ring]
+
+
+class ShardedRedisChannelLayer(RedisChannelLayer):
+    """
+    여러 Redis host 에 group / channel 을 consistent hash ring 으로 나눠 저장하는 channel layer 입니다.
+    RedisChannelLayer 는 crc32 를 host 수로 나눠 shard 를 고르기 때문에 host 를 하나 추가하면 거의 모든 key 의 shard 가
+    바뀌지만, ring 을 사용하면 약 1/N 만 새 host 로 옮겨갑니다. (옮겨갈 group 은 rebalance_channel_layer 로 이동합니다.)
+    - group (chat_<room_id>) 은 항상 host 하나에만 있으므로 방 안의 message 순서는 Redis 한대일 때와 같습니다.
+    - process 별 channel (specific.<prefix>!<local>) 은 '!' 앞부분으로 host 를 고릅니다. send / receive / group_send 가
+      모두 같은 host 를 보도록 local 부분은 hash 하지 않습니다.
+    - CONFIG : {'hosts': [...], 'ring_replicas': 160, ...RedisChannelLayer 의 나머지 option}
+    - group_send 시간은 realtime.metrics 의 siiot_channel_group_send_seconds 에 기록합니다.
+    """
+
+    def __init__(self, hosts=None, ring_replicas=160, **kwargs):
+        super().__init__(hosts=hosts, **kwargs)
+        self.ring_replicas = ring_replicas
+        self.host_names = [get_host_name(host) for host in self.hosts]
+        self._ring_points, self._ring_nodes = build_ring(self.host_names, ring_replicas)
+
+    async def group_send(self, group, message):
+        start = time.perf_counter()
+        try:
+            await super().group_send(group, message)
+        finally:
+            realtime_metrics.group_send.observe(time.perf_counter() - start)
+
+    def consistent_hash(self, value):
+        if isinstance(value, bytes):
+            value = value.decode('utf8')
+        if '!' in value:
+            value = self.non_local_name(value)
+        index = bisect.bisect(self._ring_points, _hash(value.encode('utf8')))
+        return self._ring_nodes[index % len(self._ring_nodes)]
+
+    def group_name_from_key(self, key):
+        """
+        Redis 의 group key 에서 group 이름을 꺼냅니다. (_group_key 의 반대)
+        """
+        if isinstance(key, bytes):
+            key = key.decode('utf8')
+        return key[len(self._group_key('').decode('utf8')):]
@@ -0,0 +1,63 @@
+import json
+import time
+from datetime import datetime
+
+from channels_redis.core import RedisChannelLayer
+from django.core.management.base import BaseCommand
+
+from chat.send_utils import encode_event
+
+
+class Command(BaseCommand):
+    """
+    group broadcast 한번에서 수신자 한명당 드는 CPU 시간을 event 형식별로 비교합니다. (Redis 연결은 필요 없습니다.)
+    수신자마다 channel layer serialize -> deserialize -> consumer 가 client 로 보낼 text 생성 순서로 처리합니다.
+    - legacy : payload dict 를 event 로 보내고 consumer 가 json.dumps(event)
+    - frame : sender 가 encode_event 로 한번 encode 하고 consumer 는 event['frame'] 을 그대로 전달
+    - ex : python manage.py bench_broadcast_encode --recipients 1000 --text-length 200
+    """
+    help = 'Measure per-recipient CPU of legacy vs pre-encoded group events.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--recipients', type=int, default=1000, help='broadcast 한번의 수신자 수')
+        parser.add_argument('--rounds', type=int, default=20, help='반복할 broadcast 수')
+        parser.add_argument('--text-length', type=int, default=200, help='message text 길이')
+
+    def handle(self, *args, **options):
+        layer = RedisChannelLayer()
+        payload = {
+            'type': 'chat_message',
+            'message_type': 1,
+            'message': '가' * options['text_length'],
+            'owner': 1,
+            'created_at': str(datetime.now()),
+            'message_image_url': ''
+        }
+
+        def legacy():
+            event = dict(payload)
+            for _ in range(options['recipients']):
+                received = layer.deserialize(layer.serialize(event))
+                json.dumps(received)
+
+        def frame():
+            event = encode_event(payload)
+            for _ in range(options['recipients']):
+                received = layer.deserialize(layer.serialize(event))
+                received['frame']
+
+        legacy_frame = json.dumps(payload)
+        if json.loads(encode_event(payload)['frame']) != json.loads(legacy_frame):
+            raise AssertionError('pre-encoded frame differs from legacy frame')
+
+        results = {}
+        for name, broadcast in (('legacy', legacy), ('frame', frame)):
+            start = time.process_time()
+            for _ in range(options['rounds']):
+                broadcast()
+            elapsed = time.process_time() - start
+            results[name] = elapsed / (options['rounds'] * options['recipients'])
+            self.stdout.write('{:<7} {:.2f}us / recipient'.format(name, results[name] * 1000000))
+
+        self.stdout.write(self.style.SUCCESS('frame is {:.1f}x cheaper per recipient'.format(
+            results['legacy'] / results['frame'])))
@@ -0,0 +1,84 @@
+import json
+import time
+
+from asgiref.sync import async_to_sync
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.core.management.base import BaseCommand, CommandError
+from rest_framework.test import APIClient
+
+from accounts.models import User
+from chat.models import ChatRoom
+from core.stats import percentile
+from realtime.websocket.routing import websocket_urlpatterns
+
+
+class Command(BaseCommand):
+    """
+    같은 방/유저로 message 를 count 개씩 보내며 두 send 경로의 latency 를 비교합니다.
+    - rest : POST chat/{room_id}/message/ (ChatMessageViewSet.message, in-process APIClient)
+    - websocket : ChatConsumer.receive -> 저장 -> room group broadcast 가 보낸 client 에게 돌아오기까지
+    실제 message 가 저장되므로 개발/검증용 DB 에서만 사용합니다.
+    rest 경로는 in-process 로 측정하기 때문에 실제 HTTP round trip 과 uwsgi worker 대기 시간은 포함되지 않습니다.
+    - ex : python manage.py bench_send_path --room 1 --user 3 --count 200
+    """
+    help = 'Benchmark the REST message path against the websocket-native send path.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--room', type=int, required=True, help='message 를 보낼 ChatRoom id')
+        parser.add_argument('--user', type=int, required=True, help='방 참여자 User id')
+        parser.add_argument('--count', type=int, default=200, help='경로별로 보낼 message 수')
+
+    def handle(self, *args, **options):
+        room = ChatRoom.objects.filter(pk=options['room']).first()
+        user = User.objects.filter(pk=options['user']).first()
+        if room is None or user is None or room.get_participant_role(user) is None:
+            raise CommandError('--user must be a participant of --room')
+
+        count = options['count']
+        self._report('rest', self._bench_rest(room, user, count))
+        self._report('websocket', async_to_sync(self._bench_websocket)(room, user, count))
+
+    def _bench_rest(self, room, user, count):
+        client = APIClient()
+        client.force_authenticate(user)
+        url = '/chat/{}/message/'.format(room.pk)
+        latencies = []
+        for i in range(count):
+            start = time.perf_counter()
+            response = client.post(url, {'message_type': 1, 'text': 'bench rest {}'.format(i)}, format='json')
+            latencies.append(time.perf_counter() - start)
+            if response.status_code != 201:
+                raise CommandError('rest send failed ({})'.format(response.status_code))
+        return latencies
+
+    async def _bench_websocket(self, room, user, count):
+        communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), '/ws/chat/{}/'.format(room.pk))
+        communicator.scope['user'] = user
+        connected, _ = await communicator.connect()
+        if not connected:
+            raise CommandError('websocket connect failed')
+
+        latencies = []
+        try:
+            for i in range(count):
+                start = time.perf_counter()
+                await communicator.send_to(text_data=json.dumps({'message_type': 1,
+                                                                  'text': 'bench websocket {}'.format(i)}))
+                event = json.loads(await communicator.receive_from(timeout=10))
+                latencies.append(time.perf_counter() - start)
+                if event.get('type') == 'ERROR':
+                    raise CommandError('websocket send failed ({})'.format(event['error_message']))
+        finally:
+            await communicator.disconnect()
+        return latencies
+
+    def _report(self, name, latencies):
+        total = sum(latencies)
+        self.stdout.write('{:<10} n={} total={:.2f}s throughput={:.1f} msg/s mean={:.2f}ms p50={:.2f}ms '
+                          'p95={:.2f}ms p99={:.2f}ms'.format(
+                              name, len(latencies), total, len(latencies) / total,
+                              total / len(latencies) * 1000,
+                              percentile(latencies, 50) * 1000,
+                              percentile(latencies, 95) * 1000,
+                              percentile(latencies, 99) * 1000))
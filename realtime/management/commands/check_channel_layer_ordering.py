@@ -0,0 +1,90 @@
+import asyncio
+import uuid
+from collections import Counter
+
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.module_loading import import_string
+
+
+class Command(BaseCommand):
+    """
+    channel layer 를 worker 여러개가 함께 쓸 때 방(group) 안의 message 순서가 지켜지는지 확인합니다.
+    worker 마다 channel layer instance(connection pool / client prefix) 를 따로 만들어 여러 process 를 흉내내고,
+    방마다 worker 별로 구독자를 하나씩 group_add 한 후, 방마다 sender 하나가 번호를 붙여 --messages 개를 보냅니다.
+    모든 구독자가 모든 message 를 번호 순서대로 받았는지 확인하고, 방(group) 이 host 별로 어떻게 나뉘었는지 출력합니다.
+    - local : redis-server --port 6380 & redis-server --port 6381 & 후
+      python manage.py check_channel_layer_ordering --host redis://localhost:6380 --host redis://localhost:6381
+    """
+    help = 'Check that messages within a room keep their order across channel layer shards.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', action='append', default=[],
+                            help='settings.CHANNEL_LAYERS 의 hosts 대신 사용할 Redis host (여러번 사용)')
+        parser.add_argument('--workers', type=int, default=4, help='흉내낼 worker(process) 수')
+        parser.add_argument('--rooms', type=int, default=50, help='방 수')
+        parser.add_argument('--messages', type=int, default=100, help='방마다 보낼 message 수')
+
+    def handle(self, *args, **options):
+        layer_settings = settings.CHANNEL_LAYERS['default']
+        layer_class = import_string(layer_settings['BACKEND'])
+        config = dict(layer_settings.get('CONFIG', {}))
+        if options['host']:
+            config['hosts'] = options['host']
+        # worker 의 channel 은 Redis list 하나를 함께 쓰므로, 구독자가 받기 전에 sender 가 먼저 다 보내더라도
+        # ChannelFull 로 버려지지 않도록 capacity 를 늘립니다.
+        config['capacity'] = max(config.get('capacity', 100), options['rooms'] * options['messages'])
+        layers = [layer_class(**config) for _ in range(options['workers'])]
+
+        result = async_to_sync(self._check)(layers, options['rooms'], options['messages'])
+
+        if hasattr(layers[0], 'host_names'):
+            shard_counts = Counter(layers[0].host_names[layers[0].consistent_hash(group)]
+                                   for group in result['groups'])
+            for host_name, count in sorted(shard_counts.items()):
+                self.stdout.write('{} : {} rooms'.format(host_name, count))
+
+        self.stdout.write('received {} / {} messages, {} out of order, {} missing'.format(
+            result['received'], result['expected'], result['out_of_order'], result['missing']))
+        if result['out_of_order'] or result['missing']:
+            raise CommandError('ordering check failed')
+        self.stdout.write(self.style.SUCCESS('ordering preserved'))
+
+    async def _check(self, layers, rooms, messages):
+        run_id = uuid.uuid4().hex[:8]
+        groups = ['ordering_check_{}_{}'.format(run_id, room) for room in range(rooms)]
+        subscribers = []
+        for group in groups:
+            for layer in layers:
+                channel = await layer.new_channel()
+                await layer.group_add(group, channel)
+                subscribers.append((layer, group, channel))
+
+        async def send(room, group):
+            layer = layers[room % len(layers)]
+            for seq in range(messages):
+                await layer.group_send(group, {'type': 'ordering.check', 'seq': seq})
+
+        async def receive(layer, group, channel):
+            received = []
+            try:
+                while len(received) < messages:
+                    message = await asyncio.wait_for(layer.receive(channel), timeout=10)
+                    received.append(message['seq'])
+            except asyncio.TimeoutError:
+                pass
+            await layer.group_discard(group, channel)
+            return received
+
+        receivers = [asyncio.ensure_future(receive(*subscriber)) for subscriber in subscribers]
+        await asyncio.gather(*[send(room, group) for room, group in enumerate(groups)])
+        results = await asyncio.gather(*receivers)
+        for layer in layers:
+            await layer.close_pools()
+
+        out_of_order = sum(1 for received in results for prev, seq in zip(received, received[1:]) if seq <= prev)
+        received = sum(len(received) for received in results)
+        expected = len(subscribers) * messages
+        return {'groups': groups, 'received': received, 'expected': expected,
+                'out_of_order': out_of_order, 'missing': expected - received}
@@ -0,0 +1,360 @@
+import asyncio
+import base64
+import json
+import logging
+import multiprocessing
+import os
+import re
+import struct
+import time
+
+from asgiref.sync import async_to_sync
+from channels.exceptions import ChannelFull
+from channels.layers import get_channel_layer
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.test import override_settings
+from rest_framework.authtoken.models import Token
+
+from chat.models import ChatRoom
+from core.stats import percentile
+from realtime.websocket.routing import websocket_urlpatterns
+
+
+def _rss_kb(pid):
+    """
+    process 의 RSS (kB) 입니다. /proc 이 없는 OS 에서는 None 을 return 합니다.
+    """
+    try:
+        with open('/proc/{}/status'.format(pid)) as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except OSError:
+        return None
+
+
+class ChannelFullLogHandler(logging.Handler):
+    """
+    channels_redis 는 group_send 에서 capacity 를 넘은 channel 을 log 로만 남기므로 log 에서 개수를 셉니다.
+    """
+    pattern = re.compile(r'(\d+) of \d+ channels over capacity')
+
+    def __init__(self, counter):
+        super().__init__()
+        self.counter = counter
+
+    def emit(self, record):
+        match = self.pattern.search(record.getMessage())
+        if match:
+            with self.counter.get_lock():
+                self.counter.value += int(match.group(1))
+
+
+def install_channel_full_counter(counter):
+    """
+    group_send 중 ChannelFull 로 버려진 message 수를 counter(multiprocessing.Value) 에 셉니다.
+    in-memory layer 는 ChannelFull 을 조용히 무시하므로 send 를 감싸서 세고, Redis layer 는 log 로 셉니다.
+    """
+    layer = get_channel_layer()
+    original_send = layer.send
+
+    async def send(channel, message):
+        try:
+            return await original_send(channel, message)
+        except ChannelFull:
+            with counter.get_lock():
+                counter.value += 1
+            raise
+
+    layer.send = send
+    logging.getLogger('channels_redis.core').addHandler(ChannelFullLogHandler(counter))
+
+
+def run_daphne(port, ready, channel_full):
+    """
+    fork 된 process 에서 daphne 를 띄웁니다. (부모 process 의 CHANNEL_LAYERS override 를 그대로 사용합니다.)
+    """
+    from channels.routing import get_default_application
+    from daphne.server import Server
+
+    install_channel_full_counter(channel_full)
+    Server(application=get_default_application(),
+           endpoints=['tcp:port={}:interface=127.0.0.1'.format(port)],
+           signal_handlers=False,
+           verbosity=0,
+           ready_callable=ready.set).run()
+
+
+class CommunicatorClient(object):
+    """
+    WebsocketCommunicator 로 ChatConsumer 를 process 안에서 바로 실행하는 client 입니다.
+    """
+
+    def __init__(self, application, room, user):
+        self.communicator = WebsocketCommunicator(application, '/ws/chat/{}/'.format(room.pk))
+        self.communicator.scope['user'] = user
+
+    async def connect(self):
+        connected, _ = await self.communicator.connect()
+        if not connected:
+            raise ConnectionError('websocket connect rejected')
+
+    async def send(self, text):
+        await self.communicator.send_to(text_data=text)
+
+    async def receive(self, timeout):
+        return await self.communicator.receive_from(timeout=timeout)
+
+    async def disconnect(self):
+        try:
+            await self.communicator.disconnect()
+        except Exception:
+            # receive timeout 으로 이미 취소된 consumer 입니다.
+            pass
+
+
+class DaphneClient(object):
+    """
+    localhost 의 daphne 에 실제 websocket 으로 붙는 최소한의 RFC 6455 client 입니다. (text frame / ping / close 만 처리)
+    channels.testing 이 twisted 를 import 하기 때문에 같은 process 에서 autobahn asyncio client 를 쓸 수 없어
+    asyncio stream 위에 직접 구현합니다.
+    """
+
+    def __init__(self, port, room, token_key):
+        self.port = port
+        self.path = '/ws/chat/{}/'.format(room.pk)
+        self.token_key = token_key
+        self.reader = None
+        self.writer = None
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.open_connection('127.0.0.1', self.port)
+        self.writer.write((
+            'GET {} HTTP/1.1\r\n'
+            'Host: 127.0.0.1:{}\r\n'
+            'Upgrade: websocket\r\n'
+            'Connection: Upgrade\r\n'
+            'Sec-WebSocket-Key: {}\r\n'
+            'Sec-WebSocket-Version: 13\r\n'
+            'Authorization: Token {}\r\n\r\n'
+        ).format(self.path, self.port, base64.b64encode(os.urandom(16)).decode(), self.token_key).encode())
+        response = await self.reader.readuntil(b'\r\n\r\n')
+        if not response.startswith(b'HTTP/1.1 101'):
+            raise ConnectionError(response.split(b'\r\n', 1)[0].decode())
+
+    def _write_frame(self, opcode, payload):
+        # client -> server frame 은 mask 해야 합니다.
+        header = bytes([0x80 | opcode])
+        length = len(payload)
+        if length < 126:
+            header += bytes([0x80 | length])
+        elif length < 65536:
+            header += bytes([0x80 | 126]) + struct.pack('!H', length)
+        else:
+            header += bytes([0x80 | 127]) + struct.pack('!Q', length)
+        mask = os.urandom(4)
+        repeated = (mask * (length // 4 + 1))[:length]
+        masked = (int.from_bytes(payload, 'big') ^ int.from_bytes(repeated, 'big')).to_bytes(length, 'big')
+        self.writer.write(header + mask + masked)
+
+    async def send(self, text):
+        self._write_frame(0x1, text.encode('utf8'))
+
+    async def _read_frame(self):
+        while True:
+            first, second = await self.reader.readexactly(2)
+            opcode = first & 0x0F
+            length = second & 0x7F
+            if length == 126:
+                length = struct.unpack('!H', await self.reader.readexactly(2))[0]
+            elif length == 127:
+                length = struct.unpack('!Q', await self.reader.readexactly(8))[0]
+            payload = await self.reader.readexactly(length)
+            if opcode == 0x1:
+                return payload.decode('utf8')
+            if opcode == 0x8:
+                raise ConnectionError('websocket closed by server')
+            if opcode == 0x9:
+                self._write_frame(0xA, payload)
+
+    async def receive(self, timeout):
+        return await asyncio.wait_for(self._read_frame(), timeout=timeout)
+
+    async def disconnect(self):
+        if self.writer is not None:
+            self._write_frame(0x8, b'')
+            self.writer.close()
+
+
+class Command(BaseCommand):
+    """
+    ChatConsumer 에 client 를 많이 붙여 daphne process 하나가 감당하는 방/socket 수를 측정합니다.
+    방마다 --clients-per-room 개의 client 를 붙이고, 방마다 buyer client 하나가 --messages 개를 보내며
+    방의 모든 client 가 받을 때까지의 fan-out latency 를 잽니다.
+    - mode communicator : WebsocketCommunicator 로 process 안에서 실행 (network / daphne 제외)
+    - mode daphne : daphne 를 fork 해서 127.0.0.1:--port 에 띄우고 실제 websocket 으로 접속 (Token 인증)
+    - layer memory : InMemoryChannelLayer / redis : settings.CHANNEL_LAYERS 그대로
+    report : connect rate, fan-out latency p50/p95/p99, 받지 못한 message 수, ChannelFull 수, connection 당 memory
+    최근 ChatRoom 을 사용하고 실제 message 가 저장되므로(daphne mode 는 Token 도 생성) 개발/검증용 DB 에서만 사용합니다.
+    - ex : python manage.py load_test_websocket --mode daphne --layer redis --rooms 200 --clients-per-room 10
+    """
+    help = 'Drive many simulated websocket clients against ChatConsumer and report fan-out metrics.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--mode', choices=['communicator', 'daphne'], default='communicator')
+        parser.add_argument('--layer', choices=['memory', 'redis'], default='memory')
+        parser.add_argument('--rooms', type=int, default=100, help='사용할 ChatRoom 수 (최근 방부터)')
+        parser.add_argument('--clients-per-room', type=int, default=10, help='방마다 붙일 client 수')
+        parser.add_argument('--messages', type=int, default=10, help='방마다 보낼 message 수')
+        parser.add_argument('--interval', type=float, default=0.05, help='같은 방에서 message 를 보내는 간격 (초)')
+        parser.add_argument('--connect-concurrency', type=int, default=100, help='동시에 진행할 connect 수')
+        parser.add_argument('--capacity', type=int, default=100, help='memory layer 의 channel capacity')
+        parser.add_argument('--timeout', type=float, default=10, help='message 를 기다리는 최대 시간 (초)')
+        parser.add_argument('--port', type=int, default=8765, help='daphne mode 에서 사용할 port')
+
+    def handle(self, *args, **options):
+        rooms = list(ChatRoom.objects.select_related('buyer', 'seller').order_by('-id')[:options['rooms']])
+        if not rooms:
+            raise CommandError('no ChatRoom to use')
+
+        channel_layers = settings.CHANNEL_LAYERS
+        if options['layer'] == 'memory':
+            channel_layers = {'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer',
+                                          'CONFIG': {'capacity': options['capacity']}}}
+
+        with override_settings(CHANNEL_LAYERS=channel_layers):
+            channel_full = multiprocessing.Value('i', 0)
+            daphne = None
+            if options['mode'] == 'daphne':
+                tokens = {user.pk: Token.objects.get_or_create(user=user)[0].key
+                          for room in rooms for user in (room.buyer, room.seller)}
+                connections.close_all()
+                context = multiprocessing.get_context('fork')
+                ready = context.Event()
+                daphne = context.Process(target=run_daphne, args=(options['port'], ready, channel_full), daemon=True)
+                daphne.start()
+                if not ready.wait(30):
+                    daphne.terminate()
+                    raise CommandError('daphne did not start')
+                server_pid = daphne.pid
+
+                def make_client(room, user):
+                    return DaphneClient(options['port'], room, tokens[user.pk])
+            else:
+                install_channel_full_counter(channel_full)
+                application = URLRouter(websocket_urlpatterns)
+                server_pid = os.getpid()
+
+                def make_client(room, user):
+                    return CommunicatorClient(application, room, user)
+
+            try:
+                result = async_to_sync(self._run)(rooms, make_client, server_pid, options)
+            finally:
+                if daphne is not None:
+                    daphne.terminate()
+                    daphne.join(5)
+
+        result['channel_full'] = channel_full.value
+        self._report(result, options)
+
+    async def _run(self, rooms, make_client, server_pid, options):
+        clients_by_room = []
+        for room in rooms:
+            # 첫 client(buyer) 가 message 를 보내고, 나머지는 seller 로 여러 기기에서 접속한 것처럼 붙습니다.
+            users = [room.buyer] + [room.seller] * (options['clients_per_room'] - 1)
+            clients_by_room.append([make_client(room, user) for user in users])
+        clients = [client for room_clients in clients_by_room for client in room_clients]
+
+        rss_before = _rss_kb(server_pid)
+        semaphore = asyncio.Semaphore(options['connect_concurrency'])
+
+        async def connect(client):
+            async with semaphore:
+                try:
+                    await client.connect()
+                    return True
+                except Exception:
+                    return False
+
+        start = time.perf_counter()
+        connected = await asyncio.gather(*[connect(client) for client in clients])
+        connect_seconds = time.perf_counter() - start
+        rss_after = _rss_kb(server_pid)
+
+        send_times = {}
+        latencies = []
+        errors = []
+        expected = options['messages']
+
+        async def send(room, sender):
+            for seq in range(expected):
+                text = 'load {}:{}'.format(room.pk, seq)
+                send_times[text] = time.perf_counter()
+                await sender.send(json.dumps({'message_type': 1, 'text': text}))
+                await asyncio.sleep(options['interval'])
+
+        async def receive(client):
+            received = 0
+            deadline = time.perf_counter() + options['timeout'] + expected * options['interval']
+            while received < expected:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                try:
+                    frame = json.loads(await client.receive(remaining))
+                except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+                    break
+                if frame.get('type') == 'ERROR':
+                    errors.append(frame.get('error_message'))
+                    continue
+                sent_at = send_times.get(frame.get('message'))
+                if sent_at is not None:
+                    latencies.append(time.perf_counter() - sent_at)
+                    received += 1
+            return received
+
+        live = [client for client, ok in zip(clients, connected) if ok]
+        live_ids = {id(client) for client in live}
+        receivers = [asyncio.ensure_future(receive(client)) for client in live]
+        senders = [send(room, room_clients[0]) for room, room_clients in zip(rooms, clients_by_room)
+                   if id(room_clients[0]) in live_ids]
+        await asyncio.gather(*senders)
+        received = await asyncio.gather(*receivers)
+        await asyncio.gather(*[client.disconnect() for client in live])
+
+        connected_count = sum(connected)
+        return {
+            'clients': len(clients),
+            'connected': connected_count,
+            'connect_seconds': connect_seconds,
+            'latencies': latencies,
+            'expected': connected_count * expected,
+            'received': sum(received),
+            'errors': errors,
+            'rss_per_connection': ((rss_after - rss_before) / connected_count
+                                   if rss_before is not None and rss_after is not None and connected_count else None),
+        }
+
+    def _report(self, result, options):
+        self.stdout.write('mode={} layer={} rooms={} clients={}'.format(
+            options['mode'], options['layer'], options['rooms'], result['clients']))
+        self.stdout.write('connect   : {}/{} in {:.2f}s ({:.1f} conn/s)'.format(
+            result['connected'], result['clients'], result['connect_seconds'],
+            result['connected'] / result['connect_seconds'] if result['connect_seconds'] else 0))
+        latencies = result['latencies']
+        if latencies:
+            self.stdout.write('fan-out   : n={} p50={:.2f}ms p95={:.2f}ms p99={:.2f}ms max={:.2f}ms'.format(
+                len(latencies), percentile(latencies, 50) * 1000, percentile(latencies, 95) * 1000,
+                percentile(latencies, 99) * 1000, max(latencies) * 1000))
+        self.stdout.write('delivery  : {}/{} received, {} dropped, {} ChannelFull, {} errors'.format(
+            result['received'], result['expected'], result['expected'] - result['received'],
+            result['channel_full'], len(result['errors'])))
+        if result['rss_per_connection'] is not None:
+            self.stdout.write('memory    : {:.1f} kB RSS / connection{}'.format(
+                result['rss_per_connection'],
+                ' (client 포함)' if options['mode'] == 'communicator' else ''))
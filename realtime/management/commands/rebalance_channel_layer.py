@@ -0,0 +1,76 @@
+import redis
+from channels.layers import get_channel_layer
+from django.core.management.base import BaseCommand, CommandError
+
+from realtime.layers import ShardedRedisChannelLayer
+
+# member 마다 더 최근(score 가 큰) group_add 시각을 남기고 group_expiry 를 다시 설정합니다.
+MERGE_GROUP_SCRIPT = """
+for i = 2, #ARGV, 2 do
+    local current = redis.call('ZSCORE', KEYS[1], ARGV[i + 1])
+    if not current or tonumber(current) < tonumber(ARGV[i]) then
+        redis.call('ZADD', KEYS[1], ARGV[i], ARGV[i + 1])
+    end
+end
+redis.call('EXPIRE', KEYS[1], ARGV[1])
+return 1
+"""
+
+
+def get_sync_client(host):
+    """
+    channel layer 의 host kwargs (address 가 URL 또는 (host, port)) 로 redis-py client 를 만듭니다.
+    """
+    address = host['address']
+    if isinstance(address, str):
+        return redis.Redis.from_url(address, password=host.get('password'))
+    return redis.Redis(host=address[0], port=address[1], db=host.get('db', 0), password=host.get('password'))
+
+
+class Command(BaseCommand):
+    """
+    Redis host 를 추가/제거한 후, 새 hash ring 에서 주인이 바뀐 group key 를 새 host 로 옮깁니다.
+    settings.CHANNEL_LAYERS 에 새 host 목록을 반영해 배포한 직후 실행합니다. 옮기기 전까지 해당 방의 group_send 는
+    옮겨가지 않은 member 에게 전달되지 않습니다. (새 접속 / 재접속한 member 는 이미 새 host 에 group_add 됩니다.)
+    process 별 channel 의 message 는 channel layer expiry(기본 60초) 안에 사라지므로 옮기지 않습니다.
+    - ex : python manage.py rebalance_channel_layer --removed-host redis://10.0.0.3:6379 --dry-run
+    """
+    help = 'Move channel layer group keys to their owner on the current hash ring.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--removed-host', action='append', default=[],
+                            help='ring 에서 뺀 host (group 을 모두 남은 host 로 옮깁니다)')
+        parser.add_argument('--dry-run', action='store_true', help='옮길 group 수만 출력합니다.')
+
+    def handle(self, *args, **options):
+        layer = get_channel_layer()
+        if not isinstance(layer, ShardedRedisChannelLayer):
+            raise CommandError('CHANNEL_LAYERS default backend must be ShardedRedisChannelLayer')
+
+        clients = [get_sync_client(host) for host in layer.hosts]
+        sources = list(zip(layer.host_names, clients))
+        sources += [(address, get_sync_client({'address': address})) for address in options['removed_host']]
+        merge_group = [client.register_script(MERGE_GROUP_SCRIPT) for client in clients]
+        group_key_pattern = layer._group_key('*')
+
+        total = 0
+        for source_name, source in sources:
+            moved = 0
+            for key in source.scan_iter(match=group_key_pattern, count=1000):
+                index = layer.consistent_hash(layer.group_name_from_key(key))
+                if layer.host_names[index] == source_name:
+                    continue
+                moved += 1
+                if options['dry_run']:
+                    continue
+                members = source.zrange(key, 0, -1, withscores=True)
+                if members:
+                    args = [layer.group_expiry]
+                    for member, score in members:
+                        args += [score, member]
+                    merge_group[index](keys=[key], args=args)
+                source.delete(key)
+            total += moved
+            self.stdout.write('{} : {} groups {}'.format(source_name, moved, 'to move' if options['dry_run'] else 'moved'))
+
+        self.stdout.write(self.style.SUCCESS('{} groups {}'.format(total, 'to move' if options['dry_run'] else 'moved')))
@@ -0,0 +1,173 @@
+import asyncio
+import bisect
+import os
+import threading
+import time
+
+from channels.generic.http import AsyncHttpConsumer
+from django.conf import settings
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+FRAME_BYTES_BUCKETS = (64, 128, 256, 512, 1024, 4096, 16384, 65536)
+LOOP_LAG_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1)
+
+
+class Counter(object):
+
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help_text = help_text
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def expose(self):
+        return ['# HELP {} {}'.format(self.name, self.help_text), '# TYPE {} counter'.format(self.name),
+                '{} {}'.format(self.name, self.value)]
+
+
+class Gauge(Counter):
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+    def set(self, value):
+        with self._lock:
+            self.value = value
+
+    def expose(self):
+        return ['# HELP {} {}'.format(self.name, self.help_text), '# TYPE {} gauge'.format(self.name),
+                '{} {}'.format(self.name, self.value)]
+
+
+class Histogram(object):
+    """
+    Prometheus histogram 입니다. bucket 별 개수는 누적하지 않고 저장했다가 expose 할 때 누적합니다.
+    """
+
+    def __init__(self, name, help_text, buckets):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(buckets)
+        self._counts = [0] * (len(self.buckets) + 1)
+        self._sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += value
+
+    def expose(self):
+        with self._lock:
+            counts, total = list(self._counts), self._sum
+        lines = ['# HELP {} {}'.format(self.name, self.help_text), '# TYPE {} histogram'.format(self.name)]
+        cumulative = 0
+        for bound, count in zip(self.buckets + ('+Inf',), counts):
+            cumulative += count
+            lines.append('{}_bucket{{le="{}"}} {}'.format(self.name, bound, cumulative))
+        lines.append('{}_sum {}'.format(self.name, total))
+        lines.append('{}_count {}'.format(self.name, cumulative))
+        return lines
+
+
+class RealtimeMetrics(object):
+    """
+    daphne worker(process) 하나의 websocket / channel layer 지표입니다.
+    worker 마다 따로 모으므로 Prometheus 는 worker 별로 /realtime/metrics/ 를 scrape 합니다. (instance label 로 구분)
+    - event loop lag : settings.REALTIME_LOOP_LAG_INTERVAL 마다 sleep 이 예정보다 늦게 끝난 시간입니다.
+      첫 websocket 접속 또는 첫 scrape 때 process 의 event loop 에 task 를 하나 띄웁니다.
+    """
+
+    def __init__(self):
+        self.connects = Counter('siiot_ws_connects_total', 'Websocket connections accepted.')
+        self.disconnects = Counter('siiot_ws_disconnects_total', 'Websocket connections closed.')
+        self.open_sockets = Gauge('siiot_ws_open_sockets', 'Websocket connections currently open in this process.')
+        self.receive_to_broadcast = Histogram(
+            'siiot_ws_receive_to_broadcast_seconds',
+            'Time from a client message arriving to its group_send completing.', LATENCY_BUCKETS)
+        self.group_send = Histogram('siiot_channel_group_send_seconds', 'Channel layer group_send duration.',
+                                    LATENCY_BUCKETS)
+        self.frame_bytes = Histogram('siiot_ws_frame_bytes', 'Outbound websocket frame size.', FRAME_BYTES_BUCKETS)
+        self.loop_lag = Histogram('siiot_event_loop_lag_seconds', 'Event loop scheduling delay.', LOOP_LAG_BUCKETS)
+        self.last_loop_lag = Gauge('siiot_event_loop_lag_last_seconds', 'Most recent event loop scheduling delay.')
+        self._loop = None
+        self._monitor = None
+
+    def _start(self):
+        # lag 측정 task 는 process 의 event loop 에 하나만 띄웁니다.
+        loop = asyncio.get_event_loop()
+        if self._monitor is None or self._monitor.done() or self._loop is not loop:
+            self._loop = loop
+            self._monitor = asyncio.ensure_future(self._run())
+
+    async def _run(self):
+        interval = settings.REALTIME_LOOP_LAG_INTERVAL
+        while True:
+            start = time.monotonic()
+            await asyncio.sleep(interval)
+            lag = max(time.monotonic() - start - interval, 0)
+            self.loop_lag.observe(lag)
+            self.last_loop_lag.set(lag)
+
+    def prometheus_text(self):
+        lines = []
+        for metric in (self.connects, self.disconnects, self.open_sockets, self.receive_to_broadcast,
+                       self.group_send, self.frame_bytes, self.loop_lag, self.last_loop_lag):
+            lines += metric.expose()
+        return '\n'.join(lines) + '\n'
+
+
+realtime_metrics = RealtimeMetrics()
+
+
+class RealtimeMetricsConsumerMixin(object):
+    """
+    websocket consumer 의 접속 / 종료 / 보낸 frame 크기를 realtime_metrics 에 기록합니다.
+    AsyncWebsocketConsumer 보다 앞에 상속합니다.
+    """
+    _metrics_open = False
+
+    async def accept(self, subprotocol=None):
+        await super().accept(subprotocol)
+        realtime_metrics._start()
+        realtime_metrics.connects.inc()
+        realtime_metrics.open_sockets.inc()
+        self._metrics_open = True
+
+    async def websocket_disconnect(self, message):
+        if self._metrics_open:
+            self._metrics_open = False
+            realtime_metrics.disconnects.inc()
+            realtime_metrics.open_sockets.dec()
+        await super().websocket_disconnect(message)
+
+    async def send(self, text_data=None, bytes_data=None, close=False):
+        if text_data is not None:
+            realtime_metrics.frame_bytes.observe(len(text_data.encode('utf8')))
+        elif bytes_data is not None:
+            realtime_metrics.frame_bytes.observe(len(bytes_data))
+        await super().send(text_data=text_data, bytes_data=bytes_data, close=close)
+
+
+class RealtimeMetricsConsumer(AsyncHttpConsumer):
+    """
+    이 daphne worker 의 realtime_metrics 를 Prometheus text format 으로 보여줍니다. staff 만 볼 수 있습니다.
+    (TokenAuthMiddleware 안에서 사용하고, Prometheus 는 staff 계정의 Authorization: Token <key> header 를 보냅니다.)
+    """
+
+    async def handle(self, body):
+        user = self.scope.get('user')
+        if user is None or not user.is_authenticated or not user.is_staff:
+            await self.send_response(403, b'forbidden\n', headers=[(b'Content-Type', b'text/plain')])
+            return
+        realtime_metrics._start()
+        text = realtime_metrics.prometheus_text()
+        text += '# HELP siiot_process_info Worker process.\n# TYPE siiot_process_info gauge\n'
+        text += 'siiot_process_info{{pid="{}"}} 1\n'.format(os.getpid())
+        await self.send_response(200, text.encode('utf8'),
+                                 headers=[(b'Content-Type', b'text/plain; version=0.0.4; charset=utf-8')])
@@ -1,3 +1,236 @@
-from django.test import TestCase
+import asyncio
+import json
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import AnonymousUser
+from django.test import SimpleTestCase, TransactionTestCase, override_settings
+
+from chat.models import ChatRoom, ChatMessage
+from realtime.layers import ShardedRedisChannelLayer
+from realtime.websocket.consumers import ChatConsumer
+from realtime.websocket.exceptions import InvalidMessageError
+from realtime.websocket.presence import PresenceService
+
+
+class FakeChannelLayer(object):
+
+    def __init__(self):
+        self.sent = []
+
+    async def group_send(self, group, message):
+        self.sent.append((group, message))
+
+
+@override_settings(CHAT_WRITE_BEHIND=False)
+@mock.patch('chat.pipeline.RoomHistoryBuffer')
+class ChatConsumerReceiveTest(TransactionTestCase):
+    # consumer 는 database_sync_to_async 로 다른 thread(connection) 에서 DB 를 읽으므로 transaction 으로 감싸지 않습니다.
+
+    def setUp(self):
+        user_model = get_user_model()
+        self.buyer = user_model.objects.create(nickname='buyer', phone='01000000000')
+        self.seller = user_model.objects.create(nickname='seller', phone='01000000000')
+        self.stranger = user_model.objects.create(nickname='stranger', phone='01000000000')
+        self.room = ChatRoom.objects.create(buyer=self.buyer, seller=self.seller)
+
+    def receive(self, user, text_data, room_name=None):
+        consumer = ChatConsumer({'type': 'websocket'})
+        consumer.user = user
+        consumer.room_name = room_name or str(self.room.pk)
+        consumer.room_group_name = 'chat_%s' % consumer.room_name
+        consumer.channel_layer = FakeChannelLayer()
+        frames = []
+
+        async def send(text_data=None, bytes_data=None, close=False):
+            frames.append(json.loads(text_data))
+
+        consumer.send = send
+        async_to_sync(consumer.receive)(text_data=text_data)
+        return consumer.channel_layer.sent, frames
+
+    def test_saves_and_broadcasts_message(self, history_buffer):
+        sent, frames = self.receive(self.buyer, json.dumps({'message_type': 1, 'text': 'hi'}))
+        message = ChatMessage.objects.get(room=self.room)
+        self.assertEqual((message.text, message.owner_id), ('hi', self.buyer.id))
+        self.assertEqual(frames, [])
+        self.assertEqual([group for group, event in sent], ['chat_%s' % self.room.pk])
+        self.assertEqual(json.loads(sent[0][1]['frame'])['message'], 'hi')
+        self.assertEqual(ChatRoom.objects.get(pk=self.room.pk).seller_unread_count, 1)
+
+    def test_reactivates_room_changed_after_connect(self, history_buffer):
+        self.receive(self.buyer, json.dumps({'text': 'first'}))
+        # connection 중에 상대방이 방을 나가도, 다음 message 는 새로 읽은 flag 로 다시 active 로 바꿉니다.
+        ChatRoom.objects.filter(pk=self.room.pk).update(seller_active=False)
+        self.receive(self.buyer, json.dumps({'message': 'second'}))
+        room = ChatRoom.objects.get(pk=self.room.pk)
+        self.assertEqual((room.seller_active, room.seller_unread_count), (True, 2))
+
+    def assertErrorFrame(self, result, error_code):
+        sent, frames = result
+        self.assertEqual(sent, [])
+        self.assertEqual([frame['error_code'] for frame in frames], [error_code])
+        self.assertEqual(ChatMessage.objects.count(), 0)
+
+    def test_anonymous_user_error(self, history_buffer):
+        self.assertErrorFrame(self.receive(AnonymousUser(), json.dumps({'text': 'hi'})), 1)
+
+    def test_invalid_message_error(self, history_buffer):
+        self.assertErrorFrame(self.receive(self.buyer, 'not json'), 2)
+
+    def test_non_participant_error(self, history_buffer):
+        self.assertErrorFrame(self.receive(self.stranger, json.dumps({'text': 'hi'})), 3)
+
+    def test_unknown_room_error(self, history_buffer):
+        self.assertErrorFrame(self.receive(self.buyer, json.dumps({'text': 'hi'}), room_name='0'), 3)
+
+
+class ChatConsumerParseMessageTest(SimpleTestCase):
+
+    def setUp(self):
+        self.consumer = ChatConsumer({'type': 'websocket'})
+
+    def test_text_message(self):
+        self.assertEqual(self.consumer._parse_message(json.dumps({'message_type': 1, 'text': 'hi'})),
+                         {'message_type': 1, 'text': 'hi'})
+        self.assertEqual(self.consumer._parse_message(json.dumps({'message': 'hi'})),
+                         {'message_type': 1, 'text': 'hi'})
+
+    def test_invalid_messages(self):
+        for text_data in (None, 'not json', '[]', json.dumps({'text': ''}), json.dumps({'text': 1}),
+                          json.dumps({'message_type': 2, 'text': 'hi'})):
+            with self.subTest(text_data=text_data), self.assertRaises(InvalidMessageError):
+                self.consumer._parse_message(text_data)
+
+
+class FakeSortedSetRedis(object):
+    """
+    PresenceService 가 쓰는 sorted set command 만 dict 로 흉내 냅니다. (pipeline 은 바로 실행합니다.)
+    """
+
+    def __init__(self):
+        self.sets = {}
+        self.ttls = {}
+        self.results = []
+
+    def pipeline(self, transaction=True):
+        self.results = []
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def execute(self):
+        return self.results
+
+    def zadd(self, key, mapping):
+        self.sets.setdefault(key, {}).update(mapping)
+
+    def zrem(self, key, member):
+        self.sets.get(key, {}).pop(member, None)
+
+    def zremrangebyscore(self, key, low, high):
+        members = self.sets.get(key, {})
+        for member in [member for member, score in members.items() if score <= high]:
+            del members[member]
+
+    def expire(self, key, ttl):
+        self.ttls[key] = ttl
+
+    def zcount(self, key, low, high):
+        self.results.append(len([score for score in self.sets.get(key, {}).values() if score >= low]))
+
+
+@override_settings(PRESENCE_TTL=60, PRESENCE_HEARTBEAT_INTERVAL=20)
+@mock.patch('realtime.websocket.presence.time.time')
+class PresenceServiceTest(SimpleTestCase):
+
+    def setUp(self):
+        self.redis = FakeSortedSetRedis()
+        patcher = mock.patch('realtime.websocket.presence.get_redis', return_value=self.redis)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.presence = PresenceService()
+        # heartbeat task 는 test 에서 직접 실행합니다.
+        self.presence._start = mock.Mock()
+
+    def test_counts_connections_per_user(self, now):
+        now.return_value = 1000.0
+        for user_id, channel_name in ((1, 'a'), (1, 'b'), (2, 'c')):
+            async_to_sync(self.presence.connect)(user_id, channel_name)
+        self.assertEqual(self.presence.get_connection_counts([1, 2, 3]), {1: 2, 2: 1, 3: 0})
+        self.assertEqual(self.redis.sets['presence:user:1'], {'a': 1060.0, 'b': 1060.0})
+        self.assertEqual(self.redis.ttls['presence:user:1'], 60)
+
+        async_to_sync(self.presence.disconnect)(1, 'a')
+        self.assertEqual(self.presence.get_online_user_ids([1, 2, 3]), {1, 2})
+        async_to_sync(self.presence.disconnect)(2, 'c')
+        self.assertFalse(self.presence.is_online(2))
+        self.assertEqual(self.presence._connections, {'b': 1})
+
+    def test_connection_expires_without_heartbeat(self, now):
+        now.return_value = 1000.0
+        async_to_sync(self.presence.connect)(1, 'a')
+        now.return_value = 1059.0
+        self.assertTrue(self.presence.is_online(1))
+        now.return_value = 1061.0
+        self.assertFalse(self.presence.is_online(1))
+
+    def test_heartbeat_extends_connections(self, now):
+        now.return_value = 1000.0
+        async_to_sync(self.presence.connect)(1, 'a')
+        async_to_sync(self.presence.connect)(2, 'b')
+        # 다른 worker 가 남기고 죽은 connection 은 heartbeat 때 지워집니다.
+        self.redis.zadd('presence:user:1', {'dead': 1010.0})
+
+        sleeps = []
+
+        async def sleep(seconds):
+            if sleeps:
+                raise asyncio.CancelledError
+            sleeps.append(seconds)
+            now.return_value = 1040.0
+
+        with mock.patch('realtime.websocket.presence.asyncio.sleep', sleep), self.assertRaises(asyncio.CancelledError):
+            async_to_sync(self.presence._run)()
+        self.assertEqual(sleeps, [20])
+        self.assertEqual(self.redis.sets['presence:user:1'], {'a': 1100.0})
+
+        now.return_value = 1061.0
+        self.assertEqual(self.presence.get_online_user_ids([1, 2]), {1, 2})
+
+
+class ShardedRedisChannelLayerTest(SimpleTestCase):
+
+    def layer(self, *hosts):
+        return ShardedRedisChannelLayer(hosts=[('redis-%s' % host, 6379) for host in hosts])
+
+    def shards(self, layer, keys):
+        return {key: layer.host_names[layer.consistent_hash(key)] for key in keys}
+
+    def setUp(self):
+        self.groups = ['chat_%s' % room_id for room_id in range(3000)]
+
+    def test_mapping_is_deterministic(self):
+        shards = self.shards(self.layer(1, 2, 3), self.groups)
+        self.assertEqual(self.shards(self.layer(1, 2, 3), self.groups), shards)
+        # host 순서가 바뀌어도 같은 host 를 고릅니다.
+        self.assertEqual(self.shards(self.layer(3, 1, 2), self.groups), shards)
+        self.assertEqual(set(shards.values()), {'redis-1:6379', 'redis-2:6379', 'redis-3:6379'})
+
+    def test_adding_host_moves_about_one_nth(self):
+        before = self.shards(self.layer(1, 2, 3), self.groups)
+        after = self.shards(self.layer(1, 2, 3, 4), self.groups)
+        moved = [key for key in self.groups if before[key] != after[key]]
+        # 옮겨가는 key 는 모두 새 host 로 가고, 그 비율은 약 1/4 입니다.
+        self.assertEqual({after[key] for key in moved}, {'redis-4:6379'})
+        self.assertAlmostEqual(len(moved) / len(self.groups), 1 / 4, delta=0.07)
+
+    def test_process_channels_share_host(self):
+        layer = self.layer(1, 2, 3)
+        self.assertEqual(len({layer.consistent_hash('specific.abc!%s' % local) for local in ('x', 'y', 'z')}), 1)
+        self.assertEqual(layer.consistent_hash(b'specific.abc!x'), layer.consistent_hash('specific.abc!'))
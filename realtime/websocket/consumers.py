@@ -1,30 +1,40 @@
 import json
+import time
 
+from channels.db import database_sync_to_async
 from channels.generic.websocket import AsyncWebsocketConsumer
+from django.conf import settings
+from rest_framework import serializers
+
 from chat.models import ChatRoom, ChatMessage
-from chat.serializers import ChatMessageReadSerializer, ChatMessageWriteSerializer
+from chat.pipeline import create_message
+from chat.send_utils import new_message_event, get_room_group_name
+from chat.write_behind import write_behind
+from core.metrics import QueryMetricsConsumerMixin, query_metrics
+from realtime.metrics import RealtimeMetricsConsumerMixin, realtime_metrics
 
 from .utils import add_user_as_active_websocket, add_user_as_inactive_websocket
-from .exceptions import UserNotLoggedInError
+from .exceptions import ChatClientError, UserNotLoggedInError, InvalidMessageError, RoomAccessDeniedError
 
 
 # - NOTE: ALL channel_layer methods are asynchronous
-class ChatConsumer(AsyncWebsocketConsumer):
+class ChatConsumer(QueryMetricsConsumerMixin, RealtimeMetricsConsumerMixin, AsyncWebsocketConsumer):
     async def connect(self):
         # Get the user object (provided by the TokenAuthMiddleware in SIIOT_chat_server/routing.py)
-        # self.user = self.scope["user"]
+        self.user = self.scope.get("user")
         self.room_name = self.scope['url_route']['kwargs']['room_name']
         # if self.user.is_anonymous:
         #     await self.close()
 
-        self.room_group_name = 'chat_%s' % str(self.room_name)
+        self.room_group_name = get_room_group_name(self.room_name)
 
         await self.channel_layer.group_add(
             self.room_group_name,
             self.channel_name
         )
 
-        # await add_user_as_active_websocket(self.user)
+        if self.user is not None and self.user.is_authenticated:
+            await add_user_as_active_websocket(self.user, self.channel_name)
 
         await self.accept()
 
@@ -34,27 +44,85 @@ class ChatConsumer(AsyncWebsocketConsumer):
             self.channel_name
         )
 
+        if self.user is not None and self.user.is_authenticated:
+            await add_user_as_inactive_websocket(self.user, self.channel_name)
+
         await self.close()
-        # await add_user_as_inactive_websocket(self.user)
 
     # Receive message from WebSocket
     async def receive(self, text_data=None, bytes_data=None):
-
-        # if not self.user.is_authenticated:
-        #     raise UserNotLoggedInError()
-        text_data_json = json.loads(text_data)
-        message = text_data_json['message']
-        owner = text_data_json['owner']
+        """
+        client 가 보낸 message 를 검증/저장한 후, 저장된 message 를 room group 에 broadcast 합니다.
+        (REST 의 ChatMessageViewSet.message 와 같은 chat.pipeline.create_message 를 사용합니다.)
+        settings.CHAT_WRITE_BEHIND 가 True 이면 먼저 broadcast 하고 저장은 chat.write_behind 가 모아서 합니다.
+        - data : {'message_type': 1, 'text': String} ('message' 로 보낸 text 도 허용합니다.)
+        """
+        received_at = time.perf_counter()
+        try:
+            if self.user is None or not self.user.is_authenticated:
+                raise UserNotLoggedInError()
+            data = self._parse_message(text_data)
+            chat_room = await self._get_chat_room()
+            event_args = None
+            if settings.CHAT_WRITE_BEHIND:
+                event_args = await write_behind.accept(chat_room, self.user, data)
+            if event_args is None:
+                new_message = await self._create_message(chat_room, data)
+                event_args = (new_message.text, new_message.owner_id, new_message.created_at)
+        except ChatClientError as e:
+            await self._send_error(e)
+            return
 
         # Send message to room group
         await self.channel_layer.group_send(
             self.room_group_name,
-            {
-                'type': 'chat_message',
-                'message': message,
-                'owner': owner
-            }
+            new_message_event(*event_args)
         )
+        realtime_metrics.receive_to_broadcast.observe(time.perf_counter() - received_at)
+
+    def _parse_message(self, text_data):
+        try:
+            text_data_json = json.loads(text_data)
+        except (TypeError, ValueError):
+            raise InvalidMessageError()
+        if not isinstance(text_data_json, dict):
+            raise InvalidMessageError()
+
+        message_type = text_data_json.get('message_type', 1)
+        text = text_data_json.get('text', text_data_json.get('message'))
+        if message_type != 1 or not isinstance(text, str) or not text:
+            # image message 는 REST (ChatMessageViewSet.message) 로 보냅니다.
+            raise InvalidMessageError()
+        return {'message_type': message_type, 'text': text}
+
+    async def _get_chat_room(self):
+        # buyer/seller_active 와 unread counter, watermark 는 connection 중에도 바뀌므로 message 마다 다시 조회합니다.
+        # (REST 의 ChatMessageViewSet.message 와 같이 pk 로 한 row 만 읽습니다.)
+        chat_room = await self._load_chat_room()
+        if chat_room is None or chat_room.get_participant_role(self.user) is None:
+            raise RoomAccessDeniedError()
+        return chat_room
+
+    @database_sync_to_async
+    def _load_chat_room(self):
+        try:
+            return ChatRoom.objects.filter(pk=self.room_name).first()
+        except ValueError:
+            return None
+
+    @database_sync_to_async
+    def _create_message(self, chat_room, data):
+        try:
+            return create_message(chat_room, self.user, data)
+        except serializers.ValidationError:
+            raise InvalidMessageError()
+
+    async def _send_error(self, error):
+        await self.send(text_data=json.dumps({
+            'type': error.type,
+            'error_code': error.error_code,
+            'error_message': error.error_message,
+        }))
 
     # Receive chat_message from room group and send down to client(s)
     async def chat_message(self, message):
@@ -64,5 +132,11 @@ class ChatConsumer(AsyncWebsocketConsumer):
 
     # The following is called by the CONSUMER to send the message to the CLIENT
     async def _send_consumer_to_client(self, event):
-        await self.send(text_data=json.dumps(event))
+        # sender 가 미리 encode 한 frame (chat.send_utils.encode_event) 은 그대로 보냅니다.
+        if 'frame' in event:
+            await self.send(text_data=event['frame'])
+        else:
+            with query_metrics.serialize_timer():
+                text_data = json.dumps(event)
+            await self.send(text_data=text_data)
 
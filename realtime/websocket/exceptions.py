@@ -22,3 +22,19 @@ class UserNotLoggedInError(ChatClientError):
 
     def __init__(self):
         super().__init__()
+
+
+class InvalidMessageError(ChatClientError):
+    ERROR_CODE = 2
+    ERROR_MESSAGE = "Invalid message."
+
+    def __init__(self):
+        super().__init__()
+
+
+class RoomAccessDeniedError(ChatClientError):
+    ERROR_CODE = 3
+    ERROR_MESSAGE = "You are not a member of this room."
+
+    def __init__(self):
+        super().__init__()
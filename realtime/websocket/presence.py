@@ -0,0 +1,99 @@
+import asyncio
+import logging
+import time
+
+import redis
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+from core.redis import get_redis
+
+logger = logging.getLogger(__name__)
+
+PRESENCE_KEY_FORMAT = 'presence:user:{}'
+
+
+class PresenceService(object):
+    """
+    user 별 websocket 접속 상태를 Redis 에 저장합니다. (UserWebSocketActivity row 대신 사용)
+    - user 마다 sorted set 하나에 connection(channel_name) 을 만료 시각(score) 과 함께 저장하므로
+      여러 기기에서 동시에 접속해도 connection 수로 셀 수 있습니다.
+    - worker 는 자신이 가진 connection 의 만료 시각을 PRESENCE_HEARTBEAT_INTERVAL 마다 pipeline 한번으로 갱신합니다.
+      worker 가 죽으면 갱신이 멈추고 PRESENCE_TTL 이 지나면 offline 으로 보입니다.
+    - get_connection_counts / get_online_user_ids 는 여러 user 를 pipeline 한번으로 조회합니다.
+    """
+
+    def __init__(self):
+        self.ttl = settings.PRESENCE_TTL
+        self.heartbeat_interval = settings.PRESENCE_HEARTBEAT_INTERVAL
+        self._connections = {}  # channel_name -> user_id (이 worker 의 connection)
+        self._loop = None
+        self._heartbeat = None
+
+    def make_key(self, user_id):
+        return PRESENCE_KEY_FORMAT.format(user_id)
+
+    def _start(self):
+        # heartbeat task 는 process 의 event loop 에 하나만 띄웁니다.
+        loop = asyncio.get_event_loop()
+        if self._heartbeat is None or self._heartbeat.done() or self._loop is not loop:
+            self._loop = loop
+            self._heartbeat = asyncio.ensure_future(self._run())
+
+    async def connect(self, user_id, channel_name):
+        self._start()
+        self._connections[channel_name] = user_id
+        try:
+            await sync_to_async(self._touch)({channel_name: user_id})
+        except redis.RedisError:
+            logger.exception('presence connect failed (user %s)', user_id)
+
+    async def disconnect(self, user_id, channel_name):
+        self._connections.pop(channel_name, None)
+        try:
+            await sync_to_async(get_redis().zrem)(self.make_key(user_id), channel_name)
+        except redis.RedisError:
+            logger.exception('presence disconnect failed (user %s)', user_id)
+
+    def _touch(self, connections):
+        now = time.time()
+        with get_redis().pipeline(transaction=False) as pipe:
+            for channel_name, user_id in connections.items():
+                key = self.make_key(user_id)
+                pipe.zadd(key, {channel_name: now + self.ttl})
+                pipe.zremrangebyscore(key, '-inf', now)
+                pipe.expire(key, self.ttl)
+            pipe.execute()
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.heartbeat_interval)
+            if not self._connections:
+                continue
+            try:
+                await sync_to_async(self._touch)(dict(self._connections))
+            except redis.RedisError:
+                logger.exception('presence heartbeat failed (%s connections)', len(self._connections))
+
+    def get_connection_counts(self, user_ids):
+        """
+        :return: {user_id: 만료되지 않은 connection 수}
+        """
+        user_ids = list(user_ids)
+        if not user_ids:
+            return {}
+        now = time.time()
+        with get_redis().pipeline(transaction=False) as pipe:
+            for user_id in user_ids:
+                pipe.zcount(self.make_key(user_id), now, '+inf')
+            counts = pipe.execute()
+        return dict(zip(user_ids, counts))
+
+    def get_online_user_ids(self, user_ids):
+        return {user_id for user_id, count in self.get_connection_counts(user_ids).items() if count}
+
+    def is_online(self, user_id):
+        return bool(self.get_connection_counts([user_id])[user_id])
+
+
+presence = PresenceService()
@@ -1,32 +1,65 @@
 from channels.auth import AuthMiddlewareStack
-from rest_framework.authtoken.models import Token
 from django.contrib.auth.models import AnonymousUser
-from django.db import close_old_connections
+
+from accounts.tokens import async_resolve_token, is_allowed_user
 
 
 class TokenAuthMiddleware:
     """
     Token authorization middleware for Django Channels 2
+    Authorization: Token <key> header 가 있으면 accounts.tokens 의 cache 로 user 를 찾고 inner 를 바로 부릅니다.
+    header 가 없는 connection 은 scope['user'] 를 건드리지 않고 fallback 에 넘깁니다.
+    (TokenAuthMiddlewareStack 은 fallback 으로 AuthMiddlewareStack(session) 을 쓰므로, token 으로 인증한 connection 은
+    session / cookie 조회를 하지 않습니다.)
     """
 
-    def __init__(self, inner):
+    def __init__(self, inner, fallback=None):
         self.inner = inner
+        self.fallback = fallback or inner
 
     def __call__(self, scope):
-        headers = dict(scope['headers'])
-        if 'Authorization' in headers:
-            try:
-                token_name, token_key = headers['Authorization'].decode().split()
-                if "Token" in token_name:
-                    token = Token.objects.get(key=token_key)
-                    scope['user'] = token.user
-                    close_old_connections()
-            except Token.DoesNotExist:
-                scope['user'] = AnonymousUser()
-        else:
-            scope['user'] = AnonymousUser()
-
-        return self.inner(scope)
-
-
-TokenAuthMiddlewareStack = lambda inner: TokenAuthMiddleware(AuthMiddlewareStack(inner))
+        return TokenAuthMiddlewareInstance(scope, self)
+
+
+class TokenAuthMiddlewareInstance:
+    """
+    connection 마다 만들어지는 instance 입니다. token 조회가 event loop 를 막지 않도록 async 로 처리합니다.
+    """
+
+    def __init__(self, scope, middleware):
+        self.middleware = middleware
+        self.scope = dict(scope)
+
+    async def __call__(self, receive, send):
+        token_key = get_token_key(self.scope)
+        if token_key is None:
+            inner = self.middleware.fallback(self.scope)
+            return await inner(receive, send)
+
+        user = await async_resolve_token(token_key)
+        if user is None or not is_allowed_user(user):
+            user = AnonymousUser()
+        self.scope['user'] = user
+        inner = self.middleware.inner(self.scope)
+        return await inner(receive, send)
+
+
+def get_token_key(scope):
+    """
+    ASGI header 는 소문자 bytes key 입니다.
+    :return: token key or None (Authorization: Token <key> 형식이 아닌 경우)
+    """
+    headers = dict(scope.get('headers', ()))
+    authorization = headers.get(b'authorization')
+    if not authorization:
+        return None
+    try:
+        token_name, token_key = authorization.decode().split()
+    except ValueError:
+        return None
+    if token_name != 'Token':
+        return None
+    return token_key
+
+
+TokenAuthMiddlewareStack = lambda inner: TokenAuthMiddleware(inner, fallback=AuthMiddlewareStack(inner))
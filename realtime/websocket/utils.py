@@ -1,27 +1,24 @@
-from channels.db import database_sync_to_async
-from .models import UserWebSocketActivity
+from .presence import presence
 
 
 # Group names may only contain letters, digits, hyphens, and periods. Therefore this example code will fail on
 # room names that have other characters (so we would need proper validation to tighten this up).
 
-def _set_user_websocket_activity(user, active):
-    obj, created = UserWebSocketActivity.objects.get_or_create(user=user)
-    if obj.active != active:
-        obj.active = active
-        obj.save()
+async def add_user_as_active_websocket(user, channel_name):
+    await presence.connect(user.id, channel_name)
 
 
-@database_sync_to_async
-def add_user_as_active_websocket(user):
-    _set_user_websocket_activity(user, True)
+async def add_user_as_inactive_websocket(user, channel_name):
+    await presence.disconnect(user.id, channel_name)
 
 
-@database_sync_to_async
-def add_user_as_inactive_websocket(user):
-    _set_user_websocket_activity(user, False)
+def check_if_websocket_is_active(user):
+    return presence.is_online(user.id)
 
 
-def check_if_websocket_is_active(user):
-    obj, created = UserWebSocketActivity.objects.get_or_create(user=user)
-    return obj.active
+def get_active_websocket_user_ids(user_ids):
+    """
+    여러 user 의 접속 여부를 Redis 조회 한번으로 확인합니다.
+    :return: websocket 에 접속 중인 user id set
+    """
+    return presence.get_online_user_ids(user_ids)